@@ -3,10 +3,25 @@ import connexion
 import logging.config
 import yaml
 import json
+import time
+import base64
+import requests
+from datetime import datetime, timedelta
+from collections import OrderedDict
+from threading import Thread, Lock
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
+from flask import Response, stream_with_context
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
+from event_index import EventIndex
+from event_stats import EventStats
+import event_digest
+from event_digest import EventDigests
+import event_envelope
+import metrics
+import health
+from live_updates import Broadcaster, LiveUpdates
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -28,6 +43,64 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+event_index = EventIndex(app_config['datastore']['index_filename'])
+event_stats = EventStats(app_config['datastore']['stats_filename'])
+event_digests = EventDigests(app_config['datastore']['digest_filename'], app_config['reconcile']['days_kept'])
+
+# Most recently consumed raw messages, keyed by (event_type, index), decoded only when requested
+recent_events = OrderedDict()
+recent_events_lock = Lock()
+# Pushes a sample of the recent events to the Dashboards subscribed to the events stream
+event_updates = Broadcaster(app_config['live']['keepalive_sec'])
+last_published = {}
+
+SCANNED_PER_EVENT = metrics.Histogram('analyzer_messages_scanned', 'Kafka messages read to serve a request',
+                                      {'endpoint': 'event'}, metrics.COUNT_BUCKETS)
+SCANNED_PER_PAGE = metrics.Histogram('analyzer_messages_scanned', 'Kafka messages read to serve a request',
+                                     {'endpoint': 'events'}, metrics.COUNT_BUCKETS)
+RECENT_CACHE_HITS = metrics.Counter('analyzer_recent_cache_hits_total', 'Events served from the recent events cache')
+TAILED_MESSAGES = metrics.Counter('analyzer_tailed_messages_total', 'Messages consumed by the index tail consumer')
+STREAM_CLIENTS = metrics.Gauge('analyzer_stream_clients', 'Clients connected to the events stream',
+                               callback=lambda: event_updates.clients)
+
+def connect_kafka():
+    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
+    client = KafkaClient(hosts=hostname)
+    return client.topics[str.encode(app_config['events']['topic'])]
+
+
+# Connects in the background once started; the tail consumer reconnects it after broker failures
+kafka_topic = health.Dependency('kafka', connect_kafka,
+                                app_config['connections']['initial_backoff_sec'],
+                                app_config['connections']['max_backoff_sec'])
+
+
+def get_kafka_topic():
+    """Returns the events topic, or raises health.Unavailable while Kafka is not connected."""
+    return kafka_topic.get()
+
+
+def cache_recent_event(event_type, index, raw):
+    with recent_events_lock:
+        recent_events[(event_type, index)] = raw
+        while len(recent_events) > app_config['index']['recent_cache_size']:
+            recent_events.popitem(last=False)
+
+
+def publish_recent_events():
+    """Publishes the newest cached event of each type, if it's newer than the one last published."""
+    newest = {}
+    with recent_events_lock:
+        for (event_type, index), raw in reversed(recent_events.items()):
+            if event_type not in newest:
+                newest[event_type] = (index, raw)
+    for event_type, (index, raw) in newest.items():
+        if last_published.get(event_type) == index:
+            continue
+        last_published[event_type] = index
+        event_updates.publish(event_type, {"index": index, **event_envelope.decode_payload(raw)})
+
+
 def get_sensor_data_reading(index):
     return get_event_from_kafka('sensor_data', index)
 
@@ -35,56 +108,407 @@ def get_user_command_reading(index):
     return get_event_from_kafka('user_command', index)
 
 def get_event_from_kafka(event_type, index):
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+    with recent_events_lock:
+        raw = recent_events.get((event_type, index))
+    if raw is not None:
+        RECENT_CACHE_HITS.inc()
+        SCANNED_PER_EVENT.observe(0)
+        logger.info(f"Returning {event_type} at index {index} from the recent events cache")
+        return event_envelope.decode_payload(raw), 200
 
-    # Track separate indices for each event type
-    event_index = 0
+    location = event_index.lookup(event_type, index)
+    if location is None:
+        return { "message": "Not Found" }, 404
 
+    partition_id, offset = location
     try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg['type'] == event_type:
-                if event_index == index:
-                    logger.info(f"Returning {event_type} at index {index}")
-                    return msg['payload'], 200
-                event_index += 1  # Only increment if the type matches
-        return { "message": "Not Found" }, 404
+        msg = fetch_message(partition_id, offset)
+        SCANNED_PER_EVENT.observe(0 if msg is None else 1)
+        if msg is None:
+            logger.error(f"{event_type} at index {index} is no longer available at partition {partition_id} offset {offset}")
+            return { "message": "Not Found" }, 404
+        logger.info(f"Returning {event_type} at index {index}")
+        return event_envelope.decode_payload(msg.value), 200
+    except health.Unavailable as e:
+        logger.error(str(e))
+        return { "message": "Kafka unavailable" }, 503
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         return { "message": "Error retrieving message" }, 500
 
 
-def get_event_stats():
-    hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
+def offset_before(offset):
+    """Returns the offset to pass to reset_offsets so the consumer resumes at offset.
+
+    pykafka resumes from the offset after the one given, and reads -1 as OffsetType.LATEST,
+    so the first message of a partition has to be reached with OffsetType.EARLIEST instead.
+    """
+    return offset - 1 if offset > 0 else OffsetType.EARLIEST
 
-    num_sensor_data = 0
-    num_user_command = 0
 
+def fetch_message(partition_id, offset):
+    """Reads the single message stored at the given partition and offset."""
+    topic = get_kafka_topic()
+    partition = topic.partitions[partition_id]
+    consumer = topic.get_simple_consumer(partitions=[partition],
+                                         consumer_timeout_ms=1000)
     try:
-        for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            if msg['type'] == 'sensor_data':
-                num_sensor_data += 1
-            elif msg['type'] == 'user_command':
-                num_user_command += 1
+        consumer.reset_offsets([(partition, offset_before(offset))])
+        msg = consumer.consume()
+        if msg is None or msg.offset != offset:
+            return None
+        return msg
+    finally:
+        consumer.stop()
+
+
+def get_resume_offset(partition_id):
+    """Returns the last offset consumed by all of the event index, stats and digests."""
+    offsets = [checkpoint.last_offsets.get(partition_id) for checkpoint in (event_index, event_stats, event_digests)]
+    if None in offsets:
+        return OffsetType.EARLIEST
+    return min(offsets)
+
+
+def encode_cursor(event_type, index, partition_id, offset):
+    cursor = json.dumps([event_type, index, partition_id, offset]).encode('utf-8')
+    return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+
+def decode_cursor(cursor):
+    event_type, index, partition_id, offset = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return event_type, index, partition_id, offset
+
+
+class PartitionReader:
+    """Reads forward through one partition, so a page costs one sequential read per partition."""
+
+    def __init__(self, topic, partition_id, offset):
+        self.partition = topic.partitions[partition_id]
+        self.consumer = topic.get_simple_consumer(partitions=[self.partition],
+                                                  consumer_timeout_ms=1000)
+        self.consumer.reset_offsets([(self.partition, offset_before(offset))])
+        self.scanned = 0
+
+    def read(self, offset):
+        """Returns the message at the offset, skipping any messages in between."""
+        while True:
+            msg = self.consumer.consume()
+            if msg is None or msg.offset > offset:
+                return None
+            self.scanned += 1
+            if msg.offset == offset:
+                return msg
+
+    def stop(self):
+        self.consumer.stop()
+
+
+def get_events(type, from_index=0, limit=None, cursor=None):
+    event_type = type
+    max_page_size = app_config['paging']['max_page_size']
+    limit = min(limit or max_page_size, max_page_size)
+
+    if cursor is not None:
+        try:
+            cursor_type, from_index, partition_id, offset = decode_cursor(cursor)
+        except (ValueError, TypeError):
+            return { "message": "Invalid cursor" }, 400
+        if cursor_type != event_type or event_index.lookup(event_type, from_index) not in (None, (partition_id, offset)):
+            return { "message": "Cursor does not match the event index" }, 400
+
+    end_index = min(from_index + limit, event_index.count(event_type))
+    if from_index >= end_index:
+        return { "events": [], "next_cursor": None }, 200
+
+    return Response(stream_with_context(generate_event_page(event_type, from_index, end_index)),
+                    mimetype='application/json')
+
+
+def generate_event_page(event_type, from_index, end_index):
+    """Streams events [from_index, end_index) of a type, stopping early once the page size cap is reached."""
+    max_page_bytes = app_config['paging']['max_page_bytes']
+    readers = {}
+    page_bytes = 0
+    index = from_index
+    next_cursor = None
+
+    yield '{"events": ['
+    try:
+        while index < end_index:
+            partition_id, offset = event_index.lookup(event_type, index)
+            if page_bytes >= max_page_bytes:
+                next_cursor = encode_cursor(event_type, index, partition_id, offset)
+                break
+
+            with recent_events_lock:
+                raw = recent_events.get((event_type, index))
+            if raw is not None:
+                RECENT_CACHE_HITS.inc()
+            else:
+                if partition_id not in readers:
+                    readers[partition_id] = PartitionReader(get_kafka_topic(), partition_id, offset)
+                msg = readers[partition_id].read(offset)
+                if msg is None:
+                    logger.error(f"{event_type} at index {index} is no longer available at partition {partition_id} offset {offset}")
+                    index += 1
+                    continue
+                raw = msg.value
+
+            event_str = json.dumps(event_envelope.decode_payload(raw))
+            yield event_str if page_bytes == 0 else ", " + event_str
+            page_bytes += len(event_str)
+            index += 1
+
+        if next_cursor is None and index < event_index.count(event_type):
+            partition_id, offset = event_index.lookup(event_type, index)
+            next_cursor = encode_cursor(event_type, index, partition_id, offset)
+    except Exception as e:
+        logger.error(f"Error streaming {event_type} events from index {index}: {str(e)}")
+        location = event_index.lookup(event_type, index)
+        if location is not None:
+            next_cursor = encode_cursor(event_type, index, *location)
+    finally:
+        scanned = sum(reader.scanned for reader in readers.values())
+        SCANNED_PER_PAGE.observe(scanned)
+        for reader in readers.values():
+            reader.stop()
 
+    logger.info(f"Returned {event_type} events {from_index} to {index} after scanning {scanned} messages")
+    yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+
+def new_tail_consumer(topic):
+    consumer = topic.get_simple_consumer(auto_offset_reset=OffsetType.EARLIEST,
+                                         reset_offset_on_start=False,
+                                         consumer_timeout_ms=1000)
+    consumer.reset_offsets([(partition, get_resume_offset(partition_id))
+                            for partition_id, partition in topic.partitions.items()])
+    return consumer
+
+
+def tail_events():
+    """Keeps the event index, stats and digests up to date by consuming new messages as they arrive."""
+    for checkpoint in (event_index, event_stats, event_digests):
+        try:
+            checkpoint.load()
+            logger.info(f"Loaded checkpoint from {checkpoint.filename}")
+        except Exception as e:
+            logger.error(f"Could not load {checkpoint.filename}, rebuilding from the start of the topic: {str(e)}")
+
+    checkpoint_interval = app_config['index']['checkpoint_interval_sec']
+    sample_interval = app_config['live']['sample_interval_sec']
+    last_checkpoint = time.time()
+    last_sample = time.time()
+    dirty = False
+    consumer = None
+    while True:
+        # After a broker failure, a new consumer resumes from what the index, stats and digests have seen
+        if consumer is None:
+            topic = kafka_topic.wait()
+            try:
+                consumer = new_tail_consumer(topic)
+            except Exception as e:
+                kafka_topic.reset(topic, e)
+                continue
+
+        try:
+            msg = consumer.consume()
+        except Exception as e:
+            try:
+                consumer.stop()
+            except Exception:
+                pass
+            kafka_topic.reset(topic, e)
+            consumer = None
+            continue
+
+        if msg is not None:
+            TAILED_MESSAGES.inc()
+            try:
+                # The index and stats only need the header; the payload is decoded for the digests
+                event_type, event_time = event_envelope.read_header(msg.value)
+                index = event_index.add(event_type, msg.partition_id, msg.offset)
+                if index is not None:
+                    cache_recent_event(event_type, index, msg.value)
+                event_stats.add(event_type, msg.partition_id, msg.offset,
+                                event_time if event_time is not None else time.time())
+                event_digests.add(event_type, event_envelope.decode_payload(msg.value), msg.partition_id, msg.offset)
+            except (ValueError, KeyError) as e:
+                logger.error(f"Skipping malformed message at partition {msg.partition_id} offset {msg.offset}: {str(e)}")
+                event_index.mark_consumed(msg.partition_id, msg.offset)
+                event_stats.mark_consumed(msg.partition_id, msg.offset)
+                event_digests.mark_consumed(msg.partition_id, msg.offset)
+            dirty = True
+
+        if dirty and time.time() - last_checkpoint >= checkpoint_interval:
+            event_index.save()
+            event_stats.save()
+            event_digests.save()
+            last_checkpoint = time.time()
+            dirty = False
+
+        if time.time() - last_sample >= sample_interval:
+            publish_recent_events()
+            last_sample = time.time()
+
+
+def get_event_stats():
+    try:
         stats = {
-            "num_sensor_data": num_sensor_data,
-            "num_user_command": num_user_command
+            "num_sensor_data": event_stats.count('sensor_data'),
+            "num_user_command": event_stats.count('user_command'),
+            "recent_sensor_data": event_stats.recent_counts('sensor_data'),
+            "recent_user_command": event_stats.recent_counts('user_command')
         }
         return stats, 200
     except Exception as e:
         logger.error(f"Error: {str(e)}")
         return { "message": "Error retrieving statistics" }, 500
 
+def format_hour(hour):
+    return hour.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def get_storage_json(path, params):
+    response = requests.get(f"{app_config['eventstore']['url']}{path}", params=params,
+                            timeout=app_config['eventstore']['timeout_sec'])
+    if response.status_code != 200:
+        raise Exception(f"Error fetching {path} from Storage, status code: {response.status_code}")
+    return response.json()
+
+
+def scan_bucket_trace_ids(event_type, hour):
+    """Reads the trace ids of the topic's events in an hour bucket, scanning only the bucket's offset ranges."""
+    topic = get_kafka_topic()
+    trace_ids = {}
+    for partition_id, (first, last) in event_digests.offset_ranges(event_type, hour).items():
+        partition = topic.partitions[partition_id]
+        consumer = topic.get_simple_consumer(partitions=[partition], consumer_timeout_ms=1000)
+        try:
+            consumer.reset_offsets([(partition, offset_before(first))])
+            while True:
+                msg = consumer.consume()
+                if msg is None or msg.offset > last:
+                    break
+                try:
+                    if event_envelope.read_type(msg.value) != event_type:
+                        continue
+                    payload = event_envelope.decode_payload(msg.value)
+                    if event_digest.bucket_start(payload['timestamp']) == hour:
+                        trace_ids[payload['trace_id']] = trace_ids.get(payload['trace_id'], 0) + 1
+                except (ValueError, KeyError, TypeError):
+                    continue
+        finally:
+            consumer.stop()
+    return trace_ids
+
+
+def drill_down(event_type, hour):
+    """Returns the trace ids of a mismatched bucket that are missing from Storage, extra in it, or duplicated on the topic."""
+    max_trace_ids = app_config['reconcile']['max_trace_ids']
+    topic_trace_ids = scan_bucket_trace_ids(event_type, hour)
+    stored_trace_ids = set(get_storage_json('/reconcile/trace-ids',
+                                            {"event_type": event_type, "bucket_start": format_hour(hour)}))
+    return {
+        "missing": sorted(set(topic_trace_ids) - stored_trace_ids)[:max_trace_ids],
+        "extra": sorted(stored_trace_ids - set(topic_trace_ids))[:max_trace_ids],
+        "duplicated": sorted(trace_id for trace_id, count in topic_trace_ids.items() if count > 1)[:max_trace_ids]
+    }
+
+
+def reconcile(start, end, drill_down_mismatches=True):
+    """Compares per-hour counts and trace id digests of the topic and Storage over [start, end)."""
+    topic_digests = event_digests.digests(start, end)
+    stored_digests = {(digest['event_type'], datetime.fromisoformat(digest['bucket_start'])):
+                      (digest['count'], digest['digest'])
+                      for digest in get_storage_json('/reconcile/digests', {"start_timestamp": format_hour(start),
+                                                                            "end_timestamp": format_hour(end)})}
+    mismatches = []
+    for key in sorted(set(topic_digests) | set(stored_digests)):
+        topic_count, topic_digest = topic_digests.get(key, (0, 0))
+        stored_count, stored_digest = stored_digests.get(key, (0, 0))
+        if (topic_count, topic_digest) == (stored_count, stored_digest):
+            continue
+        event_type, hour = key
+        mismatch = {
+            "event_type": event_type,
+            "bucket_start": format_hour(hour),
+            "topic_count": topic_count,
+            "stored_count": stored_count
+        }
+        if drill_down_mismatches:
+            mismatch.update(drill_down(event_type, hour))
+        mismatches.append(mismatch)
+
+    logger.info(f"Reconciled {len(set(topic_digests) | set(stored_digests))} buckets from {start} to {end}, "
+                f"{len(mismatches)} mismatched")
+    return {
+        "start_timestamp": format_hour(start),
+        "end_timestamp": format_hour(end),
+        "buckets": len(set(topic_digests) | set(stored_digests)),
+        "topic_count": sum(count for count, _ in topic_digests.values()),
+        "stored_count": sum(count for count, _ in stored_digests.values()),
+        "mismatches": mismatches
+    }
+
+
+def get_reconciliation(start_timestamp, end_timestamp, drill_down=True):
+    try:
+        start = datetime.fromisoformat(start_timestamp.strip())
+        end = datetime.fromisoformat(end_timestamp.strip())
+    except ValueError as e:
+        return { "message": f"Invalid request: {str(e)}" }, 400
+    try:
+        return reconcile(start.replace(minute=0, second=0, microsecond=0), end, drill_down), 200
+    except Exception as e:
+        logger.error(f"Error reconciling: {str(e)}")
+        return { "message": "Error reconciling with Storage" }, 500
+
+
+last_audit = None
+
+
+def run_audit():
+    """Periodically reconciles the hours before the last settle_hours, which may still have events in flight."""
+    global last_audit
+    reconcile_config = app_config['reconcile']
+    # Give the tail consumer time to catch up after a restart
+    time.sleep(reconcile_config['initial_delay_sec'])
+    while True:
+        end = datetime.utcnow().replace(minute=0, second=0, microsecond=0) - \
+            timedelta(hours=reconcile_config['settle_hours'])
+        start = end - timedelta(hours=reconcile_config['lookback_hours'])
+        try:
+            last_audit = dict(reconcile(start, end), audited=datetime.utcnow().isoformat())
+            for mismatch in last_audit['mismatches']:
+                logger.warning(f"Reconciliation mismatch: {mismatch}")
+        except Exception as e:
+            logger.error(f"Error running reconciliation audit: {str(e)}")
+        time.sleep(reconcile_config['interval_sec'])
+
+
+def get_last_audit():
+    if last_audit is None:
+        return { "message": "No audit has run yet" }, 404
+    return last_audit, 200
+
+
+def get_metrics():
+    return metrics.get_metrics()
+
+
+def get_live():
+    return health.get_live()
+
+
+def get_ready():
+    return health.get_ready()
+
+
+def init_connections():
+    kafka_topic.start()
+
 app = connexion.FlaskApp(__name__, specification_dir='./')
 app.add_middleware(
     CORSMiddleware,
@@ -94,7 +518,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    LiveUpdates,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    path="/events/stream",
+    broadcaster=event_updates,
+)
 app.add_api("openapi.yml")
 
 if __name__ == "__main__":
+    init_connections()
+    t1 = Thread(target=tail_events)
+    t1.daemon = True
+    t1.start()
+    t2 = Thread(target=run_audit)
+    t2.daemon = True
+    t2.start()
     app.run(host='0.0.0.0',port=8110)
\ No newline at end of file
@@ -0,0 +1,121 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime, timezone, timedelta
+
+DIGEST_MODULUS = 1 << 62
+
+
+def trace_id_hash(trace_id):
+    """62-bit hash of a trace id; must match Storage's, so both sides compute the same digests."""
+    return int.from_bytes(hashlib.sha1(trace_id.encode('utf-8')).digest()[:8], 'big') >> 2
+
+
+def bucket_start(timestamp):
+    """Returns the hour (naive UTC, as Storage stores it) of an ISO 8601 event timestamp."""
+    parsed = datetime.fromisoformat(timestamp.strip().replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.replace(minute=0, second=0, microsecond=0)
+
+
+class EventDigests:
+    """Per-type, per-hour counts and digests of the trace ids on the topic, for reconciling with Storage.
+
+    A digest is the sum of the trace ids' hashes modulo 2^62, so it doesn't depend on the order
+    events arrive in, and a duplicated event changes it. Each bucket also keeps the range of
+    offsets its events came from in each partition, so a mismatched bucket can be rescanned alone.
+    """
+
+    def __init__(self, filename, days_kept):
+        self.filename = filename
+        self.days_kept = days_kept
+        self.buckets = {}
+        self.last_offsets = {}
+        self.lock = threading.Lock()
+
+    def add(self, event_type, payload, partition_id, offset):
+        """Adds an event to its hour's digest, ignoring offsets that were already added.
+
+        Events whose timestamp can't be parsed are skipped, as Storage doesn't store them either.
+        """
+        try:
+            key = (event_type, bucket_start(payload['timestamp']))
+            hashed = trace_id_hash(payload['trace_id'])
+        except (KeyError, TypeError, ValueError):
+            self.mark_consumed(partition_id, offset)
+            return False
+        with self.lock:
+            if offset <= self.last_offsets.get(partition_id, -1):
+                return False
+            self.last_offsets[partition_id] = offset
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = {"count": 0, "digest": 0, "offsets": {}}
+            bucket["count"] += 1
+            bucket["digest"] = (bucket["digest"] + hashed) % DIGEST_MODULUS
+            first, last = bucket["offsets"].get(partition_id, (offset, offset))
+            bucket["offsets"][partition_id] = (min(first, offset), max(last, offset))
+            return True
+
+    def mark_consumed(self, partition_id, offset):
+        with self.lock:
+            if offset > self.last_offsets.get(partition_id, -1):
+                self.last_offsets[partition_id] = offset
+
+    def digests(self, start, end):
+        """Returns {(event_type, bucket_start): (count, digest)} for the hours in [start, end)."""
+        with self.lock:
+            return {key: (bucket["count"], bucket["digest"]) for key, bucket in self.buckets.items()
+                    if start <= key[1] < end}
+
+    def offset_ranges(self, event_type, start):
+        """Returns {partition_id: (first offset, last offset)} of a bucket's events."""
+        with self.lock:
+            bucket = self.buckets.get((event_type, start))
+            return dict(bucket["offsets"]) if bucket is not None else {}
+
+    def prune(self):
+        """Drops buckets older than days_kept."""
+        oldest = datetime.utcnow() - timedelta(days=self.days_kept)
+        with self.lock:
+            for key in [key for key in self.buckets if key[1] < oldest]:
+                del self.buckets[key]
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r') as f:
+            checkpoint = json.load(f)
+        with self.lock:
+            self.buckets = {
+                (bucket["event_type"], datetime.fromisoformat(bucket["bucket_start"])): {
+                    "count": bucket["count"],
+                    "digest": bucket["digest"],
+                    "offsets": {int(partition_id): tuple(offsets)
+                                for partition_id, offsets in bucket["offsets"].items()}
+                }
+                for bucket in checkpoint['buckets']
+            }
+            self.last_offsets = {int(partition_id): offset
+                                 for partition_id, offset in checkpoint['last_offsets'].items()}
+        return True
+
+    def save(self):
+        """Writes a checkpoint to a temp file and renames it over the previous one."""
+        self.prune()
+        with self.lock:
+            checkpoint = {
+                "buckets": [dict(bucket, event_type=event_type, bucket_start=start.isoformat(),
+                                 offsets=dict(bucket["offsets"]))
+                            for (event_type, start), bucket in self.buckets.items()],
+                "last_offsets": dict(self.last_offsets)
+            }
+
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
@@ -0,0 +1,146 @@
+import os
+import struct
+import threading
+from array import array
+
+# File layout (little endian). The index file is append-only, each save adding the entries since the last:
+#   header:     magic, version
+#   per save:   per type with new entries: name length, name, entry count, partition ids (int16), offsets (int64)
+# The sidecar file, replaced at each save, holds the consumed offsets the index file is complete up to:
+#   header:     magic, version, length of the index file, number of partitions
+#   partitions: (partition id, last offset consumed) pairs
+# Anything appended past the recorded length, by a checkpoint that didn't finish, is discarded.
+MAGIC = b'AIDX'
+VERSION = 2
+HEADER = struct.Struct('<4sH')
+SIDECAR_HEADER = struct.Struct('<4sHQI')
+PARTITION_OFFSET = struct.Struct('<iq')
+TYPE_HEADER = struct.Struct('<HQ')
+
+
+class EventIndex:
+    """Maps (event_type, ordinal) to the (partition, offset) the event was stored at."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.sidecar_filename = f"{filename}.offsets"
+        self.partitions = {}
+        self.offsets = {}
+        self.last_offsets = {}
+        self.lock = threading.Lock()
+        # How much of the index file the sidecar covers, or None until it's loaded or first written
+        self.saved_length = None
+        self.saved_counts = {}
+
+    def add(self, event_type, partition_id, offset):
+        """Appends an event to the index, ignoring offsets that were already indexed."""
+        with self.lock:
+            if offset <= self.last_offsets.get(partition_id, -1):
+                return None
+            if event_type not in self.offsets:
+                self.partitions[event_type] = array('h')
+                self.offsets[event_type] = array('q')
+            self.partitions[event_type].append(partition_id)
+            self.offsets[event_type].append(offset)
+            self.last_offsets[partition_id] = offset
+            return len(self.offsets[event_type]) - 1
+
+    def mark_consumed(self, partition_id, offset):
+        """Records a consumed offset that did not produce an index entry."""
+        with self.lock:
+            if offset > self.last_offsets.get(partition_id, -1):
+                self.last_offsets[partition_id] = offset
+
+    def lookup(self, event_type, index):
+        with self.lock:
+            if event_type not in self.offsets or index < 0 or index >= len(self.offsets[event_type]):
+                return None
+            return self.partitions[event_type][index], self.offsets[event_type][index]
+
+    def count(self, event_type):
+        with self.lock:
+            return len(self.offsets.get(event_type, ()))
+
+    def load(self):
+        if not os.path.exists(self.filename) or not os.path.exists(self.sidecar_filename):
+            return False
+        with open(self.sidecar_filename, 'rb') as f:
+            magic, version, length, num_partitions = SIDECAR_HEADER.unpack(f.read(SIDECAR_HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"Unsupported index file {self.sidecar_filename}")
+            last_offsets = {}
+            for _ in range(num_partitions):
+                partition_id, offset = PARTITION_OFFSET.unpack(f.read(PARTITION_OFFSET.size))
+                last_offsets[partition_id] = offset
+        partitions = {}
+        offsets = {}
+        with open(self.filename, 'rb') as f:
+            magic, version = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"Unsupported index file {self.filename}")
+            while f.tell() < length:
+                name_length, count = TYPE_HEADER.unpack(f.read(TYPE_HEADER.size))
+                event_type = f.read(name_length).decode('utf-8')
+                if event_type not in offsets:
+                    partitions[event_type] = array('h')
+                    offsets[event_type] = array('q')
+                partitions[event_type].fromfile(f, count)
+                offsets[event_type].fromfile(f, count)
+            if f.tell() != length:
+                raise ValueError(f"Index file {self.filename} does not match {self.sidecar_filename}")
+        with self.lock:
+            self.last_offsets = last_offsets
+            self.partitions = partitions
+            self.offsets = offsets
+        self.saved_length = length
+        self.saved_counts = {event_type: len(type_offsets) for event_type, type_offsets in offsets.items()}
+        return True
+
+    def save(self):
+        """Appends the entries added since the last save, then replaces the sidecar with the new offsets.
+
+        The first save after starting without a loadable index rewrites the index file from scratch.
+        """
+        with self.lock:
+            last_offsets = dict(self.last_offsets)
+            types = [(event_type, self.partitions[event_type][self.saved_counts.get(event_type, 0):],
+                      self.offsets[event_type][self.saved_counts.get(event_type, 0):])
+                     for event_type in self.offsets]
+        types = [(event_type, partitions, offsets) for event_type, partitions, offsets in types if offsets]
+
+        if self.saved_length is None:
+            tmp_filename = f"{self.filename}.tmp"
+            with open(tmp_filename, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION))
+                self.write_entries(f, types)
+            os.replace(tmp_filename, self.filename)
+        else:
+            with open(self.filename, 'r+b') as f:
+                f.seek(self.saved_length)
+                f.truncate()
+                self.write_entries(f, types)
+        length = os.path.getsize(self.filename)
+
+        tmp_filename = f"{self.sidecar_filename}.tmp"
+        with open(tmp_filename, 'wb') as f:
+            f.write(SIDECAR_HEADER.pack(MAGIC, VERSION, length, len(last_offsets)))
+            for partition_id, offset in last_offsets.items():
+                f.write(PARTITION_OFFSET.pack(partition_id, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.sidecar_filename)
+
+        self.saved_length = length
+        for event_type, partitions, offsets in types:
+            self.saved_counts[event_type] = self.saved_counts.get(event_type, 0) + len(offsets)
+
+    @staticmethod
+    def write_entries(f, types):
+        for event_type, partitions, offsets in types:
+            name = event_type.encode('utf-8')
+            f.write(TYPE_HEADER.pack(len(name), len(offsets)))
+            f.write(name)
+            partitions.tofile(f)
+            offsets.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import threading
+
+BUCKET_SEC = 60
+BUCKETS_KEPT = 24 * 60
+
+WINDOWS = {
+    "last_minute": 60,
+    "last_hour": 60 * 60,
+    "last_day": 24 * 60 * 60
+}
+
+
+class EventStats:
+    """Running per-type event counts, with per-minute buckets covering the last day."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.counts = {}
+        self.buckets = {}
+        self.last_offsets = {}
+        self.lock = threading.Lock()
+
+    def add(self, event_type, partition_id, offset, event_time):
+        """Counts an event, ignoring offsets that were already counted."""
+        with self.lock:
+            if offset <= self.last_offsets.get(partition_id, -1):
+                return False
+            self.last_offsets[partition_id] = offset
+            self.counts[event_type] = self.counts.get(event_type, 0) + 1
+
+            bucket = int(event_time // BUCKET_SEC)
+            if bucket > time.time() // BUCKET_SEC - BUCKETS_KEPT:
+                type_buckets = self.buckets.setdefault(event_type, {})
+                type_buckets[bucket] = type_buckets.get(bucket, 0) + 1
+            return True
+
+    def mark_consumed(self, partition_id, offset):
+        with self.lock:
+            if offset > self.last_offsets.get(partition_id, -1):
+                self.last_offsets[partition_id] = offset
+
+    def count(self, event_type):
+        with self.lock:
+            return self.counts.get(event_type, 0)
+
+    def recent_counts(self, event_type):
+        """Returns the number of events of a type seen over each of the WINDOWS."""
+        now = time.time()
+        with self.lock:
+            type_buckets = dict(self.buckets.get(event_type, {}))
+        return {
+            name: sum(count for bucket, count in type_buckets.items()
+                      if (bucket + 1) * BUCKET_SEC > now - window_sec)
+            for name, window_sec in WINDOWS.items()
+        }
+
+    def prune(self):
+        """Drops buckets that are older than a day."""
+        oldest = time.time() // BUCKET_SEC - BUCKETS_KEPT
+        with self.lock:
+            for type_buckets in self.buckets.values():
+                for bucket in [b for b in type_buckets if b <= oldest]:
+                    del type_buckets[bucket]
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r') as f:
+            checkpoint = json.load(f)
+        with self.lock:
+            self.counts = checkpoint['counts']
+            self.buckets = {event_type: {int(bucket): count for bucket, count in type_buckets.items()}
+                            for event_type, type_buckets in checkpoint['buckets'].items()}
+            self.last_offsets = {int(partition_id): offset
+                                 for partition_id, offset in checkpoint['last_offsets'].items()}
+        return True
+
+    def save(self):
+        """Writes a checkpoint to a temp file and renames it over the previous one."""
+        self.prune()
+        with self.lock:
+            checkpoint = {
+                "counts": dict(self.counts),
+                "buckets": {event_type: dict(type_buckets) for event_type, type_buckets in self.buckets.items()},
+                "last_offsets": dict(self.last_offsets)
+            }
+
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
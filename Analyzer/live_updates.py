@@ -0,0 +1,125 @@
+"""Server-Sent Events streams, served on the event loop ahead of the Flask app.
+
+Flask handlers run on a small pool of worker threads, so a long-lived stream per viewer would
+soon use them all up. Instead LiveUpdates answers its path directly as ASGI middleware, and every
+connected client waits on the same Broadcaster: each update is encoded once, whichever thread
+publishes it, and written out to all of the clients, so a hundred viewers cost about as much as one.
+"""
+import json
+import asyncio
+import threading
+from collections import deque
+
+KEEPALIVE = b': keepalive\n\n'
+
+
+def encode_event(event_name, data):
+    return f"event: {event_name}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+class Broadcaster:
+    """Fans published events out to the connected stream clients."""
+
+    def __init__(self, keepalive_sec=15, history_size=100):
+        self.keepalive_sec = keepalive_sec
+        self.history = deque(maxlen=history_size)
+        self.latest = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.loop = None
+        self.changed = None
+        self.clients = 0
+
+    def publish(self, event_name, data, latest=None):
+        """Sends an event to every client; safe to call from any thread.
+
+        Clients that connect later, or fall too far behind, are sent latest instead if it's given,
+        e.g. the full state when data is only what changed.
+        """
+        message = encode_event(event_name, data)
+        with self.lock:
+            self.version += 1
+            self.history.append((self.version, message))
+            self.latest[event_name] = message if latest is None else encode_event(event_name, latest)
+            loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.wake)
+            except RuntimeError:
+                # The event loop has shut down
+                pass
+
+    def set_latest(self, event_name, data):
+        """Replaces the event sent to clients when they connect, without sending it to the connected ones."""
+        with self.lock:
+            self.latest[event_name] = encode_event(event_name, data)
+
+    def wake(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def messages_since(self, seen):
+        """Returns the messages published after version seen, or the latest of each event if seen is too old."""
+        with self.lock:
+            if self.version == seen:
+                return b'', seen
+            if not self.history or self.history[0][0] > seen + 1:
+                return b''.join(self.latest.values()), self.version
+            return b''.join(message for version, message in self.history if version > seen), self.version
+
+    async def stream(self, receive, send):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.changed = asyncio.Event()
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'),
+                        (b'cache-control', b'no-cache'),
+                        (b'access-control-allow-origin', b'*'),
+                        (b'x-accel-buffering', b'no')]
+        })
+        with self.lock:
+            seen = self.version
+            initial = b''.join(self.latest.values())
+        await send({'type': 'http.response.body', 'body': initial or KEEPALIVE, 'more_body': True})
+
+        self.clients += 1
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            while not disconnected.done():
+                changed = asyncio.ensure_future(self.changed.wait())
+                if self.version == seen:
+                    await asyncio.wait({changed, disconnected}, timeout=self.keepalive_sec,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+                if disconnected.done():
+                    break
+                messages, seen = self.messages_since(seen)
+                await send({'type': 'http.response.body', 'body': messages or KEEPALIVE, 'more_body': True})
+        except OSError:
+            pass
+        finally:
+            self.clients -= 1
+            disconnected.cancel()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class LiveUpdates:
+    """ASGI middleware serving a Broadcaster's stream at path, and passing other requests through."""
+
+    def __init__(self, app, path, broadcaster):
+        self.app = app
+        self.path = path
+        self.broadcaster = broadcaster
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'] == self.path and scope['method'] == 'GET':
+            await self.broadcaster.stream(receive, send)
+        else:
+            await self.app(scope, receive, send)
@@ -0,0 +1,107 @@
+"""Compares the legacy JSON and version 1 binary event envelopes.
+
+Reports the bytes per event and the encode/decode throughput of each format, plus how fast a
+consumer can read just the event type, or the type and time the Analyzer's tail consumer needs.
+
+    python envelope_bench.py [--events 100000] [--output envelope_bench.json]
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Receiver'))
+import event_envelope
+
+
+def sample_events(num_events):
+    events = []
+    for i in range(num_events):
+        if i % 2 == 0:
+            events.append(("sensor_data", {
+                "sensorId": f"sensor-{random.randint(0, 999)}",
+                "temperature": round(random.uniform(-10, 40), 1),
+                "timestamp": datetime.now().isoformat(),
+                "location": random.choice(["Living Room", "Kitchen", "Bedroom", "Garage"]),
+                "trace_id": str(uuid.uuid4())
+            }))
+        else:
+            events.append(("user_command", {
+                "userId": f"user-{random.randint(0, 99)}",
+                "targetDevice": "Thermostat",
+                "targetTemperature": round(random.uniform(15, 25), 1),
+                "timestamp": datetime.now().isoformat(),
+                "trace_id": str(uuid.uuid4())
+            }))
+    return events
+
+
+def run(events, binary):
+    now = datetime.now()
+
+    started = time.perf_counter()
+    encoded = [event_envelope.encode(event_type, now, payload, binary=binary) for event_type, payload in events]
+    encode_sec = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for raw in encoded:
+        event_envelope.decode(raw)
+    decode_sec = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for raw in encoded:
+        event_envelope.decode_payload(raw)
+    decode_payload_sec = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for raw in encoded:
+        event_envelope.read_type(raw)
+    read_type_sec = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for raw in encoded:
+        event_envelope.read_header(raw)
+    read_header_sec = time.perf_counter() - started
+
+    return {
+        "bytes_per_event": sum(len(raw) for raw in encoded) / len(encoded),
+        "encode_events_per_sec": len(events) / encode_sec,
+        "decode_events_per_sec": len(events) / decode_sec,
+        "decode_payload_events_per_sec": len(events) / decode_payload_sec,
+        "read_type_events_per_sec": len(events) / read_type_sec,
+        "read_header_events_per_sec": len(events) / read_header_sec
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--output', default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    events = sample_events(args.events)
+    results = {
+        "events": args.events,
+        "json": run(events, binary=False),
+        "binary": run(events, binary=True)
+    }
+
+    for name in ("json", "binary"):
+        print(f"{name:>6}: {results[name]['bytes_per_event']:7.1f} bytes/event, "
+              f"encode {results[name]['encode_events_per_sec']:10.0f}/s, "
+              f"decode {results[name]['decode_events_per_sec']:10.0f}/s, "
+              f"decode payload {results[name]['decode_payload_events_per_sec']:10.0f}/s, "
+              f"read type {results[name]['read_type_events_per_sec']:10.0f}/s, "
+              f"read header {results[name]['read_header_events_per_sec']:10.0f}/s")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
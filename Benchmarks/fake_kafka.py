@@ -0,0 +1,224 @@
+"""In-process stand-in for the parts of pykafka the services use.
+
+install() registers it as the pykafka package, so the services import it unchanged. Topics keep
+their messages in memory, with one list per partition, and every KafkaClient in the process sees
+the same topics, so Receiver's producer and the Storage and Analyzer consumers share them.
+"""
+import sys
+import time
+import types
+import zlib
+import itertools
+from queue import Queue
+from threading import Condition, Lock, local
+from collections import namedtuple
+
+NUM_PARTITIONS = 3
+
+OffsetPartitionResponse = namedtuple('OffsetPartitionResponse', ['offset', 'err'])
+
+
+class OffsetType:
+    EARLIEST = -2
+    LATEST = -1
+
+
+class CompressionType:
+    NONE = 0
+    GZIP = 1
+    SNAPPY = 2
+    LZ4 = 3
+
+
+class KafkaException(Exception):
+    pass
+
+
+class ProducerQueueFullError(KafkaException):
+    pass
+
+
+def hashing_partitioner(partitions, key):
+    return partitions[zlib.crc32(key) % len(partitions)]
+
+
+class Message:
+    def __init__(self, value, partition_key, partition_id, offset):
+        self.value = value
+        self.partition_key = partition_key
+        self.partition_id = partition_id
+        self.offset = offset
+        self.timestamp = int(time.time() * 1000)
+
+
+class Partition:
+    def __init__(self, topic, partition_id):
+        self.topic = topic
+        self.id = partition_id
+        self.messages = []
+
+
+class Topic:
+    def __init__(self, name, num_partitions):
+        self.name = name
+        self.partitions = {partition_id: Partition(self, partition_id) for partition_id in range(num_partitions)}
+        self.committed = {}
+        self.condition = Condition()
+        self.round_robin = itertools.count()
+
+    def size(self):
+        with self.condition:
+            return sum(len(partition.messages) for partition in self.partitions.values())
+
+    def append(self, value, partition_key=None, partitioner=None):
+        partitions = list(self.partitions.values())
+        if partition_key is not None and partitioner is not None:
+            partition = partitioner(partitions, partition_key)
+        else:
+            partition = partitions[next(self.round_robin) % len(partitions)]
+        with self.condition:
+            msg = Message(value, partition_key, partition.id, len(partition.messages))
+            partition.messages.append(msg)
+            self.condition.notify_all()
+        return msg
+
+    def latest_available_offsets(self):
+        with self.condition:
+            return {partition_id: OffsetPartitionResponse([len(partition.messages)], 0)
+                    for partition_id, partition in self.partitions.items()}
+
+    def get_sync_producer(self, **kwargs):
+        return Producer(self, delivery_reports=False)
+
+    def get_producer(self, delivery_reports=False, partitioner=None, **kwargs):
+        return Producer(self, delivery_reports, partitioner)
+
+    def get_simple_consumer(self, consumer_group=None, partitions=None, **kwargs):
+        return Consumer(self, consumer_group, partitions or list(self.partitions.values()), **kwargs)
+
+    def get_balanced_consumer(self, consumer_group, zookeeper_connect=None, post_rebalance_callback=None, **kwargs):
+        # A single member owns every partition, so there is never a rebalance to report
+        return Consumer(self, consumer_group, list(self.partitions.values()), **kwargs)
+
+
+class Producer:
+    def __init__(self, topic, delivery_reports, partitioner=None):
+        self.topic = topic
+        self.delivery_reports = delivery_reports
+        self.partitioner = partitioner
+        self.reports = local()
+
+    def report_queue(self):
+        # Like pykafka, delivery reports go back to the thread that produced the message
+        queue = getattr(self.reports, 'queue', None)
+        if queue is None:
+            queue = self.reports.queue = Queue()
+        return queue
+
+    def produce(self, message, partition_key=None):
+        msg = self.topic.append(message, partition_key, self.partitioner)
+        if self.delivery_reports:
+            self.report_queue().put((msg, None))
+        return msg
+
+    def get_delivery_report(self, block=False, timeout=None):
+        return self.report_queue().get(block, timeout)
+
+    def stop(self):
+        pass
+
+
+class Consumer:
+    def __init__(self, topic, consumer_group, partitions, auto_offset_reset=OffsetType.EARLIEST,
+                 reset_offset_on_start=False, consumer_timeout_ms=-1, **kwargs):
+        self.topic = topic
+        self.consumer_group = consumer_group
+        self.partitions = partitions
+        self.timeout_sec = None if consumer_timeout_ms < 0 else consumer_timeout_ms / 1000
+        self.next_offsets = {}
+        self.next_partition = 0
+        with topic.condition:
+            for partition in partitions:
+                committed = topic.committed.get((consumer_group, partition.id))
+                if consumer_group is not None and committed is not None and not reset_offset_on_start:
+                    self.next_offsets[partition.id] = committed + 1
+                else:
+                    self.next_offsets[partition.id] = self.start_offset(partition, auto_offset_reset)
+
+    @staticmethod
+    def start_offset(partition, offset):
+        if offset == OffsetType.EARLIEST:
+            return 0
+        if offset == OffsetType.LATEST:
+            return len(partition.messages)
+        return offset + 1
+
+    def reset_offsets(self, partition_offsets):
+        """Like pykafka, resumes each partition after the given offset."""
+        with self.topic.condition:
+            for partition, offset in partition_offsets:
+                self.next_offsets[partition.id] = self.start_offset(partition, offset)
+
+    def consume(self, block=True):
+        deadline = None if self.timeout_sec is None else time.monotonic() + self.timeout_sec
+        with self.topic.condition:
+            while True:
+                for _ in range(len(self.partitions)):
+                    partition = self.partitions[self.next_partition]
+                    self.next_partition = (self.next_partition + 1) % len(self.partitions)
+                    offset = self.next_offsets[partition.id]
+                    if offset < len(partition.messages):
+                        self.next_offsets[partition.id] = offset + 1
+                        return partition.messages[offset]
+                if not block:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.topic.condition.wait(remaining)
+
+    def commit_offsets(self, partition_offsets=None):
+        with self.topic.condition:
+            for partition, offset in partition_offsets or []:
+                self.topic.committed[(self.consumer_group, partition.id)] = offset
+
+    def stop(self):
+        pass
+
+
+class Topics(dict):
+    """Creates topics on first use, like a broker with auto.create.topics.enable."""
+
+    def __missing__(self, name):
+        with topics_lock:
+            return self.setdefault(name, Topic(name, NUM_PARTITIONS))
+
+
+topics_lock = Lock()
+topics = Topics()
+
+
+class KafkaClient:
+    def __init__(self, hosts=None, **kwargs):
+        self.hosts = hosts
+        self.topics = topics
+
+
+def install(num_partitions=NUM_PARTITIONS):
+    """Registers this module as pykafka and its common, exceptions and partitioners submodules."""
+    global NUM_PARTITIONS
+    NUM_PARTITIONS = num_partitions
+    submodules = {
+        'common': {'OffsetType': OffsetType, 'CompressionType': CompressionType},
+        'exceptions': {'KafkaException': KafkaException, 'ProducerQueueFullError': ProducerQueueFullError},
+        'partitioners': {'hashing_partitioner': hashing_partitioner}
+    }
+    package = types.ModuleType('pykafka')
+    package.__path__ = []
+    package.KafkaClient = KafkaClient
+    sys.modules['pykafka'] = package
+    for name, attributes in submodules.items():
+        module = types.ModuleType(f'pykafka.{name}')
+        module.__dict__.update(attributes)
+        setattr(package, name, module)
+        sys.modules[f'pykafka.{name}'] = module
@@ -0,0 +1,413 @@
+"""End-to-end load test of Receiver, Storage, Processing and Analyzer on one machine.
+
+The four services run in this process, each on its own port, against an in-memory fake of the
+events topic (fake_kafka.py) and a SQLite database in place of MySQL, with their configs generated
+into a scratch directory. Sender threads POST sensor data and user commands to Receiver at a fixed
+rate, and the run reports:
+
+- the offered, accepted and sustained (stored) event rates
+- p50/p99 ingest-to-stored latency, from each event's timestamp to its batch committing in Storage
+- how stale Processing's stats are, sampled while the load runs
+- Analyzer's single event and page latencies as the topic grows
+
+    python pipeline_bench.py [--rate 200] [--duration 60] [--output pipeline_bench.json]
+
+Needs each service's requirements plus uvicorn installed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import importlib.util
+from threading import Thread, Lock, Event
+from datetime import datetime, timezone
+
+import yaml
+import requests
+import uvicorn
+
+import fake_kafka
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+LOCATIONS = ["Living Room", "Kitchen", "Bedroom", "Garage", "Office"]
+
+LOG_CONFIG = {
+    'version': 1,
+    'formatters': {'simple': {'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s'}},
+    'handlers': {'console': {'class': 'logging.StreamHandler', 'formatter': 'simple', 'stream': 'ext://sys.stderr'}},
+    'loggers': {'basicLogger': {'level': 'WARNING', 'handlers': ['console'], 'propagate': False}},
+    'root': {'level': 'WARNING', 'handlers': ['console']}
+}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None
+    }
+
+
+def service_configs(args, work_dir):
+    """Returns each service's app_conf.yml, pointed at the local ports, SQLite and the scratch directory."""
+    storage_url = f"http://127.0.0.1:{args.base_port}"
+    configs = {}
+    for service in ('Receiver', 'Storage', 'Processing', 'Analyzer'):
+        with open(os.path.join(ROOT_DIR, service, 'app_conf.yml'), 'r') as f:
+            configs[service] = yaml.safe_load(f.read())
+
+    configs['Storage']['datastore']['url'] = f"sqlite:///{os.path.join(work_dir, 'events.db')}"
+    configs['Storage']['metrics']['lag_interval_sec'] = 1
+
+    configs['Receiver']['eventstore1']['url'] = f"{storage_url}/sensor-data"
+    configs['Receiver']['eventstore2']['url'] = f"{storage_url}/user-command"
+    configs['Receiver']['events']['producer']['mode'] = args.producer_mode
+
+    configs['Processing']['eventstore']['url'] = storage_url
+    configs['Processing']['scheduler']['period_sec'] = args.processing_period_sec
+    configs['Processing']['datastore']['filename'] = os.path.join(work_dir, 'processing', 'data.json')
+    configs['Processing']['datastore']['sketch_filename'] = os.path.join(work_dir, 'processing', 'sketches.json')
+
+    configs['Analyzer']['datastore']['index_filename'] = os.path.join(work_dir, 'analyzer', 'event_index.bin')
+    configs['Analyzer']['datastore']['stats_filename'] = os.path.join(work_dir, 'analyzer', 'event_stats.json')
+    configs['Analyzer']['datastore']['digest_filename'] = os.path.join(work_dir, 'analyzer', 'event_digests.json')
+    configs['Analyzer']['eventstore']['url'] = storage_url
+    return configs
+
+
+def load_service(service, app_config, work_dir):
+    """Imports a service's app.py with its generated config, as the module named app that its openapi.yml refers to."""
+    service_dir = os.path.abspath(os.path.join(ROOT_DIR, service))
+    config_dir = os.path.join(work_dir, service.lower())
+    os.makedirs(config_dir, exist_ok=True)
+    with open(os.path.join(config_dir, 'app_conf.yml'), 'w') as f:
+        yaml.safe_dump(app_config, f)
+    with open(os.path.join(config_dir, 'log_conf.yml'), 'w') as f:
+        yaml.safe_dump(LOG_CONFIG, f)
+
+    # Every service has an app.py, and some share helper module names, so drop the previous service's modules
+    for filename in os.listdir(service_dir):
+        if filename.endswith('.py'):
+            sys.modules.pop(filename[:-3], None)
+
+    cwd = os.getcwd()
+    sys.path.insert(0, service_dir)
+    os.chdir(config_dir)
+    try:
+        spec = importlib.util.spec_from_file_location('app', os.path.join(service_dir, 'app.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules['app'] = module
+        spec.loader.exec_module(module)
+        # Connexion resolves operationIds on the first request, against whichever module is named app by
+        # then, so each service makes one while it still is
+        module.app.test_client().get('/health/live')
+    finally:
+        os.chdir(cwd)
+        sys.path.remove(service_dir)
+    return module
+
+
+class ServiceServer(uvicorn.Server):
+    def install_signal_handlers(self):
+        # Servers run on background threads, and signals can only be handled on the main one
+        pass
+
+
+def serve(module, port):
+    server = ServiceServer(uvicorn.Config(module.app, host='127.0.0.1', port=port, log_level='warning'))
+    Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def wait_until_ready(port, timeout_sec=30):
+    """Waits for a service to connect to the fake Kafka and the DB, which it does in the background."""
+    deadline = time.monotonic() + timeout_sec
+    while requests.get(f"http://127.0.0.1:{port}/health/ready", timeout=5).status_code != 200:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Service on port {port} was not ready after {timeout_sec} s")
+        time.sleep(0.1)
+
+
+class StoredEvents:
+    """Records the ingest-to-stored latency of every event Storage commits."""
+
+    def __init__(self):
+        self.latencies = []
+        self.count = 0
+        self.last_stored = None
+        self.lock = Lock()
+
+    def wrap(self, store_batch):
+        def store_and_record(session, rows, traces=()):
+            store_batch(session, rows, traces)
+            stored_at = datetime.now(timezone.utc).replace(tzinfo=None)
+            latencies = [(stored_at - row['timestamp']).total_seconds()
+                         for type_rows in rows.values() for row in type_rows]
+            with self.lock:
+                self.latencies.extend(latencies)
+                self.count += len(latencies)
+                self.last_stored = time.time()
+        return store_and_record
+
+
+def start_services(args, work_dir):
+    configs = service_configs(args, work_dir)
+    os.makedirs(os.path.join(work_dir, 'processing'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'analyzer'), exist_ok=True)
+    stored_events = StoredEvents()
+    services = {}
+
+    storage = load_service('Storage', configs['Storage'], work_dir)
+    storage.init_connections()
+    # process_messages hands store_batch to its workers, so it is wrapped before the consumer starts
+    storage.store_batch = stored_events.wrap(storage.store_batch)
+    Thread(target=storage.process_messages, daemon=True).start()
+    # Processing closes its windows at Storage's ingest watermark, which only moves on as it is synced
+    Thread(target=storage.run_watermark_sync, daemon=True).start()
+    services['Storage'] = storage
+
+    receiver = load_service('Receiver', configs['Receiver'], work_dir)
+    receiver.init_connections()
+    if configs['Receiver']['events']['producer']['mode'] != 'sync':
+        Thread(target=receiver.run_async_producer, daemon=True).start()
+    services['Receiver'] = receiver
+
+    processing = load_service('Processing', configs['Processing'], work_dir)
+    processing.init_scheduler()
+    services['Processing'] = processing
+
+    analyzer = load_service('Analyzer', configs['Analyzer'], work_dir)
+    analyzer.init_connections()
+    Thread(target=analyzer.tail_events, daemon=True).start()
+    services['Analyzer'] = analyzer
+
+    ports = {}
+    for offset, service in enumerate(('Storage', 'Receiver', 'Processing', 'Analyzer')):
+        ports[service] = args.base_port + offset
+        serve(services[service], ports[service])
+        wait_until_ready(ports[service])
+    return ports, fake_kafka.topics[configs['Receiver']['events']['topic'].encode()], stored_events
+
+
+def sample_event(event_type):
+    timestamp = datetime.now(timezone.utc).isoformat()
+    if event_type == 'sensor_data':
+        return {
+            "sensorId": f"sensor-{random.randint(0, 999)}",
+            "temperature": round(random.uniform(-10, 40), 1),
+            "timestamp": timestamp,
+            "location": random.choice(LOCATIONS)
+        }
+    return {
+        "userId": f"user-{random.randint(0, 99)}",
+        "targetDevice": "Thermostat",
+        "targetTemperature": round(random.uniform(15, 25), 1),
+        "timestamp": timestamp
+    }
+
+
+class LoadResults:
+    def __init__(self):
+        self.sent = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.errors = 0
+        self.latencies = []
+        self.lock = Lock()
+
+    def record(self, status, latency):
+        with self.lock:
+            self.sent += 1
+            self.latencies.append(latency)
+            if status == 201:
+                self.accepted += 1
+            elif status == 503:
+                self.rejected += 1
+            else:
+                self.errors += 1
+
+
+def send_events(receiver_url, rate, duration_sec, user_command_ratio, results):
+    """Sends events at a fixed rate, sending late ones straight away rather than skipping them."""
+    session = requests.Session()
+    interval = 1 / rate
+    started = time.perf_counter()
+    next_send = started
+    while next_send < started + duration_sec:
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        event_type = 'user_command' if random.random() < user_command_ratio else 'sensor_data'
+        path = '/user-command' if event_type == 'user_command' else '/sensor-data'
+        sent_at = time.perf_counter()
+        try:
+            status = session.post(f"{receiver_url}{path}", json=sample_event(event_type), timeout=10).status_code
+        except requests.RequestException:
+            status = None
+        results.record(status, time.perf_counter() - sent_at)
+        next_send += interval
+
+
+def measure_analyzer(analyzer_url, num_requests, page_size):
+    """Times single event lookups and page reads at random indexes of what the Analyzer has indexed so far."""
+    session = requests.Session()
+    num_indexed = session.get(f"{analyzer_url}/stats", timeout=10).json()['num_sensor_data']
+    event_latencies = []
+    page_latencies = []
+    if num_indexed == 0:
+        return num_indexed, event_latencies, page_latencies
+    for _ in range(num_requests):
+        started = time.perf_counter()
+        session.get(f"{analyzer_url}/sensor_data", params={"index": random.randrange(num_indexed)}, timeout=30)
+        event_latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        session.get(f"{analyzer_url}/events", timeout=30,
+                    params={"type": "sensor_data", "from_index": random.randrange(num_indexed), "limit": page_size})
+        page_latencies.append(time.perf_counter() - started)
+    return num_indexed, event_latencies, page_latencies
+
+
+def sample_while_running(args, ports, topic, stopped, staleness, analyzer_samples):
+    processing_url = f"http://127.0.0.1:{ports['Processing']}"
+    analyzer_url = f"http://127.0.0.1:{ports['Analyzer']}"
+    session = requests.Session()
+    while not stopped.wait(args.sample_interval_sec):
+        try:
+            last_updated = session.get(f"{processing_url}/stats", timeout=10).json()['last_updated']
+            staleness.append((datetime.now() - datetime.fromisoformat(last_updated)).total_seconds())
+
+            topic_size = topic.size()
+            num_indexed, event_latencies, page_latencies = measure_analyzer(analyzer_url, args.analyzer_requests,
+                                                                            args.page_size)
+            analyzer_samples.append({
+                "topic_size": topic_size,
+                "indexed_sensor_data": num_indexed,
+                "event_latency_sec": summarize(event_latencies),
+                "page_latency_sec": summarize(page_latencies)
+            })
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"Sampling failed: {str(e)}", file=sys.stderr)
+
+
+def run(args, work_dir):
+    fake_kafka.install(args.partitions)
+    ports, topic, stored_events = start_services(args, work_dir)
+
+    stopped = Event()
+    staleness = []
+    analyzer_samples = []
+    sampler = Thread(target=sample_while_running,
+                     args=(args, ports, topic, stopped, staleness, analyzer_samples), daemon=True)
+    sampler.start()
+
+    load = LoadResults()
+    receiver_url = f"http://127.0.0.1:{ports['Receiver']}"
+    senders = [Thread(target=send_events,
+                      args=(receiver_url, args.rate / args.senders, args.duration, args.user_command_ratio, load))
+               for _ in range(args.senders)]
+    load_started = time.time()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    load_finished = time.time()
+
+    # Let Storage catch up on what was accepted before measuring the sustained rate
+    drain_deadline = time.time() + args.drain_timeout
+    while stored_events.count < load.accepted and time.time() < drain_deadline:
+        time.sleep(0.1)
+    stopped.set()
+    sampler.join()
+
+    with stored_events.lock:
+        stored = stored_events.count
+        stored_latencies = list(stored_events.latencies)
+        last_stored = stored_events.last_stored or load_finished
+
+    return {
+        "offered_events_per_sec": args.rate,
+        "sent": load.sent,
+        "accepted": load.accepted,
+        "rejected": load.rejected,
+        "errors": load.errors,
+        "stored": stored,
+        "accepted_events_per_sec": load.accepted / (load_finished - load_started),
+        "sustained_events_per_sec": stored / max(last_stored - load_started, 1e-6),
+        "receiver_response_sec": summarize(load.latencies),
+        "ingest_to_stored_sec": summarize(stored_latencies),
+        "processing_staleness_sec": summarize(staleness),
+        "analyzer": analyzer_samples
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rate', type=float, default=200, help="Events per second to send, over all senders")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to send events for")
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--user-command-ratio', type=float, default=0.2)
+    parser.add_argument('--partitions', type=int, default=3)
+    parser.add_argument('--producer-mode', choices=['async', 'sync'], default='async')
+    parser.add_argument('--processing-period-sec', type=float, default=5)
+    parser.add_argument('--sample-interval-sec', type=float, default=5)
+    parser.add_argument('--analyzer-requests', type=int, default=20, help="Analyzer requests of each kind per sample")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--drain-timeout', type=float, default=60)
+    parser.add_argument('--base-port', type=int, default=18090)
+    parser.add_argument('--output', default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    started = datetime.now().isoformat()
+    work_dir = tempfile.mkdtemp(prefix='pipeline_bench_')
+    try:
+        results = run(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "started": started,
+        "python": platform.python_version(),
+        "config": vars(args),
+        "results": results
+    }
+
+    summary = results["results"]
+    print(f"sent {summary['sent']}, accepted {summary['accepted']}, rejected {summary['rejected']}, "
+          f"errors {summary['errors']}, stored {summary['stored']}")
+    print(f"accepted {summary['accepted_events_per_sec']:.1f} events/s, "
+          f"sustained {summary['sustained_events_per_sec']:.1f} events/s")
+    for name in ("receiver_response_sec", "ingest_to_stored_sec", "processing_staleness_sec"):
+        print(f"{name}: p50 {summary[name]['p50']}, p99 {summary[name]['p99']}, max {summary[name]['max']}")
+    for sample in summary["analyzer"]:
+        print(f"analyzer at {sample['topic_size']} messages: event p50 {sample['event_latency_sec']['p50']}, "
+              f"page p50 {sample['page_latency_sec']['p50']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if summary['errors'] or not summary['stored']:
+        print("Events were lost or rejected with errors, so the rates above don't measure the pipeline",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,11 @@ const EVENTS_URL = {
     "sensor-data": "http://ryankafkajenkins.westus2.cloudapp.azure.com:8110/sensor_data",
     "user-command": "http://ryankafkajenkins.westus2.cloudapp.azure.com:8110/user_command"
 }
+const STATS_STREAM_URL = "http://ryankafkajenkins.westus2.cloudapp.azure.com:8100/stats/stream"
+const EVENTS_STREAM_URL = "http://ryankafkajenkins.westus2.cloudapp.azure.com:8110/events/stream"
+
+// The stats as last pushed; the stream sends them in full on connect, then only what changed
+let currentStats = {}
 
 // This function fetches and updates the general statistics
 const getStats = (statsUrl) => {
@@ -85,7 +90,36 @@ const updateStatsHTML = (data, error = false) => {
     })
 }
 
+// This function subscribes to the stats and recent events streams, which push updates as they happen
+const subscribe = () => {
+    const statsSource = new EventSource(STATS_STREAM_URL)
+    statsSource.addEventListener("stats", (e) => {
+        const delta = JSON.parse(e.data)
+        console.log("Received stats update", delta)
+        currentStats = {...currentStats, ...delta}
+        updateStatsHTML(currentStats)
+    })
+    // EventSource reconnects by itself; the stats are resent in full once it does
+    statsSource.onerror = () => console.log("Stats stream disconnected, reconnecting")
+
+    const eventsSource = new EventSource(EVENTS_STREAM_URL)
+    for (const eventType of ["sensor-data", "user-command"]) {
+        eventsSource.addEventListener(eventType.replace("-", "_"), (e) => {
+            const result = JSON.parse(e.data)
+            console.log("Received event", result)
+            updateEventHTML(result, eventType)
+        })
+    }
+    eventsSource.onerror = () => console.log("Events stream disconnected, reconnecting")
+}
+
 const setup = () => {
+    if (window.EventSource) {
+        subscribe()
+        return
+    }
+
+    // Fall back to polling in browsers without Server-Sent Events
     const interval = setInterval(() => {
         getStats(STATS_API_URL)
         getEvent("sensor-data")
@@ -1,12 +1,23 @@
 import os
+import atexit
+import hashlib
+import time
 import logging
 import logging.config
 import connexion
+from connexion import NoContent, request
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import yaml
+from sketches import DDSketch, HyperLogLog, SpaceSaving, WindowedRate
+import metrics
+import health
+from live_updates import Broadcaster, LiveUpdates
 from connexion.middleware import MiddlewarePosition
 from starlette.middleware.cors import CORSMiddleware
 
@@ -31,88 +42,289 @@ logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
 stats_file = app_config['datastore']['filename']
+sketch_file = app_config['datastore']['sketch_filename']
 
-# Ensure the stats file exists with an empty stats table
-def initialize_stats_file():
-    if not os.path.exists(stats_file):
+# The stats live in memory; stats_file only holds periodic snapshots of them
+stats_lock = Lock()
+current_stats = None
+current_etag = None
+stats_dirty = False
+current_sketches = None
+# Pushes stats changes to the Dashboards subscribed to the stats stream
+stats_updates = Broadcaster(app_config['live']['keepalive_sec'])
+
+
+def new_sketches():
+    """Creates the streaming sketches, each with a fixed memory budget however many sensors report."""
+    sketch_config = app_config['sketches']
+    return {
+        "temperature": DDSketch(sketch_config['relative_accuracy'], sketch_config['max_bins']),
+        "distinct_sensors": HyperLogLog(sketch_config['hll_precision']),
+        "top_sensors": SpaceSaving(sketch_config['top_k']),
+        "top_locations": SpaceSaving(sketch_config['top_k']),
+        "sensor_data_rate": WindowedRate(sketch_config['rate_bucket_sec'], sketch_config['rate_buckets']),
+        "user_command_rate": WindowedRate(sketch_config['rate_bucket_sec'], sketch_config['rate_buckets'])
+    }
+
+
+SKETCH_TYPES = {
+    "temperature": DDSketch,
+    "distinct_sensors": HyperLogLog,
+    "top_sensors": SpaceSaving,
+    "top_locations": SpaceSaving,
+    "sensor_data_rate": WindowedRate,
+    "user_command_rate": WindowedRate
+}
+
+
+def load_sketches():
+    global current_sketches
+    current_sketches = new_sketches()
+    if os.path.exists(sketch_file):
+        logger.info(f"Loading sketches from {sketch_file}.")
+        try:
+            with open(sketch_file, 'r') as file:
+                saved = json.load(file)
+            current_sketches.update({name: SKETCH_TYPES[name].from_dict(data) for name, data in saved.items()})
+        except (ValueError, KeyError) as e:
+            logger.error(f"Error loading sketches, starting from empty ones: {e}")
+
+
+def update_sketches(sensor_data_stats, user_command_stats, window_end):
+    with stats_lock:
+        for temperature, count in sensor_data_stats.get('temperature_histogram', []):
+            current_sketches['temperature'].add(temperature, count)
+        for sensor in sensor_data_stats.get('sensors', []):
+            current_sketches['distinct_sensors'].add(sensor['sensor_id'])
+            current_sketches['top_sensors'].add(sensor['sensor_id'], sensor['count'], sensor['sum'])
+            current_sketches['top_locations'].add(sensor['location'], sensor['count'], sensor['sum'])
+        current_sketches['sensor_data_rate'].add(sensor_data_stats['count'], window_end.timestamp())
+        current_sketches['user_command_rate'].add(user_command_stats['count'], window_end.timestamp())
+
+
+def compute_etag(stats):
+    return '"%s"' % hashlib.md5(json.dumps(stats, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def stats_delta(old_stats, new_stats):
+    """Returns the stats that changed, or None if only last_updated moved on."""
+    delta = {key: value for key, value in new_stats.items() if old_stats is None or old_stats.get(key) != value}
+    if not set(delta) - {'last_updated'}:
+        return None
+    return delta
+
+
+def set_stats(stats):
+    global current_stats, current_etag, stats_dirty
+    etag = compute_etag(stats)
+    with stats_lock:
+        delta = stats_delta(current_stats, stats)
+        current_stats = stats
+        current_etag = etag
+        stats_dirty = True
+
+    # Connected clients only get what changed; clients that connect later start from the full stats
+    if delta is not None:
+        stats_updates.publish('stats', delta, latest=stats)
+    else:
+        stats_updates.set_latest('stats', stats)
+
+
+def load_stats():
+    """Loads the last snapshot, or starts from an empty stats table if there isn't one."""
+    if os.path.exists(stats_file):
+        logger.info(f"Loading stats from {stats_file}.")
+        with open(stats_file, 'r') as file:
+            set_stats(json.load(file))
+    else:
         logger.info(f"{stats_file} does not exist. Initializing with default values.")
-        initial_stats = {
+        set_stats({
             "num_sensor_data_events": 0,
             "max_temperature": 0,
             "num_user_commands": 0,
             "max_target_temperature": 0,
             "last_updated": datetime.now().isoformat()
-        }
-        with open(stats_file, 'w') as file:
-            json.dump(initial_stats, file)
-    else:
-        logger.info(f"{stats_file} already exists.")
+        })
+        snapshot_stats()
+
+
+def write_atomically(filename, data):
+    """Writes JSON to a temp file and renames it over filename, so readers never see a partial file."""
+    tmp_file = f"{filename}.tmp"
+    with open(tmp_file, 'w') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_file, filename)
+
+
+def snapshot_stats():
+    global stats_dirty
+    with stats_lock:
+        if not stats_dirty:
+            return
+        stats = dict(current_stats)
+        sketches = {name: sketch.to_dict() for name, sketch in current_sketches.items()}
+        stats_dirty = False
+
+    try:
+        write_atomically(sketch_file, sketches)
+        write_atomically(stats_file, stats)
+        logger.debug(f"Saved stats snapshot to {stats_file}")
+    except OSError as e:
+        logger.error(f"Error saving stats snapshot: {e}")
+        with stats_lock:
+            stats_dirty = True
+
+load_sketches()
+load_stats()
+atexit.register(snapshot_stats)
+
+# Keep-alive connections to Storage, shared by the concurrent per-type fetches
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+fetch_executor = ThreadPoolExecutor(max_workers=2)
+populate_lock = Lock()
+
+POPULATE_DURATION = metrics.Histogram('processing_populate_seconds', 'Duration of a populate_stats run')
+POPULATE_SKIPPED = metrics.Counter('processing_populate_skipped_total',
+                                   'populate_stats runs skipped because the previous run was still going')
+ROWS_FETCHED = metrics.Counter('processing_rows_fetched_total',
+                               'Aggregate rows (histogram bins and per-sensor rows) fetched from Storage')
+EVENTS_COUNTED = metrics.Counter('processing_events_counted_total', 'Events covered by the fetched window stats')
+FETCH_ERRORS = metrics.Counter('processing_fetch_errors_total', 'Failed window stats fetches')
+STREAM_CLIENTS = metrics.Gauge('processing_stream_clients', 'Clients connected to the stats stream',
+                               callback=lambda: stats_updates.clients)
 
-initialize_stats_file()
 
 def format_timestamp(dt):
     return dt.strftime('%Y-%m-%dT%H:%M:%S')
 
-def populate_stats():
-    logger.info("Starting periodic processing")
 
+def fetch_window_stats(event_type, start, end):
+    """Fetches an event type's window stats, following the pages of the sensor data per-sensor aggregates."""
+    params = {"start_timestamp": start, "end_timestamp": end, "event_type": event_type,
+              "detail": "true" if event_type == 'sensor_data' else "false"}
+    stats = None
+    while True:
+        response = http_session.get(f"{app_config['eventstore']['url']}/stats/window", params=params,
+                                    timeout=app_config['eventstore']['timeout_sec'])
+        logger.debug(f"{event_type} window stats response status code: {response.status_code}")
+        if response.status_code != 200:
+            raise Exception(f"Error fetching {event_type} window stats, status code: {response.status_code}")
+        page = response.json()[event_type]
+        if stats is None:
+            stats = page
+        else:
+            stats['sensors'].extend(page['sensors'])
+        if 'next_sensor_cursor' not in page:
+            return stats
+        params['sensor_cursor'] = page['next_sensor_cursor']
+
+
+def fetch_ingest_watermark():
+    """Returns the date_created before which Storage has committed every event.
+
+    Storage stamps events when it decodes them, and a batch can take a while to commit after that,
+    so a window is only complete once it ends before the watermark.
+    """
+    response = http_session.get(f"{app_config['eventstore']['url']}/cache/stats",
+                                timeout=app_config['eventstore']['timeout_sec'])
+    if response.status_code != 200:
+        raise Exception(f"Error fetching the ingest watermark, status code: {response.status_code}")
+    return datetime.fromisoformat(response.json()['watermark'])
+
+
+def report_picked_up(start, end):
+    """Tells Storage when the traced events of a window were picked up, for its per-stage latencies."""
     try:
-        with open(stats_file, 'r') as file:
-            stats = json.load(file)
-    except FileNotFoundError:
-        logger.error("Statistics file not found during periodic processing.")
-        return
+        response = http_session.post(f"{app_config['eventstore']['url']}/traces/picked-up",
+                                     json={"start_timestamp": start, "end_timestamp": end, "picked_up": time.time()},
+                                     timeout=app_config['eventstore']['timeout_sec'])
+        if response.status_code != 200:
+            logger.warning(f"Error reporting picked up traces, status code: {response.status_code}")
+    except requests.RequestException as e:
+        logger.warning(f"Error reporting picked up traces: {e}")
 
-    last_updated = datetime.fromisoformat(stats["last_updated"])
-    formatted_last_updated = last_updated.strftime("%Y-%m-%dT%H:%M:%S")
-    current_time = format_timestamp(datetime.now())
-    logger.debug(f"Fetching new data between {formatted_last_updated} and {current_time}")
 
-    # Query sensor data events
-    sensor_data_url = f"{app_config['eventstore']['url']}/sensor-data"
+def split_window(start, end, max_window_sec):
+    """Splits [start, end) into consecutive sub-windows no longer than max_window_sec."""
+    windows = []
+    while start < end:
+        window_end = min(start + timedelta(seconds=max_window_sec), end)
+        windows.append((start, window_end))
+        start = window_end
+    return windows
+
+def populate_stats():
+    # APScheduler could otherwise start a tick while a long catch-up is still running
+    if not populate_lock.acquire(blocking=False):
+        POPULATE_SKIPPED.inc()
+        logger.warning("Periodic processing is still running, skipping this run")
+        return
+    start = time.perf_counter()
     try:
-        sensor_data = requests.get(sensor_data_url, params={"start_timestamp": formatted_last_updated, "end_timestamp": current_time})
-        logger.debug(f"Sensor data response status code: {sensor_data.status_code}")
+        process_new_events()
+    finally:
+        POPULATE_DURATION.observe(time.perf_counter() - start)
+        populate_lock.release()
 
-        if sensor_data.status_code != 200:
-            logger.error(f"Error fetching sensor data, status code: {sensor_data.status_code}")
-            return
 
-        sensor_data_events = sensor_data.json()
-        logger.info(f"Received {len(sensor_data_events)} sensor data events")
+def process_new_events():
+    logger.info("Starting periodic processing")
 
-        # Process sensor data events
-        for event in sensor_data_events:
-            stats['num_sensor_data_events'] += 1
-            stats['max_temperature'] = max(stats['max_temperature'], event.get('temperature', 0))
+    with stats_lock:
+        stats = dict(current_stats)
 
+    try:
+        watermark = fetch_ingest_watermark()
     except Exception as e:
-        logger.error(f"Error processing sensor data: {e}")
+        FETCH_ERRORS.inc()
+        logger.error(f"Error processing new events: {e}")
+        return
 
-    # Query user command events
-    try:
-        user_commands = requests.get(f"{app_config['eventstore']['url']}/user-command?start_timestamp={formatted_last_updated}&end_timestamp={current_time}")
-        logger.debug(f"User command response status code: {user_commands.status_code}")
+    last_updated = datetime.fromisoformat(stats["last_updated"]).replace(microsecond=0)
+    # Windows close at the watermark rather than now, or rows still being committed would never be counted
+    current_time = min(datetime.now(), watermark).replace(microsecond=0)
+    windows = split_window(last_updated, current_time, app_config['scheduler']['max_window_sec'])
+    logger.debug(f"Fetching new data between {format_timestamp(last_updated)} and {format_timestamp(current_time)} in {len(windows)} windows")
 
-        if user_commands.status_code != 200:
-            logger.error(f"Error fetching user commands, status code: {user_commands.status_code}")
+    for window_start, window_end in windows:
+        start = format_timestamp(window_start)
+        end = format_timestamp(window_end)
+
+        # Query the event aggregates of both types concurrently
+        futures = {event_type: fetch_executor.submit(fetch_window_stats, event_type, start, end)
+                   for event_type in ('sensor_data', 'user_command')}
+        try:
+            sensor_data_stats = futures['sensor_data'].result()
+            user_command_stats = futures['user_command'].result()
+        except Exception as e:
+            FETCH_ERRORS.inc()
+            logger.error(f"Error processing window stats from {start} to {end}: {e}")
             return
 
-        user_command_events = user_commands.json()
-        logger.info(f"Received {len(user_command_events)} user command events")
+        ROWS_FETCHED.inc(len(sensor_data_stats.get('temperature_histogram', [])) +
+                         len(sensor_data_stats.get('sensors', [])))
+        EVENTS_COUNTED.inc(sensor_data_stats['count'] + user_command_stats['count'])
 
-        # Process user command events
-        for event in user_command_events:
-            stats['num_user_commands'] += 1
-            stats['max_target_temperature'] = max(stats['max_target_temperature'], event.get('target_temperature', 0))
+        logger.info(f"Received {sensor_data_stats['count']} sensor data events and {user_command_stats['count']} user command events between {start} and {end}")
 
-    except Exception as e:
-        logger.error(f"Error processing user commands: {e}")
+        stats['num_sensor_data_events'] += sensor_data_stats['count']
+        if sensor_data_stats['max'] is not None:
+            stats['max_temperature'] = max(stats['max_temperature'], sensor_data_stats['max'])
 
-    stats['last_updated'] = current_time
+        stats['num_user_commands'] += user_command_stats['count']
+        if user_command_stats['max'] is not None:
+            stats['max_target_temperature'] = max(stats['max_target_temperature'], user_command_stats['max'])
 
-    with open(stats_file, 'w') as file:
-        json.dump(stats, file)
+        update_sketches(sensor_data_stats, user_command_stats, window_end)
+        if app_config['tracing']['report_pickup']:
+            report_picked_up(start, end)
+
+        # Checkpoint after every window, so a failure later in a catch-up resumes from here
+        stats['last_updated'] = end
+        set_stats(dict(stats))
 
     logger.debug(f"Updated statistics: {stats}")
     logger.info("Periodic processing completed")
@@ -120,18 +332,56 @@ def populate_stats():
 
 def get_stats():
     logger.info("Request received for event stats")
-    try:
-        # Load the current stats from the file
-        with open(stats_file, 'r') as file:
-            stats = json.load(file)
-        return stats, 200
-    except FileNotFoundError:
-        logger.error("Statistics file not found")
-        return {"message": "Statistics do not exist"}, 404
+    with stats_lock:
+        stats = current_stats
+        etag = current_etag
+
+    if request.headers.get('If-None-Match') == etag:
+        return NoContent, 304, {'ETag': etag}
+    return stats, 200, {'ETag': etag}
+
+def get_detailed_stats():
+    logger.info("Request received for detailed event stats")
+    top_n = app_config['sketches']['top_n']
+    with stats_lock:
+        temperature = current_sketches['temperature']
+        detailed_stats = {
+            "temperature_p50": temperature.quantile(0.5),
+            "temperature_p95": temperature.quantile(0.95),
+            "temperature_p99": temperature.quantile(0.99),
+            "distinct_sensors": current_sketches['distinct_sensors'].count(),
+            "top_sensors": current_sketches['top_sensors'].top(top_n),
+            "top_locations": current_sketches['top_locations'].top(top_n),
+            "event_rates": {
+                event_type: {
+                    "last_minute": current_sketches[f"{event_type}_rate"].rate(60),
+                    "last_5_minutes": current_sketches[f"{event_type}_rate"].rate(5 * 60),
+                    "last_hour": current_sketches[f"{event_type}_rate"].rate(60 * 60)
+                }
+                for event_type in ('sensor_data', 'user_command')
+            }
+        }
+    return detailed_stats, 200
+
+
+def get_metrics():
+    return metrics.get_metrics()
+
+
+def get_live():
+    return health.get_live()
+
+
+def get_ready():
+    # Processing only talks to Storage over HTTP, and serves its last stats while Storage is down
+    return health.get_ready()
+
 
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
-    sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['period_sec'])
+    sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['period_sec'],
+                  max_instances=1, coalesce=True)
+    sched.add_job(snapshot_stats, 'interval', seconds=app_config['datastore']['snapshot_period_sec'])
     sched.start()
 
 app = connexion.FlaskApp(__name__, specification_dir='')
@@ -143,6 +393,12 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    LiveUpdates,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    path="/stats/stream",
+    broadcaster=stats_updates,
+)
 app.add_api("openapi.yml", strict_validation=True, validate_responses=True)
 
 if __name__ == "__main__":
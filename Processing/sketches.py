@@ -0,0 +1,206 @@
+import math
+import time
+import base64
+import hashlib
+
+
+class DDSketch:
+    """Quantile sketch with bounded relative error, holding at most max_bins bins per sign."""
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def key(self, value):
+        return math.ceil(math.log(value) / self.log_gamma)
+
+    def value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value, weight=1):
+        if value > 0:
+            store = self.positive
+            key = self.key(value)
+        elif value < 0:
+            store = self.negative
+            key = self.key(-value)
+        else:
+            self.zero_count += weight
+            self.count += weight
+            return
+        store[key] = store.get(key, 0) + weight
+        self.count += weight
+        if len(store) > self.max_bins:
+            self.collapse(store)
+
+    def collapse(self, store):
+        """Folds the bins closest to zero together until the store fits in max_bins."""
+        keys = sorted(store)
+        excess = len(keys) - self.max_bins + 1
+        folded = sum(store.pop(key) for key in keys[:excess])
+        store[keys[excess]] = store.get(keys[excess], 0) + folded
+
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self.value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self.value(key)
+        return self.value(max(self.positive))
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_bins": self.max_bins,
+            "positive": self.positive,
+            "negative": self.negative,
+            "zero_count": self.zero_count
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['relative_accuracy'], data['max_bins'])
+        sketch.positive = {int(key): count for key, count in data['positive'].items()}
+        sketch.negative = {int(key): count for key, count in data['negative'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = sketch.zero_count + sum(sketch.positive.values()) + sum(sketch.negative.values())
+        return sketch
+
+
+class HyperLogLog:
+    """Distinct count estimate in 2^precision bytes of registers."""
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+
+    def add(self, item):
+        hashed = int.from_bytes(hashlib.sha1(item.encode('utf-8')).digest()[:8], 'big')
+        register = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def count(self):
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while many registers are still empty
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {
+            "precision": self.precision,
+            "registers": base64.b64encode(bytes(self.registers)).decode('ascii')
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['precision'])
+        sketch.registers = bytearray(base64.b64decode(data['registers']))
+        return sketch
+
+
+class SpaceSaving:
+    """Top-k heavy hitters by count, tracking at most capacity keys.
+
+    When a new key evicts the smallest one it inherits that key's count as its error,
+    so count - error is a lower bound on how often the key was really seen.
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.items = {}
+
+    def add(self, key, count, total):
+        item = self.items.get(key)
+        if item is not None:
+            item[0] += count
+            item[2] += total
+            return
+        if len(self.items) < self.capacity:
+            self.items[key] = [count, 0, total]
+            return
+        evicted = min(self.items, key=lambda k: self.items[k][0])
+        min_count = self.items.pop(evicted)[0]
+        self.items[key] = [min_count + count, min_count, total]
+
+    def top(self, n):
+        ranked = sorted(self.items.items(), key=lambda kv: kv[1][0], reverse=True)[:n]
+        return [{
+            "key": key,
+            "count": count,
+            "error": error,
+            "avg_temperature": total / (count - error) if count > error else None
+        } for key, (count, error, total) in ranked]
+
+    def to_dict(self):
+        return {"capacity": self.capacity, "items": self.items}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['capacity'])
+        sketch.items = data['items']
+        return sketch
+
+
+class WindowedRate:
+    """Ring buffer of per-bucket event counts, for event rates over sliding windows."""
+
+    def __init__(self, bucket_sec=60, num_buckets=60):
+        self.bucket_sec = bucket_sec
+        self.num_buckets = num_buckets
+        self.counts = [0] * num_buckets
+        self.bucket_ids = [-1] * num_buckets
+
+    def add(self, count, timestamp):
+        bucket_id = int(timestamp // self.bucket_sec)
+        slot = bucket_id % self.num_buckets
+        if self.bucket_ids[slot] != bucket_id:
+            self.bucket_ids[slot] = bucket_id
+            self.counts[slot] = 0
+        self.counts[slot] += count
+
+    def rate(self, window_sec):
+        """Returns the events per second over the last window_sec seconds."""
+        current = int(time.time() // self.bucket_sec)
+        oldest = current - min(window_sec // self.bucket_sec, self.num_buckets) + 1
+        total = sum(count for count, bucket_id in zip(self.counts, self.bucket_ids)
+                    if oldest <= bucket_id <= current)
+        return total / window_sec
+
+    def to_dict(self):
+        return {
+            "bucket_sec": self.bucket_sec,
+            "num_buckets": self.num_buckets,
+            "counts": self.counts,
+            "bucket_ids": self.bucket_ids
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['bucket_sec'], data['num_buckets'])
+        sketch.counts = data['counts']
+        sketch.bucket_ids = data['bucket_ids']
+        return sketch
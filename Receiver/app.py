@@ -3,14 +3,32 @@ import yaml
 import logging
 import logging.config
 import connexion
-from connexion import NoContent
+from connexion import NoContent, request
+from connexion.datastructures import MediaTypeDict
+from connexion.middleware import MiddlewarePosition
+from connexion.validators import VALIDATOR_MAP, AbstractRequestBodyValidator, JSONResponseBodyValidator
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from flask import Response, stream_with_context
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from datetime import datetime, timedelta, timezone
 import uuid
 import time
+import random
+from queue import Queue, Empty, Full
+from threading import Thread
 from pykafka import KafkaClient
-from pykafka.exceptions import KafkaException
+from pykafka.common import CompressionType
+from pykafka.exceptions import ProducerQueueFullError
+from pykafka.partitioners import hashing_partitioner
 import json
+from jsonschema import Draft4Validator
+from jsonschema.exceptions import best_match
+from response_cache import ResponseCache
+import event_envelope
+import metrics
+import health
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -33,131 +51,424 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-# Constants for retry logic
-MAX_RETRIES = 5
-RETRY_INTERVAL = 10  # seconds
-
-
-def initialize_kafka_client():
-    """Initialize Kafka client with retry logic."""
-    retries = 0
-    while retries < MAX_RETRIES:
+def create_producer(kafka_topic):
+    producer_config = app_config['events']['producer']
+    if producer_config['mode'] == 'sync':
+        return kafka_topic.get_sync_producer()
+    # Keyed on trace_id, so delivery reports can be matched to the event and load spreads over partitions
+    return kafka_topic.get_producer(delivery_reports=True,
+                                    linger_ms=producer_config['linger_ms'],
+                                    min_queued_messages=producer_config['batch_size'],
+                                    max_queued_messages=producer_config['max_queued_messages'],
+                                    compression=getattr(CompressionType, producer_config['compression'].upper()),
+                                    partitioner=hashing_partitioner)
+
+
+def connect_kafka():
+    kafka_client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
+    kafka_topic = kafka_client.topics[app_config['events']['topic'].encode()]
+    return create_producer(kafka_topic)
+
+
+PRODUCE_LATENCY = metrics.Histogram('receiver_kafka_produce_seconds',
+                                    'Time from producing an event to Kafka acknowledging it')
+PRODUCE_ERRORS = metrics.Counter('receiver_kafka_produce_errors_total', 'Events that failed to produce or deliver')
+REJECTED_EVENTS = metrics.Counter('receiver_rejected_events_total', 'Events rejected because the outbox was full')
+
+# Connects in the background once started, so the service serves (and queues events) while Kafka is down
+kafka_producer = health.Dependency('kafka', connect_kafka,
+                                   app_config['connections']['initial_backoff_sec'],
+                                   app_config['connections']['max_backoff_sec'],
+                                   close=lambda producer: producer.stop())
+
+# Events accepted but not yet handed to the async producer; a full outbox means Kafka can't keep up
+outbox = Queue(maxsize=app_config['events']['producer']['max_in_flight'])
+OUTBOX_DEPTH = metrics.Gauge('receiver_outbox_depth', 'Events waiting to be handed to the producer', callback=outbox.qsize)
+
+
+def run_async_producer():
+    """Hands queued events to the async producer and logs failed deliveries.
+
+    pykafka only returns delivery reports to the thread that produced the message,
+    so producing and collecting reports both happen on this thread. Events wait in
+    the outbox while Kafka is unavailable.
+    """
+    # Produce times of the events awaiting a delivery report, keyed by partition key
+    produced_at = {}
+    producer = None
+    while True:
+        if producer is None:
+            producer = kafka_producer.wait()
+            # Reports for a previous producer's events will never arrive
+            produced_at.clear()
         try:
-            logger.info(f"Attempting to connect to Kafka (attempt {retries + 1}/{MAX_RETRIES})...")
-            kafka_client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-            kafka_topic = kafka_client.topics[app_config['events']['topic'].encode()]
-            kafka_producer = kafka_topic.get_sync_producer()
-            logger.info("Kafka client connected successfully.")
-            return kafka_producer
-        except KafkaException as e:
-            logger.warning(f"Failed to connect to Kafka: {str(e)}")
-            retries += 1
-            if retries < MAX_RETRIES:
-                logger.info(f"Retrying in {RETRY_INTERVAL} seconds...")
-                time.sleep(RETRY_INTERVAL)
-            else:
-                logger.error("Max retries reached. Kafka connection failed.")
-                return None
-
-
-# Initialize Kafka producer on service startup
-kafka_producer = initialize_kafka_client()
-
-
-def receive_sensor_data(body):
+            trace_id, msg_bytes = outbox.get(timeout=app_config['events']['producer']['report_poll_sec'])
+            partition_key = trace_id.encode('utf-8')
+            if event_envelope.is_traced(msg_bytes):
+                msg_bytes = event_envelope.stamp_produced(msg_bytes, time.time())
+            produced_at[partition_key] = time.perf_counter()
+            producer.produce(msg_bytes, partition_key=partition_key)
+        except Empty:
+            pass
+        except Exception as produce_error:
+            produced_at.pop(partition_key, None)
+            PRODUCE_ERRORS.inc()
+            logger.error(f"Failed to produce event with trace id {trace_id}: {str(produce_error)}")
+            # A full queue only means Kafka is slow; anything else means this producer is broken
+            if not isinstance(produce_error, ProducerQueueFullError):
+                kafka_producer.reset(producer, produce_error)
+                producer = None
+                continue
+
+        while True:
+            try:
+                msg, exc = producer.get_delivery_report(block=False)
+            except Empty:
+                break
+            start = produced_at.pop(msg.partition_key, None)
+            if start is not None:
+                PRODUCE_LATENCY.observe(time.perf_counter() - start)
+            if exc is not None:
+                PRODUCE_ERRORS.inc()
+                logger.error(f"Failed to deliver event with trace id {msg.partition_key.decode('utf-8')}: {str(exc)}")
+
+
+# Batch items are checked against the same schemas connexion applies to the single event endpoints
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openapi.yml'), 'r') as f:
+    event_schemas = yaml.safe_load(f.read())['components']['schemas']
+
+EVENT_VALIDATORS = {
+    "sensor_data": Draft4Validator(event_schemas['sensordata_body']),
+    "user_command": Draft4Validator(event_schemas['usercommand_body'])
+}
+
+
+def find_invalid_field(event_name, body):
+    """Returns why an event would be dropped by Storage, or None if it is valid.
+
+    The schemas' date-time format isn't checked without an optional jsonschema dependency, so the
+    timestamp is parsed the way Storage parses it.
+    """
+    error = best_match(EVENT_VALIDATORS[event_name].iter_errors(body))
+    if error is not None:
+        field = ".".join(str(part) for part in error.path)
+        return f"Invalid {field}: {error.message}" if field else error.message
     try:
-        required_fields = ['temperature', 'timestamp', 'sensorId', 'location']
-        for field in required_fields:
-            if field not in body:
-                logger.error(f"Missing key: {field}")
-                return {"error": f"Missing key: {field}"}, 400
+        datetime.fromisoformat(body['timestamp'].strip().replace('Z', '+00:00'))
+    except ValueError:
+        return f"Invalid timestamp: {body['timestamp']!r} is not an ISO 8601 date-time"
+    return None
+
 
-        trace_id = str(uuid.uuid4())
-        event_name = "sensor_data"
-        logger.info(f"Received event {event_name} request with a trace id of {trace_id}")
+def build_message(event_name, body):
+    """Stamps a trace id on the event and returns it with the encoded Kafka message."""
+    trace_id = str(uuid.uuid4())
+    logger.info(f"Received event {event_name} request with a trace id of {trace_id}")
 
-        body['trace_id'] = trace_id
+    body['trace_id'] = trace_id
 
-        if kafka_producer is None:
-            logger.error("Kafka producer is not initialized.")
-            return {"error": "Kafka unavailable"}, 500
+    # A sample of events carry their stage times through the pipeline, for Storage's /traces endpoints
+    received = time.time() if random.random() < app_config['tracing']['sample_rate'] else None
+    msg_bytes = event_envelope.encode(event_name, datetime.now(), body,
+                                      binary=app_config['events']['format'] == 'binary', received=received)
+    return trace_id, msg_bytes
 
-        msg = {
-            "type": "sensor_data",
-            "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "payload": body
-        }
-        msg_str = json.dumps(msg)
 
+def send_message(event_name, trace_id, msg_bytes):
+    """Produces (sync mode) or queues (async mode) a message, returning an error response if that failed."""
+    retry_after = {"Retry-After": str(app_config['events']['producer']['retry_after_sec'])}
+    if app_config['events']['producer']['mode'] == 'sync':
         try:
-            kafka_producer.produce(msg_str.encode('utf-8'))
-            logger.info(f"Produced sensor data event with trace id: {trace_id}")
+            producer = kafka_producer.get()
+        except health.Unavailable as e:
+            logger.error(str(e))
+            return {"error": "Kafka unavailable"}, 503, retry_after
+        try:
+            if event_envelope.is_traced(msg_bytes):
+                msg_bytes = event_envelope.stamp_produced(msg_bytes, time.time())
+            start = time.perf_counter()
+            producer.produce(msg_bytes)
+            PRODUCE_LATENCY.observe(time.perf_counter() - start)
+            logger.info(f"Produced {event_name} event with trace id: {trace_id}")
         except Exception as produce_error:
+            PRODUCE_ERRORS.inc()
             logger.error(f"Failed to produce message to Kafka: {str(produce_error)}")
+            kafka_producer.reset(producer, produce_error)
             return {"error": "Failed to produce event"}, 500
+        return None
+
+    try:
+        outbox.put_nowait((trace_id, msg_bytes))
+        logger.info(f"Queued {event_name} event with trace id: {trace_id}")
+    except Full:
+        REJECTED_EVENTS.inc()
+        logger.warning(f"Producer queue is full, rejecting {event_name} event with trace id: {trace_id}")
+        return {"error": "Too many events in flight"}, 503, retry_after
+    return None
+
 
-        return NoContent, 201
+def receive_event(event_name, body):
+    try:
+        invalid_field = find_invalid_field(event_name, body)
+        if invalid_field is not None:
+            logger.error(f"Invalid {event_name} event: {invalid_field}")
+            return {"error": invalid_field}, 400
+
+        trace_id, msg_bytes = build_message(event_name, body)
+        return send_message(event_name, trace_id, msg_bytes) or (NoContent, 201)
 
     except Exception as e:
-        logger.error(f"Unexpected error in receive_sensor_data: {str(e)}")
+        logger.error(f"Unexpected error in receive_{event_name}: {str(e)}")
         return {"error": "Internal server error"}, 500
 
 
+def receive_sensor_data(body):
+    return receive_event("sensor_data", body)
+
+
 def receive_user_command(body):
+    return receive_event("user_command", body)
+
+
+def parse_batch(body):
+    """Returns the items of a batch sent as a JSON array or as NDJSON, one event per line."""
+    if isinstance(body, list):
+        return body
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def receive_batch(event_name, body):
+    batch_config = app_config['events']['batch']
     try:
-        required_fields = ['timestamp', 'userId', 'targetDevice', 'targetTemperature']
-        for field in required_fields:
-            if field not in body:
-                logger.error(f"Missing key: {field}")
-                return {"error": f"Missing key: {field}"}, 400
+        items = parse_batch(body)
+    except ValueError as e:
+        return {"error": f"Invalid NDJSON: {str(e)}"}, 400
+    if len(items) > batch_config['max_items']:
+        return {"error": f"Batch has more than {batch_config['max_items']} items"}, 413
+
+    # Validate every item before producing any of them
+    results = []
+    messages = []
+    for index, item in enumerate(items):
+        invalid_field = find_invalid_field(event_name, item)
+        if invalid_field is not None:
+            results.append({"index": index, "status": 400, "error": invalid_field})
+            continue
+        trace_id, msg_bytes = build_message(event_name, item)
+        results.append({"index": index, "status": 201, "trace_id": trace_id})
+        messages.append((results[-1], trace_id, msg_bytes))
+
+    # In async mode the accepted items are queued back to back, so the producer sends them in one batch
+    for result, trace_id, msg_bytes in messages:
+        error = send_message(event_name, trace_id, msg_bytes)
+        if error is not None:
+            result["status"] = error[1]
+            result["error"] = error[0]["error"]
+
+    accepted = sum(1 for result in results if result["status"] == 201)
+    logger.info(f"Received batch of {len(items)} {event_name} events, accepted {accepted}")
+    return {"accepted": accepted, "rejected": len(items) - accepted, "results": results}, 200
+
+
+def receive_sensor_data_batch(body):
+    return receive_batch("sensor_data", body)
+
+
+def receive_user_command_batch(body):
+    return receive_batch("user_command", body)
 
-        trace_id = str(uuid.uuid4())
-        event_name = "user_command"
-        logger.info(f"Received event {event_name} request with a trace id of {trace_id}")
 
-        body['trace_id'] = trace_id
+# Keep-alive connections to Storage for the proxied GET endpoints
+proxy_session = requests.Session()
+proxy_session.mount('http://', HTTPAdapter(pool_connections=2, pool_maxsize=app_config['proxy']['pool_size']))
+proxy_cache = ResponseCache(app_config['proxy']['cache_max_bytes'], app_config['proxy']['cache_max_entry_bytes'])
 
-        if kafka_producer is None:
-            logger.error("Kafka producer is not initialized.")
-            return {"error": "Kafka unavailable"}, 500
+PROXIED_HEADERS = ['Content-Type', 'X-Next-Cursor']
+PROXIED_PATHS = {'/sensor-data', '/user-command'}
+# The proxied endpoints produce JSON or NDJSON, so connexion needs to be told which one an error is
+PROXY_ERROR_HEADERS = {'Content-Type': 'application/json'}
 
-        msg = {
-            "type": "user_command",
-            "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "payload": body
-        }
-        msg_str = json.dumps(msg)
 
+def is_immutable_window(end_timestamp):
+    """A window that ended long enough ago has all of its events stored, so its results can't change."""
+    try:
+        # Compared in UTC, with a timestamp without an offset taken to be in local time like Storage's
+        end = datetime.fromisoformat(end_timestamp.strip().replace('Z', '+00:00')).astimezone(timezone.utc)
+    except ValueError:
+        return False
+    return end < datetime.now(timezone.utc) - timedelta(seconds=app_config['proxy']['immutable_after_sec'])
+
+
+def proxy_get(url):
+    """Forwards a GET to Storage, streaming the body through, and caching windows that can no longer change.
+
+    A cacheable body is kept as it streams past, and cached once complete unless it outgrew the
+    largest cache entry, so a large export is never held in memory.
+    """
+    params = sorted(request.query_params.items())
+    cacheable = is_immutable_window(request.query_params.get('end_timestamp', ''))
+    cache_key = (url, tuple(params))
+
+    if cacheable:
+        cached = proxy_cache.get(cache_key)
+        if cached is not None:
+            status, headers, body = cached
+            return Response(body, status=status, headers=headers)
+
+    try:
+        upstream = proxy_session.get(url, params=params, stream=True, timeout=app_config['proxy']['timeout_sec'])
+    except (requests.ConnectionError, requests.Timeout) as e:
+        logger.error(f"Storage unavailable for {url}: {str(e)}")
+        return {"error": "Storage unavailable"}, 503, dict(PROXY_ERROR_HEADERS,
+                                                           **{"Retry-After": str(app_config['proxy']['retry_after_sec'])})
+    except requests.RequestException as e:
+        logger.error(f"Error proxying {url}: {str(e)}")
+        return {"error": "Bad response from Storage"}, 502, PROXY_ERROR_HEADERS
+    headers = {name: upstream.headers[name] for name in PROXIED_HEADERS if name in upstream.headers}
+
+    def stream_body():
+        chunks = [] if cacheable and upstream.status_code == 200 else None
+        size = 0
         try:
-            kafka_producer.produce(msg_str.encode('utf-8'))
-            logger.info(f"Produced user command event with trace id: {trace_id}")
-        except Exception as produce_error:
-            logger.error(f"Failed to produce message to Kafka: {str(produce_error)}")
-            return {"error": "Failed to produce event"}, 500
+            for chunk in upstream.iter_content(chunk_size=64 * 1024):
+                if chunks is not None:
+                    size += len(chunk)
+                    if size <= proxy_cache.max_entry_bytes:
+                        chunks.append(chunk)
+                    else:
+                        chunks = None
+                yield chunk
+        finally:
+            upstream.close()
+        if chunks is not None:
+            proxy_cache.put(cache_key, upstream.status_code, headers, b"".join(chunks))
 
-        return NoContent, 201
+    return Response(stream_with_context(stream_body()), status=upstream.status_code, headers=headers)
 
-    except Exception as e:
-        logger.error(f"Unexpected error in receive_user_command: {str(e)}")
-        return {"error": "Internal server error"}, 500
+
+def get_sensor_data_readings(start_timestamp, end_timestamp, limit=None, cursor=None, format='json'):
+    return proxy_get(app_config['eventstore1']['url'])
+
+
+def get_user_command_events(start_timestamp, end_timestamp, limit=None, cursor=None, format='json'):
+    return proxy_get(app_config['eventstore2']['url'])
+
+
+def get_proxy_cache_stats():
+    return proxy_cache.stats(), 200
+
+
+def get_metrics():
+    return metrics.get_metrics()
+
+
+def get_live():
+    return health.get_live()
+
+
+def get_ready():
+    return health.get_ready()
+
+
+def init_connections():
+    kafka_producer.start()
+
+
+class UnvalidatedNDJSON(AbstractRequestBodyValidator):
+    """Passes NDJSON batches through, as connexion would parse them as a single JSON document.
+
+    receive_batch checks each line against its event schema instead.
+    """
+
+    async def wrap_receive(self, receive, *, scope):
+        return receive, scope
+
+
+BATCH_PATHS = {'/sensor-data/batch', '/user-command/batch'}
+
+
+class BatchSizeLimit:
+    """Answers 413 to a batch body larger than max_bytes before connexion reads and parses it.
+
+    A body with a Content-Length is rejected up front. A chunked one is read up to max_bytes, and
+    only handed on, from memory and with its length set, once it has ended within the limit.
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] not in BATCH_PATHS:
+            return await self.app(scope, receive, send)
+
+        content_length = Headers(scope=scope).get('content-length')
+        if content_length is not None:
+            if int(content_length) > self.max_bytes:
+                return await self.reject(scope, receive, send)
+            return await self.app(scope, receive, send)
+
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] != 'http.request':
+                return
+            size += len(message.get('body', b''))
+            if size > self.max_bytes:
+                return await self.reject(scope, receive, send)
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        body = b"".join(chunks)
+        received = False
+        # Flask only reads a body with a length, so the buffered one is handed on with its length set
+        headers = [(name, value) for name, value in scope['headers'] if name != b'transfer-encoding']
+        scope = dict(scope, headers=headers + [(b'content-length', str(len(body)).encode('ascii'))])
+
+        async def replay():
+            nonlocal received
+            if received:
+                return await receive()
+            received = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        await self.app(scope, replay, send)
+
+    async def reject(self, scope, receive, send):
+        response = JSONResponse({"error": f"Batch is larger than {self.max_bytes} bytes"}, status_code=413)
+        await response(scope, receive, send)
 
 
-def get_sensor_data_readings():
-    data = requests.args
-    response = requests.get(app_config['eventstore1']['url'], params=data)
-    return NoContent, response.status_code
+class ProxiedResponseValidator(JSONResponseBodyValidator):
+    """Streams proxied responses through, which Storage has already validated, and validates the rest.
 
+    Connexion's validators hold the whole body in memory, which a large export would exhaust.
+    """
 
-def get_user_command_events():
-    data = requests.args
-    response = requests.get(app_config['eventstore2']['url'], params=data)
-    return NoContent, response.status_code
+    def wrap_send(self, send):
+        if self._scope['path'] in PROXIED_PATHS:
+            return send
+        return super().wrap_send(send)
 
 
 # Start the application
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", strict_validation=False, validate_responses=True)
+app.add_api("openapi.yml", strict_validation=False, validate_responses=True,
+            validator_map={'body': MediaTypeDict(VALIDATOR_MAP['body'],
+                                                 **{'application/x-ndjson': UnvalidatedNDJSON}),
+                           'response': MediaTypeDict(VALIDATOR_MAP['response'],
+                                                     **{'*/*json': ProxiedResponseValidator})})
+app.add_middleware(BatchSizeLimit, MiddlewarePosition.BEFORE_VALIDATION,
+                   max_bytes=app_config['events']['batch']['max_bytes'])
 
 if __name__ == "__main__":
     logger.info("Starting the app...")
+    init_connections()
+    if app_config['events']['producer']['mode'] != 'sync':
+        producer_thread = Thread(target=run_async_producer, daemon=True)
+        producer_thread.start()
     app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
@@ -0,0 +1,122 @@
+"""Encoding of events on the events topic.
+
+Version 1 binary messages start with a fixed header, followed by the msgpack encoded payload:
+
+    magic (0xE7) | version | type tag | flags | datetime (uint32 Unix seconds)
+
+so consumers can read the event type and time without decoding the payload. Sampled events have
+the TRACED flag set and a trace block between the header and the payload, holding the times
+(double Unix seconds) Receiver received and produced the event. Legacy messages are the JSON
+object {"type": ..., "datetime": ..., "payload": ...}, always start with '{' and are never traced.
+"""
+import json
+import time
+import struct
+from datetime import datetime
+
+import msgpack
+
+MAGIC = 0xE7
+VERSION = 1
+HEADER = struct.Struct('>BBBBI')
+TRACE = struct.Struct('>dd')
+
+TRACED = 0x01
+
+TYPE_TAGS = {
+    "sensor_data": 1,
+    "user_command": 2
+}
+TAG_TYPES = {tag: event_type for event_type, tag in TYPE_TAGS.items()}
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def is_binary(raw):
+    return len(raw) >= HEADER.size and raw[0] == MAGIC
+
+
+def is_traced(raw):
+    return is_binary(raw) and raw[3] & TRACED
+
+
+def payload_offset(raw):
+    return HEADER.size + TRACE.size if raw[3] & TRACED else HEADER.size
+
+
+def encode(event_type, event_datetime, payload, binary=True, received=None):
+    """Encodes an event, as a version 1 binary message or as legacy JSON.
+
+    Passing the time the event was received traces it, in the binary format only.
+    """
+    if not binary:
+        return json.dumps({
+            "type": event_type,
+            "datetime": event_datetime.strftime(DATETIME_FORMAT),
+            "payload": payload
+        }).encode('utf-8')
+    if received is None:
+        header = HEADER.pack(MAGIC, VERSION, TYPE_TAGS[event_type], 0, int(event_datetime.timestamp()))
+    else:
+        header = HEADER.pack(MAGIC, VERSION, TYPE_TAGS[event_type], TRACED, int(event_datetime.timestamp())) + \
+                 TRACE.pack(received, 0)
+    return header + msgpack.packb(payload, use_bin_type=True)
+
+
+def stamp_produced(raw, produced):
+    """Returns a copy of a traced message with the time it was handed to the producer filled in."""
+    stamped = bytearray(raw)
+    struct.pack_into('>d', stamped, HEADER.size + 8, produced)
+    return bytes(stamped)
+
+
+def read_trace(raw):
+    """Returns the received and produced times of a traced message, or None if it isn't traced."""
+    if not is_traced(raw):
+        return None
+    return TRACE.unpack_from(raw, HEADER.size)
+
+
+def read_type(raw):
+    """Returns the event type of a message, so consumers can skip other types without decoding them."""
+    if is_binary(raw):
+        return TAG_TYPES[raw[2]]
+    for event_type in TYPE_TAGS:
+        if raw.startswith(b'{"type": "%s"' % event_type.encode('utf-8')):
+            return event_type
+    return json.loads(raw.decode('utf-8'))['type']
+
+
+def read_header(raw):
+    """Returns the event type and time (Unix seconds) of a message, only decoding legacy JSON messages."""
+    if is_binary(raw):
+        _, version, tag, _, seconds = HEADER.unpack_from(raw)
+        if version != VERSION:
+            raise ValueError(f"Unsupported event envelope version {version}")
+        return TAG_TYPES[tag], seconds
+    msg = json.loads(raw.decode('utf-8'))
+    try:
+        return msg['type'], datetime.strptime(msg['datetime'], DATETIME_FORMAT).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return msg['type'], None
+
+
+def decode_payload(raw):
+    """Decodes just the payload of a message of either format."""
+    if is_binary(raw):
+        if raw[1] != VERSION:
+            raise ValueError(f"Unsupported event envelope version {raw[1]}")
+        return msgpack.unpackb(raw[payload_offset(raw):], raw=False)
+    return json.loads(raw.decode('utf-8'))['payload']
+
+
+def decode(raw):
+    """Decodes a message of either format into {"type": ..., "datetime": ..., "payload": ...}."""
+    if is_binary(raw):
+        event_type, seconds = read_header(raw)
+        return {
+            "type": event_type,
+            "datetime": time.strftime(DATETIME_FORMAT, time.localtime(seconds)),
+            "payload": msgpack.unpackb(raw[payload_offset(raw):], raw=False)
+        }
+    return json.loads(raw.decode('utf-8'))
@@ -0,0 +1,129 @@
+"""Background connections to Kafka and the DB, and the /health/live and /health/ready endpoints.
+
+A Dependency connects on its own thread, retrying with exponential backoff and jitter, so the
+service starts serving straight away. Code using the connection calls reset() when it fails, and
+the Dependency reconnects in the background. The service is ready once every Dependency is connected.
+"""
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger('basicLogger')
+
+dependencies = []
+
+
+class Unavailable(Exception):
+    pass
+
+
+def backoff_delays(initial_sec, max_sec):
+    """Yields exponentially growing delays with full jitter, so restarted services don't retry in step."""
+    ceiling = initial_sec
+    while True:
+        yield random.uniform(0, ceiling)
+        ceiling = min(ceiling * 2, max_sec)
+
+
+class Dependency:
+    """A connection made, and remade after failures, on a background thread.
+
+    check, if given, is called with the connection every check_interval_sec and should raise if it
+    is broken; close, if given, is called with a connection once it has been reset.
+    """
+
+    def __init__(self, name, connect, initial_backoff_sec=1, max_backoff_sec=30,
+                 check=None, check_interval_sec=10, close=None):
+        self.name = name
+        self.connect = connect
+        self.initial_backoff_sec = initial_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.check = check
+        self.check_interval_sec = check_interval_sec
+        self.close = close
+        self.connection = None
+        self.error = "Not connected yet"
+        self.condition = threading.Condition()
+        self.thread = None
+        dependencies.append(self)
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name=f"{self.name}-connection", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            connection = self.connect_with_backoff()
+            with self.condition:
+                self.connection = connection
+                self.error = None
+                self.condition.notify_all()
+            logger.info(f"Connected to {self.name}")
+            self.watch(connection)
+
+    def connect_with_backoff(self):
+        for delay in backoff_delays(self.initial_backoff_sec, self.max_backoff_sec):
+            try:
+                return self.connect()
+            except Exception as e:
+                with self.condition:
+                    self.error = str(e)
+                logger.warning(f"Failed to connect to {self.name}, retrying in {delay:.1f} s: {str(e)}")
+                time.sleep(delay)
+
+    def watch(self, connection):
+        """Returns once connection has been reset, checking it in the meantime if there is a check."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.connection is not connection,
+                                        timeout=self.check_interval_sec if self.check else None)
+                if self.connection is not connection:
+                    return
+            try:
+                self.check(connection)
+            except Exception as e:
+                self.reset(connection, e)
+
+    def get(self):
+        """Returns the connection, or raises Unavailable if it isn't connected."""
+        with self.condition:
+            if self.connection is None:
+                raise Unavailable(f"{self.name} is unavailable: {self.error}")
+            return self.connection
+
+    def wait(self):
+        """Returns the connection, waiting for it to connect."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.connection is not None)
+            return self.connection
+
+    def reset(self, connection, error):
+        """Reconnects after connection failed, unless it has already been replaced."""
+        with self.condition:
+            if self.connection is not connection:
+                return
+            self.connection = None
+            self.error = str(error)
+            self.condition.notify_all()
+        logger.error(f"Lost connection to {self.name}, reconnecting: {str(error)}")
+        if self.close is not None:
+            try:
+                self.close(connection)
+            except Exception as e:
+                logger.warning(f"Error closing {self.name} connection: {str(e)}")
+
+    def status(self):
+        with self.condition:
+            return "ready" if self.connection is not None else self.error
+
+
+def get_live():
+    return {"status": "live"}, 200
+
+
+def get_ready():
+    statuses = {dependency.name: dependency.status() for dependency in dependencies}
+    ready = all(status == "ready" for status in statuses.values())
+    return {"status": "ready" if ready else "not ready", "dependencies": statuses}, 200 if ready else 503
@@ -0,0 +1,134 @@
+"""Minimal Prometheus instrumentation, rendered in the text exposition format at /metrics.
+
+Counters and histograms are sharded per thread: a hot path only ever updates its own thread's
+shard, without taking a lock, and the shards are summed when the metrics are scraped.
+"""
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+registry = []
+registry_lock = threading.Lock()
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+
+class Metric:
+    metric_type = None
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels or {}
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+        with registry_lock:
+            registry.append(self)
+
+    def new_shard(self):
+        raise NotImplementedError
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.new_shard()
+            self.local.shard = shard
+            with self.shards_lock:
+                self.shards.append(shard)
+        return shard
+
+    def samples(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def new_shard(self):
+        return [0]
+
+    def inc(self, amount=1):
+        self.shard()[0] += amount
+
+    def value(self):
+        with self.shards_lock:
+            return sum(shard[0] for shard in self.shards)
+
+    def samples(self):
+        return [(self.name, self.labels, self.value())]
+
+
+class Gauge(Metric):
+    """A value that is set directly, or read from a callback when scraped."""
+    metric_type = 'gauge'
+
+    def __init__(self, name, help_text, labels=None, callback=None):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def samples(self):
+        return [(self.name, self.labels, self.callback() if self.callback else self.current)]
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, labels=None, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help_text, labels)
+
+    def new_shard(self):
+        # One count per bucket plus +Inf, then the sum and the total count
+        return [0] * (len(self.buckets) + 3)
+
+    def observe(self, value):
+        shard = self.shard()
+        shard[bisect_left(self.buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def samples(self):
+        with self.shards_lock:
+            totals = [sum(column) for column in zip(*self.shards)] or self.new_shard()
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            cumulative += count
+            samples.append((f"{self.name}_bucket", dict(self.labels, le="+Inf" if bound == float('inf') else repr(bound)),
+                            cumulative))
+        samples.append((f"{self.name}_sum", self.labels, totals[-2]))
+        samples.append((f"{self.name}_count", self.labels, totals[-1]))
+        return samples
+
+
+def render():
+    """Returns every registered metric in the Prometheus text exposition format."""
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    described = set()
+    for metric in metrics:
+        if metric.name not in described:
+            described.add(metric.name)
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def get_metrics():
+    # Connexion only accepts the content type exactly as the spec declares it, and Prometheus reads a
+    # bare text/plain as its text format 0.0.4
+    return render(), 200, {'Content-Type': 'text/plain'}
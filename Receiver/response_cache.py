@@ -0,0 +1,47 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache:
+    """LRU cache of upstream responses, bounded by the total size of the cached bodies."""
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, status, headers, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[2])
+            self.entries[key] = (status, headers, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self.entries.popitem(last=False)[1][2])
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0
+            }
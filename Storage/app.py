@@ -29,18 +29,40 @@ import logging.config
 import yaml
 import connexion
 from connexion import NoContent
-from sqlalchemy import create_engine, and_
+from connexion.datastructures import MediaTypeDict
+from connexion.validators import VALIDATOR_MAP, AbstractResponseBodyValidator
+from sqlalchemy import create_engine, and_, or_, insert, func, case, text, cast, tuple_, LargeBinary
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import DBAPIError, IntegrityError, DataError
 from sensor_data import SensorData
 from user_command import UserCommand
+from sensor_rollup import SensorRollup
+from trace_stage import TraceStage, STAGE_LATENCIES
+from trace_digest import TraceDigest
+from stored_trace_id import StoredTraceId
+from replica_watermark import ReplicaWatermark
 from base import Base
 import uuid
 import datetime
 import json
+import time
+import base64
+import hashlib
+from flask import Response, stream_with_context
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
-from threading import Thread
+from threading import Thread, RLock
 from create_tables_mysql import create_tables
+from partition_workers import PartitionWorkerPool
+from dedup import TraceIdCache
+from result_cache import ResultCache, IngestWatermark
+from cold_storage import ColdStore
+import event_envelope
+import metrics
+import health
+from migrations import EVENT_TABLES, get_partitions, add_day_partitions, drop_expired_partitions, delete_expired_rows
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -62,31 +84,92 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
-logger.info(f"Connecting to MySQL database at {app_config['datastore']['hostname']}:{app_config['datastore']['port']}")
-logger.info(f"Database configuration: {app_config['datastore']}")
-DB_ENGINE = create_engine(f"mysql+pymysql://{app_config['datastore']['user']}:{app_config['datastore']['password']}@{app_config['datastore']['hostname']}:{app_config['datastore']['port']}/{app_config['datastore']['db']}")
+
+def get_database_url():
+    """Returns datastore.url if set (e.g. a SQLite database for local runs), otherwise the MySQL database's URL."""
+    if app_config['datastore'].get('url'):
+        logger.info(f"Connecting to database at {app_config['datastore']['url']}")
+        return app_config['datastore']['url']
+    logger.info(f"Connecting to MySQL database at {app_config['datastore']['hostname']}:{app_config['datastore']['port']}")
+    logger.info(f"Database configuration: {app_config['datastore']}")
+    return f"mysql+pymysql://{app_config['datastore']['user']}:{app_config['datastore']['password']}@{app_config['datastore']['hostname']}:{app_config['datastore']['port']}/{app_config['datastore']['db']}"
+
+
+# Without CLIENT_FOUND_ROWS, which SQLAlchemy asks MySQL for, an ON DUPLICATE KEY UPDATE that leaves a row as
+# it was doesn't count as affected, so an insert's rowcount is the number of rows it added
+DB_CONNECT_ARGS = {} if app_config['datastore'].get('url') else {'client_flag': 0}
+DB_ENGINE = create_engine(get_database_url(), pool_size=app_config['events']['consumer']['workers'] + 5,
+                          connect_args=DB_CONNECT_ARGS)
 Base.metadata.bind = DB_ENGINE
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 #Base.metadata.create_all(DB_ENGINE)
 
+EVENT_MODELS = {'sensor_data': SensorData, 'user_command': UserCommand}
+trace_id_cache = TraceIdCache(app_config['dedup']['cache_size'])
+result_cache = ResultCache(app_config['cache']['max_bytes'], app_config['cache']['max_entry_bytes'])
+ingest_watermark = IngestWatermark()
+# Identifies this process's row in replica_watermark
+REPLICA_ID = str(uuid.uuid4())
+cold_store = None
+if app_config['cold_storage']['export_after_days']:
+    cold_store = ColdStore(app_config['cold_storage']['directory'], app_config['cold_storage']['compression'],
+                           app_config['cold_storage']['row_group_size'], app_config['paging']['fetch_size'])
+
+BATCH_COMMIT_TIME = metrics.Histogram('storage_batch_commit_seconds', 'Time to write and commit a batch of events')
+MESSAGE_COMMIT_TIME = metrics.Histogram('storage_message_commit_seconds',
+                                        'Batch commit time divided over the events in the batch')
+STORED_EVENTS = metrics.Counter('storage_stored_events_total', 'Events stored in the DB')
+REPLAYED_EVENTS = metrics.Counter('storage_replayed_events_total', 'Replayed events dropped at ingest')
+SKIPPED_EVENTS = metrics.Counter('storage_skipped_events_total',
+                                 'Events the DB kept rejecting, skipped so their partitions could move on')
+CONSUMER_LAG = metrics.Gauge('storage_consumer_lag_messages',
+                             'Messages on the topic that have not been committed by this consumer')
+RESULT_CACHE_HITS = metrics.Counter('storage_result_cache_hits_total', 'Queries served from the result cache')
+RESULT_CACHE_MISSES = metrics.Counter('storage_result_cache_misses_total', 'Cacheable queries run against the DB')
+RESULT_CACHE_BYTES = metrics.Gauge('storage_result_cache_bytes', 'Serialized size of the cached query results',
+                                   callback=lambda: result_cache.size)
+
+def parse_event_timestamp(timestamp):
+    """Parses an ISO 8601 event timestamp into a naive UTC datetime for the DATETIME(6) columns."""
+    parsed = datetime.datetime.fromisoformat(timestamp.strip().replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def sensor_data_row(body):
+    return {
+        'sensor_id': body['sensorId'],
+        'temperature': body['temperature'],
+        'timestamp': parse_event_timestamp(body['timestamp']),
+        'location': body['location'],
+        'trace_id': body.get('trace_id', str(uuid.uuid4())),
+        'date_created': datetime.datetime.now()
+    }
+
+
+def user_command_row(body):
+    return {
+        'user_id': body['userId'],
+        'target_device': body['targetDevice'],
+        'target_temperature': body['targetTemperature'],
+        'timestamp': parse_event_timestamp(body['timestamp']),
+        'trace_id': body.get('trace_id', str(uuid.uuid4())),
+        'date_created': datetime.datetime.now()
+    }
+
+
 def receive_sensor_data(body):
     print("here")
     session = DB_SESSION()
 
-    trace_id = body.get('trace_id', str(uuid.uuid4()))
-
-    sensor_data = SensorData(
-        sensor_id=body['sensorId'],
-        temperature=body['temperature'],
-        timestamp=body['timestamp'],
-        location=body['location'],
-        trace_id=trace_id,
-        date_created=datetime.datetime.now()
-    )
-
-    session.add(sensor_data)
-    session.commit()
-    session.close()
+    try:
+        with ingest_watermark.writing():
+            row = sensor_data_row(body)
+            trace_id = row['trace_id']
+            store_batch(session, {'sensor_data': [row]})
+    finally:
+        session.close()
 
     logger.debug(f"Stored event 'sensor_data' request with a trace id of {trace_id}")
 
@@ -97,106 +180,1102 @@ def receive_user_command(body):
     print("here")
     session = DB_SESSION()
 
-    trace_id = body.get('trace_id', str(uuid.uuid4()))
+    try:
+        with ingest_watermark.writing():
+            row = user_command_row(body)
+            trace_id = row['trace_id']
+            store_batch(session, {'user_command': [row]})
+    finally:
+        session.close()
+
+    logger.debug(f"Stored event 'user_command' request with a trace id of {trace_id}")
+
+    return NoContent, 201
+
+
+def parse_timestamp(timestamp):
+    timestamp = timestamp.strip()
+    try:
+        return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%f")
+    except ValueError:
+        return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
 
-    user_command = UserCommand(
-        user_id=body['userId'],
-        target_device=body['targetDevice'],
-        target_temperature=body['targetTemperature'],
-        timestamp=body['timestamp'],
-        trace_id=trace_id,
-        date_created=datetime.datetime.now()
+
+def encode_cursor(result):
+    """Encodes the (date_created, id) keyset position after a result dict as an opaque cursor."""
+    cursor = f"{result['date_created']}|{result['id']}".encode('utf-8')
+    return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+
+def decode_cursor(cursor):
+    date_created, row_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split('|')
+    return datetime.datetime.fromisoformat(date_created), int(row_id)
+
+
+def query_window(session, model, start_timestamp_datetime, end_timestamp_datetime, cursor=None, limit=None):
+    """Returns a query for the rows created in a window, in (date_created, id) order."""
+    query = session.query(model).filter(
+        and_(model.date_created >= start_timestamp_datetime,
+             model.date_created < end_timestamp_datetime)
     )
+    if cursor is not None:
+        after_date_created, after_id = decode_cursor(cursor)
+        query = query.filter(
+            or_(model.date_created > after_date_created,
+                and_(model.date_created == after_date_created, model.id > after_id))
+        )
+    query = query.order_by(model.date_created, model.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
 
-    session.add(user_command)
-    session.commit()
-    session.close()
 
-    logger.debug(f"Stored event 'user_command' request with a trace id of {trace_id}")
+def stream_ndjson(session, cold_results, hot_query, limit, description, start_timestamp):
+    """Yields the cold storage results as they are read, then rows straight off a server-side cursor, as NDJSON.
+
+    hot_query is called with the number of cold results for the query of the rows after them. Ends with
+    the next cursor if the page is full.
+    """
+    count = 0
+    last_result = None
+    try:
+        for result in cold_results:
+            yield json.dumps(result) + "\n"
+            count += 1
+            last_result = result
+        query = hot_query(count)
+        if query is not None:
+            for row in query.execution_options(stream_results=True).yield_per(app_config['paging']['fetch_size']):
+                last_result = row.to_dict()
+                yield json.dumps(last_result) + "\n"
+                count += 1
+        if limit is not None and count == limit:
+            yield json.dumps({"next_cursor": encode_cursor(last_result)}) + "\n"
+    finally:
+        session.close()
+        logger.info("Streamed query for %s after %s returns %d results" %
+                    (description, start_timestamp, count))
+
+
+def cached_prefix_end(start_timestamp_datetime, end_timestamp_datetime):
+    """Returns where the part of a window that can be cached ends, or None if none of it can.
+
+    Rows before the ingest watermark are all committed, so that part of a window can't change. The
+    watermark is rounded down, so queries up to the live edge share a prefix and only query the tail.
+    """
+    watermark = ingest_watermark.value()
+    if end_timestamp_datetime <= watermark:
+        return end_timestamp_datetime
+    granularity = app_config['cache']['prefix_granularity_sec']
+    prefix_end = watermark - datetime.timedelta(seconds=(watermark - datetime.datetime.min).total_seconds() % granularity)
+    return prefix_end if prefix_end > start_timestamp_datetime else None
+
+
+def cached_query(key, run_query):
+    """Returns the cached result for key, running and caching run_query() on a miss."""
+    result = result_cache.get(key)
+    if result is not None:
+        RESULT_CACHE_HITS.inc()
+        return result
+    RESULT_CACHE_MISSES.inc()
+    generation = result_cache.generation(key[0])
+    result = run_query()
+    result_cache.put(key, result, generation)
+    return result
 
-    return NoContent, 201
 
+def window_rows(session, model, start_timestamp_datetime, end_timestamp_datetime):
+    """Returns the rows created in a window as dicts, from the cache up to the ingest watermark and the DB after it."""
+    def rows_between(start, end):
+        return [row.to_dict() for row in query_window(session, model, start, end)]
 
-def get_sensor_data_readings(start_timestamp, end_timestamp):
+    prefix_end = cached_prefix_end(start_timestamp_datetime, end_timestamp_datetime)
+    if prefix_end is None:
+        return rows_between(start_timestamp_datetime, end_timestamp_datetime)
+    rows = cached_query((model.__tablename__, 'rows', start_timestamp_datetime, prefix_end),
+                        lambda: rows_between(start_timestamp_datetime, prefix_end))
+    if prefix_end < end_timestamp_datetime:
+        rows = rows + rows_between(prefix_end, end_timestamp_datetime)
+    return rows
+
+
+def cold_boundary(model):
+    """Returns when the rows still in the DB start, or None if none have been exported to cold storage."""
+    exported_until = cold_store.exported_until(model.__tablename__) if cold_store is not None else None
+    return datetime.datetime.combine(exported_until, datetime.time()) if exported_until else None
+
+
+# The readings endpoints produce JSON or NDJSON, so connexion needs to be told which one a response is
+JSON_CONTENT_TYPE = {'Content-Type': 'application/json'}
+
+
+def get_events(model, description, start_timestamp, end_timestamp, limit, cursor, format):
     try:
-        session = DB_SESSION()
+        start_timestamp_datetime = parse_timestamp(start_timestamp)
+        end_timestamp_datetime = parse_timestamp(end_timestamp)
+        after = decode_cursor(cursor) if cursor is not None else None
+    except ValueError as e:
+        return {"message": f"Invalid request: {str(e)}"}, 400, JSON_CONTENT_TYPE
 
-        start_timestamp = start_timestamp.strip()
-        end_timestamp = end_timestamp.strip()
+    # Rows created before the boundary are read from the cold storage files, the rest from the DB
+    cold_results = iter(())
+    hot_start = start_timestamp_datetime
+    boundary = cold_boundary(model)
+    if boundary is not None and boundary > start_timestamp_datetime:
+        cold_results = cold_store.read_window(model.__tablename__, start_timestamp_datetime,
+                                              min(end_timestamp_datetime, boundary), after, limit)
+        hot_start = boundary
 
-        try:
-            start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S.%f")
-        except ValueError:
-            start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
+    session = DB_SESSION()
 
-        try:
-            end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S.%f")
-        except ValueError:
-            end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
+    def hot_query(cold_count):
+        """Returns the query for the rows after the cold ones, or None if the page has no room for them."""
+        hot_limit = limit - cold_count if limit is not None else None
+        if hot_start >= end_timestamp_datetime or hot_limit == 0:
+            return None
+        return query_window(session, model, hot_start, end_timestamp_datetime, cursor, hot_limit)
+
+    if format == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(session, cold_results, hot_query, limit, description,
+                                                          start_timestamp)),
+                        mimetype='application/x-ndjson')
+
+    try:
+        cold_results = list(cold_results)
+        query = hot_query(len(cold_results))
+        if query is None:
+            results_list = cold_results
+        elif cursor is None and limit is None:
+            results_list = cold_results + window_rows(session, model, hot_start, end_timestamp_datetime)
+        else:
+            results_list = cold_results + [row.to_dict() for row in query.all()]
+    finally:
+        session.close()
+
+    logger.info("Query for %s after %s returns %d results (%d from cold storage)" %
+                (description, start_timestamp, len(results_list), len(cold_results)))
+
+    headers = dict(JSON_CONTENT_TYPE)
+    if limit is not None and len(results_list) == limit:
+        headers['X-Next-Cursor'] = encode_cursor(results_list[-1])
+    return results_list, 200, headers
+
+
+WINDOW_STATS_COLUMNS = {
+    'sensor_data': SensorData.temperature,
+    'user_command': UserCommand.target_temperature
+}
+
+
+def encode_sensor_cursor(sensor):
+    """Encodes the (sensor_id, location) keyset position after a window detail sensor as an opaque cursor."""
+    cursor = json.dumps([sensor['sensor_id'], sensor['location']]).encode('utf-8')
+    return base64.urlsafe_b64encode(cursor).decode('ascii')
+
+
+def decode_sensor_cursor(cursor):
+    sensor_id, location = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    return str(sensor_id), str(location)
+
+
+def sensor_key():
+    """Returns the (sensor_id, location) key window detail pages by, compared byte by byte.
 
-        readings = session.query(SensorData).filter(
-            and_(SensorData.date_created >= start_timestamp_datetime,
-                 SensorData.date_created < end_timestamp_datetime)
+    MySQL compares strings case-insensitively by default, while cold storage and the merge compare code points.
+    """
+    if DB_ENGINE.dialect.name == 'mysql':
+        return cast(SensorData.sensor_id, LargeBinary), cast(SensorData.location, LargeBinary)
+    return SensorData.sensor_id, SensorData.location
+
+
+def get_window_detail(session, start_timestamp_datetime, end_timestamp_datetime, sensor_page):
+    """Returns the sensor data temperature histogram at 0.1 degree resolution, and the counts and sums of a page of
+    sensors in (sensor_id, location) order.
+
+    sensor_page is the (sensor_id, location) the page starts after, or None, and the most sensors to return.
+    """
+    in_window = and_(SensorData.date_created >= start_timestamp_datetime,
+                     SensorData.date_created < end_timestamp_datetime)
+    rounded_temperature = func.round(SensorData.temperature, 1)
+    histogram = session.query(rounded_temperature, func.count(SensorData.id)).filter(in_window) \
+        .group_by(rounded_temperature)
+    after, limit = sensor_page
+    key = sensor_key()
+    sensors = session.query(SensorData.sensor_id, SensorData.location,
+                            func.count(SensorData.id), func.sum(SensorData.temperature)).filter(in_window)
+    if after is not None:
+        sensors = sensors.filter(tuple_(*key) > tuple_(*after))
+    sensors = sensors.group_by(SensorData.sensor_id, SensorData.location).order_by(*key).limit(limit)
+    return {
+        "temperature_histogram": [[temperature, count] for temperature, count in histogram],
+        "sensors": [{"sensor_id": sensor_id, "location": location, "count": count, "sum": total}
+                    for sensor_id, location, count, total in sensors]
+    }
+
+
+def query_window_stats(session, stats_type, start_timestamp_datetime, end_timestamp_datetime, sensor_page):
+    model = EVENT_MODELS[stats_type]
+    column = WINDOW_STATS_COLUMNS[stats_type]
+    count, max_value, min_value, sum_value = session.query(
+        func.count(model.id), func.max(column), func.min(column), func.sum(column)
+    ).filter(
+        and_(model.date_created >= start_timestamp_datetime,
+             model.date_created < end_timestamp_datetime)
+    ).one()
+    stats = {
+        "count": count,
+        "max": max_value,
+        "min": min_value,
+        "sum": sum_value or 0
+    }
+    if sensor_page is not None:
+        stats.update(get_window_detail(session, start_timestamp_datetime, end_timestamp_datetime, sensor_page))
+    return stats
+
+
+def merge_window_stats(first, second):
+    """Combines the stats of two consecutive windows."""
+    merged = {
+        "count": first["count"] + second["count"],
+        "max": max((value for value in (first["max"], second["max"]) if value is not None), default=None),
+        "min": min((value for value in (first["min"], second["min"]) if value is not None), default=None),
+        "sum": first["sum"] + second["sum"]
+    }
+    if "temperature_histogram" in first:
+        histogram = {}
+        for temperature, count in first["temperature_histogram"] + second["temperature_histogram"]:
+            histogram[temperature] = histogram.get(temperature, 0) + count
+        sensors = {}
+        for sensor in first["sensors"] + second["sensors"]:
+            key = (sensor["sensor_id"], sensor["location"])
+            if key in sensors:
+                sensors[key] = dict(sensors[key], count=sensors[key]["count"] + sensor["count"],
+                                    sum=sensors[key]["sum"] + sensor["sum"])
+            else:
+                sensors[key] = sensor
+        merged["temperature_histogram"] = [[temperature, count] for temperature, count in histogram.items()]
+        merged["sensors"] = list(sensors.values())
+    return merged
+
+
+def page_sensors(stats, limit):
+    """Cuts the merged per-sensor aggregates of a window to a page, with the cursor of the next one if it is full.
+
+    Each merged part holds its first limit sensors after the cursor, so the first limit of their union are exact.
+    """
+    sensors = sorted(stats["sensors"], key=lambda sensor: (sensor["sensor_id"], sensor["location"]))[:limit]
+    stats = dict(stats, sensors=sensors)
+    if len(sensors) == limit:
+        stats["next_sensor_cursor"] = encode_sensor_cursor(sensors[-1])
+    return stats
+
+
+def window_stats_for(session, stats_type, start_timestamp_datetime, end_timestamp_datetime, sensor_page):
+    """Returns a window's stats, from the cache up to the ingest watermark and the DB after it."""
+    prefix_end = cached_prefix_end(start_timestamp_datetime, end_timestamp_datetime)
+    if prefix_end is None:
+        return query_window_stats(session, stats_type, start_timestamp_datetime, end_timestamp_datetime, sensor_page)
+    stats = cached_query((EVENT_MODELS[stats_type].__tablename__, ('detail', sensor_page) if sensor_page else 'stats',
+                          start_timestamp_datetime, prefix_end),
+                         lambda: query_window_stats(session, stats_type, start_timestamp_datetime, prefix_end,
+                                                    sensor_page))
+    if prefix_end < end_timestamp_datetime:
+        stats = merge_window_stats(
+            stats, query_window_stats(session, stats_type, prefix_end, end_timestamp_datetime, sensor_page))
+    return stats
+
+
+def cold_and_hot_window_stats(session, stats_type, start_timestamp_datetime, end_timestamp_datetime, sensor_page):
+    """Returns a window's stats, merging the part exported to cold storage with the part still in the DB."""
+    boundary = cold_boundary(EVENT_MODELS[stats_type])
+    if boundary is None or boundary <= start_timestamp_datetime:
+        return window_stats_for(session, stats_type, start_timestamp_datetime, end_timestamp_datetime, sensor_page)
+    stats = cold_store.window_stats(stats_type, start_timestamp_datetime, min(end_timestamp_datetime, boundary),
+                                    WINDOW_STATS_COLUMNS[stats_type].name, sensor_page)
+    if boundary < end_timestamp_datetime:
+        stats = merge_window_stats(
+            stats, window_stats_for(session, stats_type, boundary, end_timestamp_datetime, sensor_page))
+    return stats
+
+
+def get_window_stats(start_timestamp, end_timestamp, event_type=None, detail=False, sensor_limit=None,
+                     sensor_cursor=None):
+    """Returns the count, max, min and sum of each event type's temperature over a window, computed in SQL.
+
+    The per-sensor detail is paged in (sensor_id, location) order, at most paging.max_window_sensors at a time.
+    """
+    session = DB_SESSION()
+    try:
+        start_timestamp_datetime = parse_timestamp(start_timestamp)
+        end_timestamp_datetime = parse_timestamp(end_timestamp)
+        after = decode_sensor_cursor(sensor_cursor) if sensor_cursor is not None else None
+    except (ValueError, TypeError) as e:
+        session.close()
+        return {"message": f"Invalid request: {str(e)}"}, 400
+
+    max_sensors = app_config['paging']['max_window_sensors']
+    sensor_limit = min(sensor_limit or max_sensors, max_sensors)
+    try:
+        window_stats = {}
+        for stats_type in WINDOW_STATS_COLUMNS:
+            if event_type is not None and stats_type != event_type:
+                continue
+            sensor_page = (after, sensor_limit) if detail and stats_type == 'sensor_data' else None
+            stats = cold_and_hot_window_stats(session, stats_type, start_timestamp_datetime, end_timestamp_datetime,
+                                              sensor_page)
+            window_stats[stats_type] = page_sensors(stats, sensor_limit) if sensor_page else stats
+    except Exception as e:
+        logger.error(f"Error computing window stats: {str(e)}")
+        return {"message": str(e)}, 500
+    finally:
+        session.close()
+
+    logger.info("Window stats from %s to %s: %s" %
+                (start_timestamp, end_timestamp,
+                 ", ".join(f"{stats['count']} {stats_type}" for stats_type, stats in window_stats.items())))
+
+    return window_stats, 200
+
+
+def get_sensor_data_rollups(bucket, start, end, sensorId=None):
+    session = DB_SESSION()
+    try:
+        start_datetime = parse_timestamp(start)
+        end_datetime = parse_timestamp(end)
+    except ValueError as e:
+        session.close()
+        return {"message": f"Invalid request: {str(e)}"}, 400
+
+    try:
+        query = session.query(SensorRollup).filter(
+            and_(SensorRollup.bucket == bucket,
+                 SensorRollup.bucket_start >= start_datetime,
+                 SensorRollup.bucket_start < end_datetime)
         )
+        if sensorId is not None:
+            query = query.filter(SensorRollup.sensor_id == sensorId)
+        results_list = [rollup.to_dict() for rollup in
+                        query.order_by(SensorRollup.bucket_start, SensorRollup.sensor_id, SensorRollup.location)]
+    except Exception as e:
+        logger.error(f"Error retrieving sensor data rollups: {str(e)}")
+        return {"message": str(e)}, 500
+    finally:
+        session.close()
+
+    logger.info("Query for %s sensor data rollups after %s returns %d results" %
+                (bucket, start, len(results_list)))
+
+    return results_list, 200
+
 
-        results_list = [reading.to_dict() for reading in readings]
+def get_trace(trace_id):
+    session = DB_SESSION()
+    try:
+        trace = session.get(TraceStage, trace_id)
+        if trace is None:
+            return {"message": f"No trace recorded for {trace_id}"}, 404
+        return trace.to_dict(), 200
+    except Exception as e:
+        logger.error(f"Error retrieving trace {trace_id}: {str(e)}")
+        return {"message": str(e)}, 500
+    finally:
         session.close()
 
-        logger.info("Query for sensor data readings after %s returns %d results" %
-                    (start_timestamp, len(results_list)))
 
-        return results_list, 200
+def percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": values[int(0.5 * (len(values) - 1))],
+        "p90": values[int(0.9 * (len(values) - 1))],
+        "p99": values[int(0.99 * (len(values) - 1))],
+        "max": values[-1]
+    }
+
+
+def get_trace_stats(start_timestamp, end_timestamp, event_type=None):
+    """Returns percentiles of the time spent in each stage by the events traced in a window."""
+    session = DB_SESSION()
+    try:
+        start_timestamp_datetime = parse_timestamp(start_timestamp)
+        end_timestamp_datetime = parse_timestamp(end_timestamp)
+    except ValueError as e:
+        session.close()
+        return {"message": f"Invalid request: {str(e)}"}, 400
+
+    try:
+        query = session.query(TraceStage).filter(
+            and_(TraceStage.date_created >= start_timestamp_datetime,
+                 TraceStage.date_created < end_timestamp_datetime)
+        )
+        if event_type is not None:
+            query = query.filter(TraceStage.event_type == event_type)
+        latencies = {}
+        for trace in query.order_by(TraceStage.date_created.desc()).limit(app_config['tracing']['max_stats_traces']):
+            for stage, latency in trace.stage_latencies().items():
+                if latency is not None:
+                    latencies.setdefault(stage, []).append(latency)
     except Exception as e:
-        logger.error(f"Error retrieving sensor data: {str(e)}")
+        logger.error(f"Error computing trace stats: {str(e)}")
         return {"message": str(e)}, 500
+    finally:
+        session.close()
 
+    return {stage: percentiles(latencies.get(stage, []))
+            for stage in STAGE_LATENCIES}, 200
 
 
-def get_user_command_events(start_timestamp, end_timestamp):
+def record_picked_up(body):
+    """Marks the traced events stored in a window as picked up by Processing at the given time."""
     session = DB_SESSION()
+    try:
+        start_timestamp_datetime = parse_timestamp(body['start_timestamp'])
+        end_timestamp_datetime = parse_timestamp(body['end_timestamp'])
+    except ValueError as e:
+        session.close()
+        return {"message": f"Invalid request: {str(e)}"}, 400
 
-    start_timestamp_datetime = datetime.datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S")
-    end_timestamp_datetime = datetime.datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S")
+    try:
+        updated = session.query(TraceStage).filter(
+            and_(TraceStage.date_created >= start_timestamp_datetime,
+                 TraceStage.date_created < end_timestamp_datetime,
+                 TraceStage.picked_up.is_(None))
+        ).update({TraceStage.picked_up: body['picked_up']}, synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error recording picked up traces: {str(e)}")
+        return {"message": str(e)}, 500
+    finally:
+        session.close()
 
-    commands = session.query(UserCommand).filter(
-        and_(UserCommand.date_created >= start_timestamp_datetime,
-             UserCommand.date_created < end_timestamp_datetime)
-    )
+    return {"updated": updated}, 200
+
+
+def get_trace_digests(start_timestamp, end_timestamp):
+    """Returns the count and trace id digest of each event type and hour in a window of event timestamps."""
+    session = DB_SESSION()
+    try:
+        start_timestamp_datetime = parse_timestamp(start_timestamp)
+        end_timestamp_datetime = parse_timestamp(end_timestamp)
+    except ValueError as e:
+        session.close()
+        return {"message": f"Invalid request: {str(e)}"}, 400
 
-    results_list = [command.to_dict() for command in commands]
-    session.close()
+    try:
+        digests = [digest.to_dict() for digest in session.query(TraceDigest).filter(
+            and_(TraceDigest.bucket_start >= start_timestamp_datetime,
+                 TraceDigest.bucket_start < end_timestamp_datetime)
+        ).order_by(TraceDigest.event_type, TraceDigest.bucket_start)]
+    except Exception as e:
+        logger.error(f"Error retrieving trace digests: {str(e)}")
+        return {"message": str(e)}, 500
+    finally:
+        session.close()
 
-    logger.info("Query for user command events after %s returns %d results" %
-                (start_timestamp, len(results_list)))
+    return digests, 200
+
+
+def get_bucket_trace_ids(event_type, bucket_start):
+    """Returns the trace ids of the stored events of a type whose timestamp falls in an hour bucket.
+
+    The digests cover events moved to cold storage too, so their files are read as well as the DB.
+    """
+    session = DB_SESSION()
+    try:
+        start_timestamp_datetime = parse_timestamp(bucket_start)
+    except ValueError as e:
+        session.close()
+        return {"message": f"Invalid request: {str(e)}"}, 400
+
+    model = EVENT_MODELS[event_type]
+    end_timestamp_datetime = start_timestamp_datetime + datetime.timedelta(hours=1)
+    try:
+        trace_ids = [trace_id for (trace_id,) in session.query(model.trace_id).filter(
+            and_(model.timestamp >= start_timestamp_datetime,
+                 model.timestamp < end_timestamp_datetime)
+        )]
+        if cold_store is not None:
+            # A day being exported is in both until it is pruned from the DB
+            trace_ids = list(dict.fromkeys(
+                trace_ids + cold_store.trace_ids(event_type, start_timestamp_datetime, end_timestamp_datetime)))
+    except Exception as e:
+        logger.error(f"Error retrieving trace ids: {str(e)}")
+        return {"message": str(e)}, 500
+    finally:
+        session.close()
+
+    return trace_ids, 200
+
+
+def get_sensor_data_readings(start_timestamp, end_timestamp, limit=None, cursor=None, format='json'):
+    try:
+        return get_events(SensorData, 'sensor data readings', start_timestamp, end_timestamp, limit, cursor, format)
+    except Exception as e:
+        logger.error(f"Error retrieving sensor data: {str(e)}")
+        return {"message": str(e)}, 500, JSON_CONTENT_TYPE
+
+
+def get_user_command_events(start_timestamp, end_timestamp, limit=None, cursor=None, format='json'):
+    try:
+        return get_events(UserCommand, 'user command events', start_timestamp, end_timestamp, limit, cursor, format)
+    except Exception as e:
+        logger.error(f"Error retrieving user commands: {str(e)}")
+        return {"message": str(e)}, 500, JSON_CONTENT_TYPE
+
+def insert_ignoring_duplicates(session, table, rows, key):
+    """Inserts rows into a table, skipping those whose unique key is already stored, and returns how many it added.
+
+    Only duplicates are skipped: unlike INSERT IGNORE, which also clips values MySQL would reject, bad data
+    still raises, so the batch is split up to skip the rows it is in.
+    """
+    if DB_ENGINE.dialect.name == 'mysql':
+        stmt = mysql_insert(table).on_duplicate_key_update({key: table.c[key]})
+    else:
+        stmt = sqlite_insert(table).on_conflict_do_nothing(index_elements=[key])
+    # A Core insert on the session's connection, as ORM bulk inserts don't report a rowcount
+    return session.connection().execute(stmt, rows).rowcount
+
+
+def stored_now(session, model, rows):
+    """Returns the rows stored with the date_created stamped on them by this batch, rather than by an earlier one."""
+    stored = {(trace_id, date_created) for trace_id, date_created in
+              session.query(model.trace_id, model.date_created)
+                     .filter(model.trace_id.in_([row['trace_id'] for row in rows]))}
+    return [row for row in rows if (row['trace_id'], row['date_created']) in stored]
+
+
+def insert_new_rows(session, model, rows):
+    """Inserts rows with distinct trace ids, skipping any already stored, and returns the rows inserted.
+
+    A unique trace_id index drops replays as they are inserted, so there is no query for them first.
+    Day-partitioned tables can't have one, so their trace ids are claimed in stored_trace_id before the
+    rows are inserted. Only when some were skipped are they looked up again, in the same transaction.
+    """
+    if not app_config['retention']['partition_by_day']:
+        if insert_ignoring_duplicates(session, model.__table__, rows, 'trace_id') == len(rows):
+            return rows
+        return stored_now(session, model, rows)
+
+    claims = [{'trace_id': row['trace_id'], 'event_type': model.__tablename__, 'date_created': row['date_created']}
+              for row in rows]
+    if insert_ignoring_duplicates(session, StoredTraceId.__table__, claims, 'trace_id') < len(rows):
+        rows = stored_now(session, StoredTraceId, rows)
+    if rows:
+        session.connection().execute(insert(model.__table__), rows)
+    return rows
+
+
+ROLLUP_BUCKETS = {
+    'minute': lambda timestamp: timestamp.replace(second=0, microsecond=0),
+    'hour': lambda timestamp: timestamp.replace(minute=0, second=0, microsecond=0)
+}
+
+
+def aggregate_rollups(sensor_data_rows):
+    """Folds sensor data rows into per-minute and per-hour rollup rows, one per sensor, location and bucket."""
+    rollups = {}
+    for row in sensor_data_rows:
+        for bucket, bucket_start in ROLLUP_BUCKETS.items():
+            key = (bucket, bucket_start(row['timestamp']), row['sensor_id'], row['location'])
+            rollup = rollups.get(key)
+            if rollup is None:
+                rollups[key] = {
+                    'bucket': key[0],
+                    'bucket_start': key[1],
+                    'sensor_id': key[2],
+                    'location': key[3],
+                    'count': 1,
+                    'min_temperature': row['temperature'],
+                    'max_temperature': row['temperature'],
+                    'sum_temperature': row['temperature'],
+                    'last_temperature': row['temperature'],
+                    'last_timestamp': row['timestamp']
+                }
+                continue
+            rollup['count'] += 1
+            rollup['min_temperature'] = min(rollup['min_temperature'], row['temperature'])
+            rollup['max_temperature'] = max(rollup['max_temperature'], row['temperature'])
+            rollup['sum_temperature'] += row['temperature']
+            if row['timestamp'] >= rollup['last_timestamp']:
+                rollup['last_temperature'] = row['temperature']
+                rollup['last_timestamp'] = row['timestamp']
+    # A consistent key order keeps concurrent workers from deadlocking on the same rollup rows
+    return [rollups[key] for key in sorted(rollups)]
+
+
+def upsert_rollups(session, rollups):
+    """Merges rollup rows into sensor_rollup, adding to any existing row for the same bucket."""
+    if DB_ENGINE.dialect.name == 'mysql':
+        stmt = mysql_insert(SensorRollup)
+        new, least, greatest = stmt.inserted, func.least, func.greatest
+    else:
+        stmt = sqlite_insert(SensorRollup)
+        new, least, greatest = stmt.excluded, func.min, func.max
+
+    # last_temperature is assigned before last_timestamp, since MySQL applies the updates in order
+    updates = [
+        ('count', SensorRollup.count + new.count),
+        ('min_temperature', least(SensorRollup.min_temperature, new.min_temperature)),
+        ('max_temperature', greatest(SensorRollup.max_temperature, new.max_temperature)),
+        ('sum_temperature', SensorRollup.sum_temperature + new.sum_temperature),
+        ('last_temperature', case((new.last_timestamp >= SensorRollup.last_timestamp, new.last_temperature),
+                                  else_=SensorRollup.last_temperature)),
+        ('last_timestamp', greatest(SensorRollup.last_timestamp, new.last_timestamp))
+    ]
+    if DB_ENGINE.dialect.name == 'mysql':
+        stmt = stmt.on_duplicate_key_update(updates)
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=['bucket', 'bucket_start', 'sensor_id', 'location'],
+                                          set_=dict(updates))
+    session.execute(stmt, rollups)
+
+
+DIGEST_MODULUS = 1 << 62
+
+
+def trace_id_hash(trace_id):
+    """62-bit hash of a trace id; must match the Analyzer's, so both sides compute the same digests."""
+    return int.from_bytes(hashlib.sha1(trace_id.encode('utf-8')).digest()[:8], 'big') >> 2
+
+
+def aggregate_digests(event_type, rows):
+    """Folds rows into per-hour (of the event timestamp) counts and sums of trace id hashes."""
+    digests = {}
+    for row in rows:
+        bucket_start = row['timestamp'].replace(minute=0, second=0, microsecond=0)
+        count, digest = digests.get(bucket_start, (0, 0))
+        digests[bucket_start] = (count + 1, (digest + trace_id_hash(row['trace_id'])) % DIGEST_MODULUS)
+    return [{'event_type': event_type, 'bucket_start': bucket_start, 'count': count, 'digest': digest}
+            for bucket_start, (count, digest) in sorted(digests.items())]
+
+
+def upsert_digests(session, digests):
+    """Adds digest rows into trace_digest, in the same transaction as the rows they cover."""
+    if DB_ENGINE.dialect.name == 'mysql':
+        stmt = mysql_insert(TraceDigest)
+        new = stmt.inserted
+    else:
+        stmt = sqlite_insert(TraceDigest)
+        new = stmt.excluded
+
+    updates = [
+        ('count', TraceDigest.count + new.count),
+        ('digest', (TraceDigest.digest + new.digest) % DIGEST_MODULUS)
+    ]
+    if DB_ENGINE.dialect.name == 'mysql':
+        stmt = stmt.on_duplicate_key_update(updates)
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=['event_type', 'bucket_start'], set_=dict(updates))
+    session.execute(stmt, digests)
+
+
+def store_batch(session, rows, traces=()):
+    """Writes a batch of rows in a single transaction, with one bulk insert per table.
+
+    Rows are keyed on trace_id, so replayed events are dropped rather than stored twice.
+    The stage times of any traced events are recorded once the batch is committed.
+    """
+    stored_trace_ids = []
+    stored = 0
+    start = time.perf_counter()
+    try:
+        for event_type, model in EVENT_MODELS.items():
+            type_rows = rows.get(event_type, [])
+            if not type_rows:
+                continue
+            # Trace ids stored recently are dropped without a round trip, and the rest by the insert
+            new_rows = trace_id_cache.filter_new(type_rows)
+            inserted = insert_new_rows(session, model, new_rows) if new_rows else []
+            stored += len(inserted)
+            if len(inserted) < len(type_rows):
+                REPLAYED_EVENTS.inc(len(type_rows) - len(inserted))
+                logger.info(f"Dropped {len(type_rows) - len(inserted)} replayed {event_type} events")
+            stored_trace_ids.extend(row['trace_id'] for row in new_rows)
+            # Digests and rollups only count the rows this insert added, or replays would be counted twice
+            if inserted:
+                upsert_digests(session, aggregate_digests(event_type, inserted))
+                if model is SensorData:
+                    upsert_rollups(session, aggregate_rollups(inserted))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    elapsed = time.perf_counter() - start
+    batch_size = sum(len(type_rows) for type_rows in rows.values())
+    BATCH_COMMIT_TIME.observe(elapsed)
+    if batch_size:
+        MESSAGE_COMMIT_TIME.observe(elapsed / batch_size)
+    STORED_EVENTS.inc(stored)
+    trace_id_cache.add(stored_trace_ids)
+    if traces:
+        record_traces(session, traces, time.time())
+
+
+def record_traces(session, traces, committed):
+    """Stores the stage times of traced events; a failure only loses the traces, not the events."""
+    try:
+        session.execute(insert(TraceStage).prefix_with('IGNORE', dialect='mysql')
+                                          .prefix_with('OR IGNORE', dialect='sqlite'),
+                        [dict(trace, committed=committed) for trace in traces])
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f"Error recording {len(traces)} traces: {str(e)}")
+
+
+def trace_row(event_type, row, msg, consumed_at):
+    """Returns the stage times so far of a traced message, or None if it isn't traced."""
+    trace = event_envelope.read_trace(msg.value)
+    if trace is None:
+        return None
+    received, produced = trace
+    return {
+        'trace_id': row['trace_id'],
+        'event_type': event_type,
+        'date_created': row['date_created'],
+        'received': received,
+        'produced': produced,
+        'consumed': consumed_at
+    }
+
+
+def decode_message(msg, consumed_at):
+    """Returns the event type, table row and trace for a Kafka message, or None if it can't be stored."""
+    try:
+        event_type = event_envelope.read_type(msg.value)
+        payload = event_envelope.decode_payload(msg.value)
+        logger.debug("Message: %s %s" % (event_type, payload))
+        if event_type == 'sensor_data':
+            row = sensor_data_row(payload)
+        elif event_type == 'user_command':
+            row = user_command_row(payload)
+        else:
+            return None
+        return event_type, row, trace_row(event_type, row, msg, consumed_at)
+    except (ValueError, KeyError) as e:
+        logger.error(f"Skipping malformed message: {str(e)}")
+    return None
+
+
+def is_rejected_data(error):
+    """Whether storing the same rows again would fail the same way, unlike after a lost connection or a deadlock."""
+    return isinstance(error, (IntegrityError, DataError)) or not isinstance(error, DBAPIError)
+
+
+def skip_rows(rows, error):
+    for event_type, type_rows in rows.items():
+        for row in type_rows:
+            logger.error(f"Skipping {event_type} event with trace id {row['trace_id']} that the DB rejected: {str(error)}")
+        SKIPPED_EVENTS.inc(len(type_rows))
+
+
+def get_consumer(topic, worker_pool, commit_lock):
+    consumer_config = app_config['events']['consumer']
+    if consumer_config['type'] == 'simple':
+        return topic.get_simple_consumer(consumer_group=b'event_group',
+                                         reset_offset_on_start=False,
+                                         auto_offset_reset=OffsetType.LATEST,
+                                         auto_commit_enable=False,
+                                         consumer_timeout_ms=1000)
+
+    def on_rebalance(consumer, old_partition_offsets, new_partition_offsets):
+        # Anything stored but not yet committed for the old assignment is left to be
+        # redelivered, so an offset is never committed for a partition we no longer own
+        with commit_lock:
+            worker_pool.revoke([partition.id for partition in old_partition_offsets])
+        logger.info("Rebalanced, now consuming partitions %s" %
+                    sorted(partition.id for partition in new_partition_offsets))
+        return None
+
+    return topic.get_balanced_consumer(consumer_group=b'event_group',
+                                       zookeeper_connect=consumer_config['zookeeper'],
+                                       reset_offset_on_start=False,
+                                       auto_offset_reset=OffsetType.LATEST,
+                                       auto_commit_enable=False,
+                                       consumer_timeout_ms=1000,
+                                       post_rebalance_callback=on_rebalance)
+
+
+def get_consumer_lag(topic, committed_offsets):
+    """Returns how many messages of the partitions this consumer has committed are still to be committed."""
+    lag = 0
+    for partition_id, response in topic.latest_available_offsets().items():
+        if partition_id in committed_offsets:
+            # The latest available offset is the offset the next produced message will get
+            lag += max(0, response.offset[0] - 1 - committed_offsets[partition_id])
+    return lag
 
-    return results_list, 200
 
 def process_messages():
+    """Consumes events into the DB, with a new consumer whenever the connection to Kafka is remade."""
+    # The schema is migrated when the DB first connects
+    database.wait()
+    batch_config = app_config['events']['batch']
+    worker_pool = PartitionWorkerPool(app_config['events']['consumer']['workers'],
+                                      batch_config['max_size'],
+                                      batch_config['max_linger_ms'] / 1000,
+                                      batch_config['retry_interval_sec'],
+                                      DB_SESSION, decode_message, store_batch, ingest_watermark,
+                                      app_config['events']['consumer']['queue_size'], batch_config['max_attempts'],
+                                      is_rejected_data, skip_rows)
+    worker_pool.start()
+    commit_lock = RLock()
+    committed_offsets = {}
+    while True:
+        topic = kafka_topic.wait()
+        consumer = None
+        try:
+            consumer = get_consumer(topic, worker_pool, commit_lock)
+            consume_messages(topic, consumer, worker_pool, commit_lock, committed_offsets)
+        except Exception as e:
+            # Stored offsets that weren't committed are redelivered to the new consumer, and dropped as replays
+            with commit_lock:
+                worker_pool.revoke(list(topic.partitions))
+            if consumer is not None:
+                try:
+                    consumer.stop()
+                except Exception:
+                    pass
+            kafka_topic.reset(topic, e)
+
+
+def consume_messages(topic, consumer, worker_pool, commit_lock, committed_offsets):
+    lag_checked = 0
+    while True:
+        msg = consumer.consume()
+        if msg is not None:
+            worker_pool.submit(msg)
+
+        # Offsets are only committed once the workers have stored the rows in the DB
+        with commit_lock:
+            committable = worker_pool.take_committable()
+            if committable:
+                consumer.commit_offsets([(topic.partitions[partition_id], offset)
+                                         for partition_id, offset in committable.items()])
+                committed_offsets.update(committable)
+
+        if time.time() - lag_checked >= app_config['metrics']['lag_interval_sec']:
+            lag_checked = time.time()
+            try:
+                CONSUMER_LAG.set(get_consumer_lag(topic, committed_offsets))
+            except Exception as e:
+                logger.warning(f"Failed to get consumer lag: {str(e)}")
+
+
+def get_cache_stats():
+    return dict(result_cache.stats(), watermark=ingest_watermark.value().isoformat()), 200
+
+
+def get_cold_stats():
+    return cold_store.stats() if cold_store is not None else {}, 200
+
+
+def get_metrics():
+    return metrics.get_metrics()
+
+
+def get_live():
+    return health.get_live()
+
+
+def get_ready():
+    return health.get_ready()
+
+
+def init_database():
+    """Migrates the MySQL schema, or creates the tables straight from the models for a datastore.url database."""
+    if app_config['datastore'].get('url'):
+        Base.metadata.create_all(DB_ENGINE)
+    else:
+        create_tables()
+
+
+def sync_watermark():
+    """Publishes this replica's ingest watermark, and raises its floor to the oldest of the live replicas'.
+
+    A replica that hasn't published for cache.replica_timeout_sec is taken to be gone, along with its writes.
+    """
+    now = datetime.datetime.now()
+    expired = now - datetime.timedelta(seconds=app_config['cache']['replica_timeout_sec'])
+    published = {'replica_id': REPLICA_ID, 'watermark': ingest_watermark.local_value(), 'updated': now}
+    if DB_ENGINE.dialect.name == 'mysql':
+        stmt = mysql_insert(ReplicaWatermark)
+        stmt = stmt.on_duplicate_key_update(watermark=stmt.inserted.watermark, updated=stmt.inserted.updated)
+    else:
+        stmt = sqlite_insert(ReplicaWatermark)
+        stmt = stmt.on_conflict_do_update(index_elements=['replica_id'],
+                                          set_={'watermark': stmt.excluded.watermark, 'updated': stmt.excluded.updated})
+    session = DB_SESSION()
+    try:
+        session.execute(stmt, [published])
+        session.query(ReplicaWatermark).filter(ReplicaWatermark.updated < expired).delete()
+        session.commit()
+        floor = session.query(func.min(ReplicaWatermark.watermark)).scalar()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    ingest_watermark.raise_floor(floor)
+
+
+def run_watermark_sync():
+    """Periodically shares the ingest watermark with the other replicas writing to the DB."""
+    database.wait()
+    while True:
+        time.sleep(app_config['cache']['watermark_sync_interval_sec'])
+        try:
+            sync_watermark()
+        except Exception as e:
+            logger.error(f"Error syncing the ingest watermark: {str(e)}")
+
+
+def connect_database():
+    init_database()
+    # Published before any event is consumed, so the other replicas hold their caches back for its writes
+    sync_watermark()
+    return DB_ENGINE
+
+
+def check_database(engine):
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+
+
+def connect_kafka():
     hostname = f"{app_config['events']['hostname']}:{app_config['events']['port']}"
     client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group',
-                                         reset_offset_on_start=False,
-                                         auto_offset_reset=OffsetType.LATEST)
-    for msg in consumer:
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        payload = msg['payload']
-        if msg['type'] == 'sensor_data':
-            receive_sensor_data(payload)
-        elif msg['type'] == 'user_command':
-            receive_user_command(payload)
-        consumer.commit_offsets()
+    return client.topics[str.encode(app_config['events']['topic'])]
+
+
+# Both connect in the background once started, and reconnect after failures
+database = health.Dependency('db', connect_database,
+                             app_config['connections']['initial_backoff_sec'],
+                             app_config['connections']['max_backoff_sec'],
+                             check=check_database,
+                             check_interval_sec=app_config['connections']['check_interval_sec'])
+kafka_topic = health.Dependency('kafka', connect_kafka,
+                                app_config['connections']['initial_backoff_sec'],
+                                app_config['connections']['max_backoff_sec'])
+
+
+def init_connections():
+    database.start()
+    kafka_topic.start()
+
+
+def prune_rows(db_conn, table, oldest_kept_day):
+    """Removes a table's rows created before oldest_kept_day, a whole day partition at a time when partitioned."""
+    db_cursor = db_conn.cursor()
+    partitioned = bool(get_partitions(db_cursor, table))
+    db_cursor.close()
+    if partitioned:
+        drop_expired_partitions(db_conn, table, oldest_kept_day)
+        delete_expired_rows(db_conn, StoredTraceId.__tablename__, oldest_kept_day,
+                            app_config['retention']['delete_batch_size'], event_type=table)
+    else:
+        delete_expired_rows(db_conn, table, oldest_kept_day, app_config['retention']['delete_batch_size'])
+    result_cache.invalidate(table)
+
+
+def run_retention():
+    """Periodically removes events older than the retention period, from the DB and cold storage."""
+    retention_config = app_config['retention']
+    while True:
+        oldest_kept_day = datetime.date.today() - datetime.timedelta(days=retention_config['days'])
+        db_conn = DB_ENGINE.raw_connection()
+        try:
+            for table in EVENT_TABLES:
+                db_cursor = db_conn.cursor()
+                partitioned = bool(get_partitions(db_cursor, table))
+                db_cursor.close()
+                if partitioned:
+                    add_day_partitions(db_conn, table, retention_config['partition_days_ahead'])
+                prune_rows(db_conn, table, oldest_kept_day)
+                if cold_store is not None:
+                    cold_store.drop_days_before(table, oldest_kept_day)
+        except Exception as e:
+            logger.error(f"Error running retention: {str(e)}")
+        finally:
+            db_conn.close()
+        time.sleep(retention_config['interval_sec'])
+
+
+def export_closed_days(model, export_before):
+    """Exports a table's days before export_before to cold storage, oldest first, then prunes them from the DB."""
+    table = model.__tablename__
+    columns = [column.name for column in model.__table__.columns]
+    session = DB_SESSION()
+    try:
+        day = cold_store.exported_until(table)
+        if day is None:
+            oldest = session.query(func.min(model.date_created)).scalar()
+            if oldest is None:
+                return
+            day = oldest.date()
+        if day >= export_before:
+            return
+        while day < export_before:
+            day_start = datetime.datetime.combine(day, datetime.time())
+            query = query_window(session, model, day_start, day_start + datetime.timedelta(days=1))
+            rows = query.execution_options(stream_results=True).yield_per(app_config['paging']['fetch_size'])
+            cold_store.export_day(model, day, ({name: getattr(row, name) for name in columns} for row in rows))
+            session.expunge_all()
+            day += datetime.timedelta(days=1)
+    finally:
+        session.close()
+
+    db_conn = DB_ENGINE.raw_connection()
+    try:
+        prune_rows(db_conn, table, day)
+    finally:
+        db_conn.close()
+
+
+def run_cold_export():
+    """Periodically moves closed days of events from the DB to cold storage files."""
+    cold_config = app_config['cold_storage']
+    while True:
+        # A day is closed once it is old enough and every row stamped during it has been committed
+        export_before = min(datetime.date.today() - datetime.timedelta(days=cold_config['export_after_days']),
+                            ingest_watermark.value().date())
+        for table in EVENT_TABLES:
+            try:
+                export_closed_days(EVENT_MODELS[table], export_before)
+            except Exception as e:
+                logger.error(f"Error exporting {table} to cold storage: {str(e)}")
+        time.sleep(cold_config['interval_sec'])
+
+
+class UnvalidatedStream(AbstractResponseBodyValidator):
+    """Sends NDJSON responses on as they are streamed, where a validator would hold the whole body in memory."""
 
+    def wrap_send(self, send):
+        return send
 
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yml", strict_validation=True, validate_responses=True,
+            validator_map={'response': MediaTypeDict(VALIDATOR_MAP['response'],
+                                                     **{'application/x-ndjson': UnvalidatedStream})})
 
 if __name__ == "__main__":
-    create_tables()
+    init_connections()
     t1 = Thread(target=process_messages)
     t1.setDaemon(True)
     t1.start()
+    if app_config['retention']['days']:
+        t2 = Thread(target=run_retention)
+        t2.setDaemon(True)
+        t2.start()
+    if cold_store is not None:
+        t3 = Thread(target=run_cold_export)
+        t3.setDaemon(True)
+        t3.start()
+    t4 = Thread(target=run_watermark_sync)
+    t4.setDaemon(True)
+    t4.start()
     app.run(host='0.0.0.0',port=8090)
\ No newline at end of file
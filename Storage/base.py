@@ -1,3 +1,8 @@
+from sqlalchemy import DateTime
+from sqlalchemy.dialects.mysql import DATETIME
 from sqlalchemy.ext.declarative import declarative_base
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
+
+# DATETIME(6) on MySQL, so date_created keeps microseconds for keyset pagination
+PreciseDateTime = DateTime().with_variant(DATETIME(fsp=6), 'mysql')
@@ -0,0 +1,250 @@
+import os
+import json
+import datetime
+import logging
+from threading import Lock
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import DateTime, Integer, Float, String
+
+logger = logging.getLogger('basicLogger')
+
+ARROW_TYPES = [
+    # PreciseDateTime columns are DateTimes with a DATETIME(6) variant for MySQL
+    (DateTime, pa.timestamp('us')),
+    (Integer, pa.int64()),
+    (Float, pa.float64()),
+    (String, pa.string())
+]
+
+
+def arrow_schema(model):
+    """Maps a model's columns to an Arrow schema, in table order."""
+    fields = []
+    for column in model.__table__.columns:
+        arrow_type = next(arrow_type for column_type, arrow_type in ARROW_TYPES if isinstance(column.type, column_type))
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+def overlapping_row_groups(parquet_file, start, end):
+    """Returns the row groups of a file whose date_created statistics overlap [start, end)."""
+    column = parquet_file.schema_arrow.get_field_index('date_created')
+    row_groups = []
+    for i in range(parquet_file.num_row_groups):
+        statistics = parquet_file.metadata.row_group(i).column(column).statistics
+        if statistics is None or not statistics.has_min_max or (statistics.max >= start and statistics.min < end):
+            row_groups.append(i)
+    return row_groups
+
+
+def result_dict(row):
+    """Formats a row read from a file like the models' to_dict()."""
+    return {name: value.isoformat() if isinstance(value, datetime.datetime) else value
+            for name, value in row.items()}
+
+
+class ColdStore:
+    """Closed days of events, one Parquet file per table and day, in (date_created, id) order.
+
+    A manifest records each file's row count and date_created range, and the day up to which each
+    table has been exported. Days are exported oldest first, so everything created before a table's
+    exported_until is in its files, and only rows from exported_until on are in the DB.
+    """
+
+    def __init__(self, directory, compression, row_group_size, read_batch_size):
+        self.directory = directory
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.read_batch_size = read_batch_size
+        self.manifest_file = os.path.join(directory, 'manifest.json')
+        self.lock = Lock()
+        self.manifest = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r') as f:
+                self.manifest = json.load(f)
+
+    def exported_until(self, table):
+        """Returns the day before which all of a table's rows are in files, or None if none are."""
+        with self.lock:
+            exported_until = self.manifest.get(table, {}).get('exported_until')
+        return datetime.date.fromisoformat(exported_until) if exported_until else None
+
+    def save_manifest(self):
+        tmp_file = f"{self.manifest_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.manifest_file)
+
+    def export_day(self, model, day, rows):
+        """Writes a day's rows, given as column dicts in (date_created, id) order, and moves exported_until past it."""
+        table = model.__tablename__
+        schema = arrow_schema(model)
+        os.makedirs(os.path.join(self.directory, table), exist_ok=True)
+        filename = os.path.join(table, f"{day.isoformat()}.parquet")
+        path = os.path.join(self.directory, filename)
+
+        count = 0
+        first = last = None
+        min_timestamp = max_timestamp = None
+        with pq.ParquetWriter(f"{path}.tmp", schema, compression=self.compression) as writer:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                min_timestamp = min(min_timestamp or row['timestamp'], row['timestamp'])
+                max_timestamp = max(max_timestamp or row['timestamp'], row['timestamp'])
+                if len(batch) >= self.row_group_size:
+                    writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                    count += len(batch)
+                    first = first or batch[0]['date_created']
+                    last = batch[-1]['date_created']
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                count += len(batch)
+                first = first or batch[0]['date_created']
+                last = batch[-1]['date_created']
+        os.replace(f"{path}.tmp", path)
+
+        with self.lock:
+            entry = self.manifest.setdefault(table, {"exported_until": None, "days": {}})
+            if count:
+                entry["days"][day.isoformat()] = {
+                    "file": filename,
+                    "rows": count,
+                    "bytes": os.path.getsize(path),
+                    "min_date_created": first.isoformat(),
+                    "max_date_created": last.isoformat(),
+                    "min_timestamp": min_timestamp.isoformat(),
+                    "max_timestamp": max_timestamp.isoformat()
+                }
+            else:
+                os.remove(path)
+            entry["exported_until"] = (day + datetime.timedelta(days=1)).isoformat()
+            self.save_manifest()
+        logger.info(f"Exported {count} {table} rows created on {day} to {filename}")
+        return count
+
+    def drop_days_before(self, table, oldest_kept_day):
+        """Deletes a table's files for days before oldest_kept_day, for retention."""
+        with self.lock:
+            days = self.manifest.get(table, {}).get("days", {})
+            expired = [day for day in days if datetime.date.fromisoformat(day) < oldest_kept_day]
+            for day in expired:
+                path = os.path.join(self.directory, days.pop(day)["file"])
+                if os.path.exists(path):
+                    os.remove(path)
+            if expired:
+                self.save_manifest()
+        if expired:
+            logger.info(f"Dropped expired {table} files for {', '.join(sorted(expired))}")
+
+    def read_window(self, table, start, end, after=None, limit=None):
+        """Yields the rows created in [start, end) after the (date_created, id) position after, as result dicts.
+
+        Only files whose date_created range overlaps the window are opened. The rows in a file are
+        already in (date_created, id) order, so it is read a batch at a time from the row groups whose
+        statistics can hold the window, and reading stops at the end of the window or after limit rows.
+        """
+        with self.lock:
+            days = sorted(self.manifest.get(table, {}).get("days", {}).items())
+        first = start if after is None else max(start, after[0])
+        count = 0
+        for day, entry in days:
+            if datetime.datetime.fromisoformat(entry["max_date_created"]) < first or \
+                    datetime.datetime.fromisoformat(entry["min_date_created"]) >= end:
+                continue
+            with pq.ParquetFile(os.path.join(self.directory, entry["file"])) as parquet_file:
+                for batch in parquet_file.iter_batches(batch_size=self.read_batch_size,
+                                                       row_groups=overlapping_row_groups(parquet_file, first, end)):
+                    date_created = batch.column('date_created')
+                    in_window = pc.and_(pc.greater_equal(date_created, pa.scalar(start, pa.timestamp('us'))),
+                                        pc.less(date_created, pa.scalar(end, pa.timestamp('us'))))
+                    if after is not None:
+                        after_date_created = pa.scalar(after[0], pa.timestamp('us'))
+                        in_window = pc.and_(in_window, pc.or_(
+                            pc.greater(date_created, after_date_created),
+                            pc.and_(pc.equal(date_created, after_date_created),
+                                    pc.greater(batch.column('id'), after[1]))))
+                    for row in batch.filter(in_window).to_pylist():
+                        yield result_dict(row)
+                        count += 1
+                        if limit is not None and count >= limit:
+                            return
+                    if pc.max(date_created).as_py() >= end:
+                        return
+
+    def trace_ids(self, table, timestamp_start, timestamp_end):
+        """Returns the trace ids of the rows whose event timestamp is in [timestamp_start, timestamp_end).
+
+        Files are by date_created, which can be any time after the event, so each file whose
+        timestamp range overlaps is read, or every file exported before the ranges were recorded.
+        """
+        with self.lock:
+            days = sorted(self.manifest.get(table, {}).get("days", {}).items())
+        trace_ids = []
+        for day, entry in days:
+            if "min_timestamp" in entry and (
+                    datetime.datetime.fromisoformat(entry["max_timestamp"]) < timestamp_start or
+                    datetime.datetime.fromisoformat(entry["min_timestamp"]) >= timestamp_end):
+                continue
+            trace_ids.extend(pq.read_table(os.path.join(self.directory, entry["file"]), columns=['trace_id'],
+                                           filters=[('timestamp', '>=', timestamp_start),
+                                                    ('timestamp', '<', timestamp_end)])['trace_id'].to_pylist())
+        return trace_ids
+
+    def window_stats(self, table, start, end, column, sensor_page):
+        """Returns the count, max, min and sum of column over the rows created in [start, end), like the SQL stats.
+
+        With a sensor_page of (after, limit), also the histogram of column at 0.1 resolution and the counts and
+        sums of the first limit sensors after the (sensor_id, location) after, or None.
+        """
+        with self.lock:
+            days = sorted(self.manifest.get(table, {}).get("days", {}).items())
+        columns = ['id', column] + (['sensor_id', 'location'] if sensor_page is not None else [])
+        tables = [pq.read_table(os.path.join(self.directory, entry["file"]), columns=columns,
+                                filters=[('date_created', '>=', start), ('date_created', '<', end)])
+                  for day, entry in days
+                  if datetime.datetime.fromisoformat(entry["max_date_created"]) >= start and
+                  datetime.datetime.fromisoformat(entry["min_date_created"]) < end]
+        rows = pa.concat_tables(tables) if tables else pa.table({name: pa.array([], pa.float64()) for name in columns})
+
+        min_max = pc.min_max(rows[column]).as_py()
+        stats = {
+            "count": rows.num_rows,
+            "max": min_max["max"],
+            "min": min_max["min"],
+            "sum": pc.sum(rows[column]).as_py() or 0
+        }
+        if sensor_page is not None:
+            # Rounds halves away from zero, as ROUND() does in the DB
+            rounded = rows.append_column('rounded', pc.round(rows[column], 1, round_mode='half_towards_infinity'))
+            histogram = rounded.group_by('rounded').aggregate([('id', 'count')])
+            stats["temperature_histogram"] = [[row['rounded'], row['id_count']] for row in histogram.to_pylist()]
+
+            after, limit = sensor_page
+            if after is not None and rows.num_rows:
+                # Sensors with the cursor's id but a location up to its one are dropped after grouping
+                rows = rows.filter(pc.greater_equal(rows['sensor_id'], after[0]))
+            sensors = rows.group_by(['sensor_id', 'location']).aggregate([('id', 'count'), (column, 'sum')]) \
+                .sort_by([('sensor_id', 'ascending'), ('location', 'ascending')])
+            stats["sensors"] = [{"sensor_id": row['sensor_id'], "location": row['location'],
+                                 "count": row['id_count'], "sum": row[f"{column}_sum"]}
+                                for row in sensors.to_pylist()
+                                if after is None or (row['sensor_id'], row['location']) > after][:limit]
+        return stats
+
+    def stats(self):
+        with self.lock:
+            return {
+                table: {
+                    "exported_until": entry["exported_until"],
+                    "days": len(entry["days"]),
+                    "rows": sum(day["rows"] for day in entry["days"].values()),
+                    "bytes": sum(day["bytes"] for day in entry["days"].values())
+                }
+                for table, entry in self.manifest.items()
+            }
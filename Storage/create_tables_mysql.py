@@ -1,35 +1,30 @@
+import yaml
 import mysql.connector
+from migrations import migrate, enable_day_partitioning, EVENT_TABLES
 
-db_conn = mysql.connector.connect(host="", user="", 
-                                  password="", database="")
-
-db_cursor = db_conn.cursor()
-
-# Create sensor_data table
-db_cursor.execute('''
-CREATE TABLE sensor_data
-(id INT NOT NULL AUTO_INCREMENT,
-sensor_id VARCHAR(250) NOT NULL,
-temperature FLOAT NOT NULL,
-timestamp VARCHAR(100) NOT NULL,
-location VARCHAR(250) NOT NULL,
-trace_id VARCHAR(100) NOT NULL,
-date_created VARCHAR(100) NOT NULL,
-CONSTRAINT sensor_data_pk PRIMARY KEY (id))
-''')
-
-# Create user_command table
-db_cursor.execute('''
-CREATE TABLE user_command
-(id INT NOT NULL AUTO_INCREMENT,
-user_id VARCHAR(250) NOT NULL,
-target_device VARCHAR(250) NOT NULL,
-target_temperature FLOAT NOT NULL,
-timestamp VARCHAR(100) NOT NULL,
-trace_id VARCHAR(100) NOT NULL,
-date_created VARCHAR(100) NOT NULL,
-CONSTRAINT user_command_pk PRIMARY KEY (id))
-''')
-
-db_conn.commit()
-db_conn.close()
+with open('app_conf.yml', 'r') as f:
+    app_config = yaml.safe_load(f.read())
+
+
+def connect():
+    return mysql.connector.connect(host=app_config['datastore']['hostname'],
+                                   port=app_config['datastore']['port'],
+                                   user=app_config['datastore']['user'],
+                                   password=app_config['datastore']['password'],
+                                   database=app_config['datastore']['db'])
+
+
+def create_tables():
+    """Brings the schema up to date, partitioning the event tables by day if configured."""
+    db_conn = connect()
+    migrate(db_conn)
+
+    if app_config['retention']['partition_by_day']:
+        for table in EVENT_TABLES:
+            enable_day_partitioning(db_conn, table, app_config['retention']['partition_days_ahead'])
+
+    db_conn.close()
+
+
+if __name__ == "__main__":
+    create_tables()
@@ -0,0 +1,37 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class TraceIdCache:
+    """Bounded LRU set of recently stored trace ids, shared by the partition workers."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.trace_ids = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def filter_new(self, rows):
+        """Returns the rows whose trace id hasn't been seen recently, dropping repeats within rows too."""
+        new_rows = []
+        seen = set()
+        with self.lock:
+            for row in rows:
+                trace_id = row['trace_id']
+                if trace_id in self.trace_ids:
+                    self.trace_ids.move_to_end(trace_id)
+                    self.hits += 1
+                elif trace_id not in seen:
+                    seen.add(trace_id)
+                    new_rows.append(row)
+                    self.misses += 1
+        return new_rows
+
+    def add(self, trace_ids):
+        with self.lock:
+            for trace_id in trace_ids:
+                self.trace_ids[trace_id] = None
+                self.trace_ids.move_to_end(trace_id)
+            while len(self.trace_ids) > self.max_size:
+                self.trace_ids.popitem(last=False)
@@ -1,13 +1,13 @@
-import mysql.connector
+from create_tables_mysql import connect
 
-db_conn = mysql.connector.connect(host="", user="", 
-                                  password="", database="")
+db_conn = connect()
 
 db_cursor = db_conn.cursor()
 
 # Drop the tables
 db_cursor.execute('''
-DROP TABLE IF EXISTS sensor_data, user_command
+DROP TABLE IF EXISTS sensor_data, user_command, sensor_rollup, trace_stage, trace_digest, stored_trace_id,
+    replica_watermark, schema_version
 ''')
 
 db_conn.commit()
@@ -0,0 +1,328 @@
+import datetime
+import logging
+
+logger = logging.getLogger('basicLogger')
+
+EVENT_TABLES = ['sensor_data', 'user_command']
+
+# Values written by earlier versions look like 2024-09-19T10:00:00Z, 2024-09-19 10:00:00.123456 or
+# 2024-09-19T12:00:00+02:00, and the ones with an offset are converted to UTC like new events are
+NORMALIZE_DATETIME = """
+CASE WHEN {column} REGEXP '[+-][0-9][0-9]:[0-9][0-9]$'
+THEN CONVERT_TZ(LEFT(REPLACE(LEFT({column}, CHAR_LENGTH({column}) - 6), 'T', ' '), 26), RIGHT({column}, 6), '+00:00')
+ELSE LEFT(REPLACE(REPLACE({column}, 'T', ' '), 'Z', ''), 26)
+END
+"""
+
+
+def index_exists(db_cursor, table, index):
+    db_cursor.execute('''
+    SELECT COUNT(*) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+    ''', (table, index))
+    return db_cursor.fetchone()[0] > 0
+
+
+def column_type(db_cursor, table, column):
+    db_cursor.execute('''
+    SELECT DATA_TYPE FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    ''', (table, column))
+    return db_cursor.fetchone()[0].lower()
+
+
+def has_digests(db_cursor, event_type):
+    db_cursor.execute('SELECT COUNT(*) FROM trace_digest WHERE event_type = %s', (event_type,))
+    return db_cursor.fetchone()[0] > 0
+
+
+def is_datetime(table, column):
+    return lambda db_cursor: column_type(db_cursor, table, column) == 'datetime'
+
+
+def create_index(table, index, columns, unique=False):
+    return (lambda db_cursor: index_exists(db_cursor, table, index),
+            f'CREATE {"UNIQUE " if unique else ""}INDEX {index} ON {table} ({columns})')
+
+
+# (version, description, steps), applied in order and recorded in schema_version. MySQL commits each DDL
+# statement as it runs, so a failed migration is re-run from its first step: a step is either a statement
+# that is safe to repeat, or (applied, statement) where applied(db_cursor) tells if it already ran.
+MIGRATIONS = [
+    (1, "Create sensor_data and user_command tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS sensor_data
+        (id INT NOT NULL AUTO_INCREMENT,
+        sensor_id VARCHAR(250) NOT NULL,
+        temperature FLOAT NOT NULL,
+        timestamp VARCHAR(100) NOT NULL,
+        location VARCHAR(250) NOT NULL,
+        trace_id VARCHAR(100) NOT NULL,
+        date_created VARCHAR(100) NOT NULL,
+        CONSTRAINT sensor_data_pk PRIMARY KEY (id))
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_command
+        (id INT NOT NULL AUTO_INCREMENT,
+        user_id VARCHAR(250) NOT NULL,
+        target_device VARCHAR(250) NOT NULL,
+        target_temperature FLOAT NOT NULL,
+        timestamp VARCHAR(100) NOT NULL,
+        trace_id VARCHAR(100) NOT NULL,
+        date_created VARCHAR(100) NOT NULL,
+        CONSTRAINT user_command_pk PRIMARY KEY (id))
+        '''
+    ]),
+    (2, "Store timestamp and date_created as DATETIME(6)", [
+        statement
+        for table in EVENT_TABLES
+        for statement in (
+            (is_datetime(table, 'date_created'), f'''
+            UPDATE {table}
+            SET timestamp = {NORMALIZE_DATETIME.format(column='timestamp')},
+                date_created = {NORMALIZE_DATETIME.format(column='date_created')}
+            '''),
+            (is_datetime(table, 'date_created'), f'''
+            ALTER TABLE {table}
+            MODIFY timestamp DATETIME(6) NOT NULL,
+            MODIFY date_created DATETIME(6) NOT NULL
+            ''')
+        )
+    ]),
+    (3, "Index date_created and (sensor_id, timestamp)", [
+        create_index('sensor_data', 'sensor_data_date_created_idx', 'date_created, id'),
+        create_index('sensor_data', 'sensor_data_sensor_timestamp_idx', 'sensor_id, timestamp'),
+        create_index('user_command', 'user_command_date_created_idx', 'date_created, id')
+    ]),
+    (4, "Make trace_id unique, keeping the first copy of any duplicated event", [
+        statement
+        for table in EVENT_TABLES
+        for statement in (
+            f'''
+            DELETE duplicate FROM {table} duplicate
+            JOIN {table} original ON duplicate.trace_id = original.trace_id AND duplicate.id > original.id
+            ''',
+            create_index(table, f'{table}_trace_id_idx', 'trace_id', unique=True)
+        )
+    ]),
+    (5, "Create sensor_rollup table for per-minute and per-hour sensor aggregates", [
+        '''
+        CREATE TABLE IF NOT EXISTS sensor_rollup
+        (bucket VARCHAR(10) NOT NULL,
+        bucket_start DATETIME NOT NULL,
+        sensor_id VARCHAR(250) NOT NULL,
+        location VARCHAR(250) NOT NULL,
+        count INT NOT NULL,
+        min_temperature FLOAT NOT NULL,
+        max_temperature FLOAT NOT NULL,
+        sum_temperature DOUBLE NOT NULL,
+        last_temperature FLOAT NOT NULL,
+        last_timestamp DATETIME(6) NOT NULL,
+        CONSTRAINT sensor_rollup_pk PRIMARY KEY (bucket, bucket_start, sensor_id, location))
+        ''',
+        create_index('sensor_rollup', 'sensor_rollup_sensor_idx', 'bucket, sensor_id, bucket_start')
+    ]),
+    (6, "Create trace_stage table for the stage times of sampled events", [
+        '''
+        CREATE TABLE IF NOT EXISTS trace_stage
+        (trace_id VARCHAR(100) NOT NULL,
+        event_type VARCHAR(20) NOT NULL,
+        date_created DATETIME(6) NOT NULL,
+        received DOUBLE NOT NULL,
+        produced DOUBLE NOT NULL,
+        consumed DOUBLE NOT NULL,
+        committed DOUBLE NOT NULL,
+        picked_up DOUBLE,
+        CONSTRAINT trace_stage_pk PRIMARY KEY (trace_id))
+        ''',
+        create_index('trace_stage', 'trace_stage_date_created_idx', 'date_created')
+    ]),
+    (7, "Create trace_digest table of per-hour trace id digests, backfilled from the stored events", [
+        '''
+        CREATE TABLE IF NOT EXISTS trace_digest
+        (event_type VARCHAR(20) NOT NULL,
+        bucket_start DATETIME NOT NULL,
+        count INT NOT NULL,
+        digest BIGINT NOT NULL,
+        CONSTRAINT trace_digest_pk PRIMARY KEY (event_type, bucket_start))
+        ''',
+        create_index('sensor_data', 'sensor_data_timestamp_idx', 'timestamp'),
+        create_index('user_command', 'user_command_timestamp_idx', 'timestamp')
+    ] + [
+        # The first 64 bits of SHA1(trace_id) shifted down to 62, as in Storage's trace_id_hash
+        (lambda db_cursor, table=table: has_digests(db_cursor, table), f'''
+        INSERT INTO trace_digest (event_type, bucket_start, count, digest)
+        SELECT '{table}', DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00'), COUNT(*),
+               MOD(SUM(CAST(CONV(SUBSTR(SHA1(trace_id), 1, 16), 16, 10) AS UNSIGNED) >> 2), 4611686018427387904)
+        FROM {table}
+        GROUP BY DATE_FORMAT(timestamp, '%Y-%m-%d %H:00:00')
+        ''')
+        for table in EVENT_TABLES
+    ]),
+    (8, "Create stored_trace_id table to deduplicate the day-partitioned event tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS stored_trace_id
+        (trace_id VARCHAR(100) NOT NULL,
+        event_type VARCHAR(20) NOT NULL,
+        date_created DATETIME(6) NOT NULL,
+        CONSTRAINT stored_trace_id_pk PRIMARY KEY (trace_id))
+        ''',
+        create_index('stored_trace_id', 'stored_trace_id_date_created_idx', 'event_type, date_created')
+    ] + [
+        # Tables partitioned by an earlier version have no unique trace_id index, so their trace ids are copied
+        f'''
+        INSERT IGNORE INTO stored_trace_id (trace_id, event_type, date_created)
+        SELECT trace_id, '{table}', date_created FROM {table}
+        WHERE EXISTS (SELECT 1 FROM information_schema.PARTITIONS
+                      WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = '{table}' AND PARTITION_NAME IS NOT NULL)
+        '''
+        for table in EVENT_TABLES
+    ]),
+    (9, "Create replica_watermark table for the ingest watermark shared by the Storage replicas", [
+        '''
+        CREATE TABLE IF NOT EXISTS replica_watermark
+        (replica_id VARCHAR(36) NOT NULL,
+        watermark DATETIME(6) NOT NULL,
+        updated DATETIME(6) NOT NULL,
+        CONSTRAINT replica_watermark_pk PRIMARY KEY (replica_id))
+        '''
+    ]),
+]
+
+
+def get_schema_version(db_cursor):
+    db_cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version
+    (version INT NOT NULL,
+    description VARCHAR(250) NOT NULL,
+    applied DATETIME NOT NULL,
+    CONSTRAINT schema_version_pk PRIMARY KEY (version))
+    ''')
+    db_cursor.execute('SELECT MAX(version) FROM schema_version')
+    version = db_cursor.fetchone()[0]
+    return version or 0
+
+
+def migrate(db_conn):
+    """Applies every migration newer than the current schema version, skipping steps a failed run applied."""
+    db_cursor = db_conn.cursor()
+    current_version = get_schema_version(db_cursor)
+    for version, description, steps in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info(f"Applying schema migration {version}: {description}")
+        for step in steps:
+            if isinstance(step, tuple):
+                applied, statement = step
+                if applied(db_cursor):
+                    continue
+            else:
+                statement = step
+            db_cursor.execute(statement)
+        db_cursor.execute('INSERT INTO schema_version (version, description, applied) VALUES (%s, %s, %s)',
+                          (version, description, datetime.datetime.now()))
+        db_conn.commit()
+    db_cursor.close()
+
+
+def partition_name(day):
+    return day.strftime('p%Y%m%d')
+
+
+def get_partitions(db_cursor, table):
+    """Returns the names of a table's partitions, or an empty list if it isn't partitioned."""
+    db_cursor.execute('''
+    SELECT PARTITION_NAME FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+    ORDER BY PARTITION_ORDINAL_POSITION
+    ''', (table,))
+    return [row[0] for row in db_cursor.fetchall()]
+
+
+def day_partition_definitions(days):
+    return ", ".join(f"PARTITION {partition_name(day)} VALUES LESS THAN ('{day + datetime.timedelta(days=1)}')"
+                     for day in days)
+
+
+def enable_day_partitioning(db_conn, table, days_ahead):
+    """Range partitions a table by day of date_created, from its oldest row to days_ahead from today."""
+    db_cursor = db_conn.cursor()
+    if get_partitions(db_cursor, table):
+        db_cursor.close()
+        return
+
+    db_cursor.execute(f'SELECT MIN(date_created) FROM {table}')
+    oldest = db_cursor.fetchone()[0]
+    today = datetime.date.today()
+    first_day = oldest.date() if oldest is not None else today
+    days = [first_day + datetime.timedelta(days=i)
+            for i in range((today - first_day).days + days_ahead + 1)]
+
+    logger.info(f"Partitioning {table} by day from {days[0]} to {days[-1]}")
+    # Every unique key of a partitioned table has to include the partitioning column, so trace_id
+    # uniqueness moves to stored_trace_id, where ingest claims each trace id before inserting its row
+    db_cursor.execute(f'''
+    INSERT IGNORE INTO stored_trace_id (trace_id, event_type, date_created)
+    SELECT trace_id, '{table}', date_created FROM {table}
+    ''')
+    db_cursor.execute(f'''
+    ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, date_created),
+    DROP INDEX {table}_trace_id_idx, ADD INDEX {table}_trace_id_idx (trace_id)
+    ''')
+    db_cursor.execute(f'''
+    ALTER TABLE {table} PARTITION BY RANGE COLUMNS(date_created)
+    ({day_partition_definitions(days)}, PARTITION pfuture VALUES LESS THAN (MAXVALUE))
+    ''')
+    db_conn.commit()
+    db_cursor.close()
+
+
+def add_day_partitions(db_conn, table, days_ahead):
+    """Splits pfuture so there is a partition for each of the next days_ahead days."""
+    db_cursor = db_conn.cursor()
+    partitions = get_partitions(db_cursor, table)
+    today = datetime.date.today()
+    days = [today + datetime.timedelta(days=i) for i in range(days_ahead + 1)
+            if partition_name(today + datetime.timedelta(days=i)) not in partitions]
+    if days:
+        logger.info(f"Adding partitions to {table} for {days[0]} to {days[-1]}")
+        db_cursor.execute(f'''
+        ALTER TABLE {table} REORGANIZE PARTITION pfuture INTO
+        ({day_partition_definitions(days)}, PARTITION pfuture VALUES LESS THAN (MAXVALUE))
+        ''')
+        db_conn.commit()
+    db_cursor.close()
+
+
+def drop_expired_partitions(db_conn, table, oldest_kept_day):
+    """Drops the day partitions of a table that are entirely older than oldest_kept_day."""
+    db_cursor = db_conn.cursor()
+    expired = [name for name in get_partitions(db_cursor, table)
+               if name != 'pfuture' and name < partition_name(oldest_kept_day)]
+    if expired:
+        logger.info(f"Dropping expired partitions of {table}: {', '.join(expired)}")
+        db_cursor.execute(f'ALTER TABLE {table} DROP PARTITION {", ".join(expired)}')
+        db_conn.commit()
+    db_cursor.close()
+    return len(expired)
+
+
+def delete_expired_rows(db_conn, table, oldest_kept_day, batch_size, event_type=None):
+    """Deletes rows older than oldest_kept_day from an unpartitioned table, one batch per transaction.
+
+    For stored_trace_id, event_type limits it to the trace ids of one event table.
+    """
+    db_cursor = db_conn.cursor()
+    deleted = 0
+    condition = 'date_created < %s' + (' AND event_type = %s' if event_type is not None else '')
+    params = (oldest_kept_day,) + ((event_type,) if event_type is not None else ())
+    while True:
+        db_cursor.execute(f'DELETE FROM {table} WHERE {condition} LIMIT {int(batch_size)}', params)
+        db_conn.commit()
+        deleted += db_cursor.rowcount
+        if db_cursor.rowcount < batch_size:
+            break
+    db_cursor.close()
+    if deleted:
+        logger.info(f"Deleted {deleted} expired rows from {table}")
+    return deleted
@@ -0,0 +1,175 @@
+import time
+import logging
+from queue import Queue, Empty
+from threading import Thread, RLock
+
+logger = logging.getLogger('basicLogger')
+
+
+class PartitionWorker(Thread):
+    """Batches and stores the messages of the partitions assigned to it, in offset order."""
+
+    def __init__(self, pool, name):
+        super().__init__(name=name, daemon=True)
+        self.pool = pool
+        # Bounded, so a worker that falls behind blocks the consumer rather than buffering the topic in memory
+        self.queue = Queue(maxsize=pool.queue_size)
+
+    def run(self):
+        session = self.pool.session_factory()
+        batch = []
+        batch_started = None
+        while True:
+            timeout = None if batch_started is None else max(0, batch_started + self.pool.max_linger_sec - time.time())
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+                if batch_started is None:
+                    batch_started = time.time()
+            except Empty:
+                pass
+
+            if batch and (len(batch) >= self.pool.max_batch_size or
+                          time.time() - batch_started >= self.pool.max_linger_sec):
+                session = self.flush(session, batch, batch_started)
+                batch = []
+                batch_started = None
+
+    def flush(self, session, batch, batch_started):
+        """Stores a batch, skipping any rows the DB keeps rejecting, then marks its offsets as committable."""
+        # Rows are stamped with date_created when decoded, so the watermark waits for their commit
+        with self.pool.ingest_watermark.writing():
+            rows = {}
+            traces = []
+            last_offsets = {}
+            for partition_id, generation, msg, consumed_at in batch:
+                # Messages from a revoked partition are redelivered to its new owner
+                if not self.pool.is_current(partition_id, generation):
+                    continue
+                decoded = self.pool.decode_message(msg, consumed_at)
+                if decoded is not None:
+                    event_type, row, trace = decoded
+                    rows.setdefault(event_type, []).append(row)
+                    if trace is not None:
+                        traces.append(trace)
+                last_offsets[partition_id] = (generation, msg.offset)
+
+            batch_size = sum(len(type_rows) for type_rows in rows.values())
+            flush_started = time.time()
+            if batch_size:
+                session = self.store(session, rows, traces, self.pool.max_attempts)
+
+        self.pool.mark_stored(last_offsets)
+
+        flushed = time.time()
+        logger.info("%s stored batch of %d events (%s) in %.1f ms, %.1f ms after the first event, %.0f rows/s" %
+                    (self.name, batch_size,
+                     ", ".join(f"{len(type_rows)} {event_type}" for event_type, type_rows in rows.items()),
+                     (flushed - flush_started) * 1000, (flushed - batch_started) * 1000,
+                     batch_size / max(flushed - flush_started, 1e-6)))
+        return session
+
+    def store(self, session, rows, traces, attempts):
+        """Stores rows, splitting them in half while the DB keeps rejecting them.
+
+        A single row the DB still rejects is skipped, so one bad event doesn't stall its partitions.
+        """
+        session, error = self.try_store(session, rows, traces, attempts)
+        if error is None:
+            return session
+        events = [(event_type, row) for event_type, type_rows in rows.items() for row in type_rows]
+        if len(events) == 1:
+            self.pool.on_skipped(rows, error)
+            return session
+        for half in (events[:len(events) // 2], events[len(events) // 2:]):
+            half_rows = {}
+            for event_type, row in half:
+                half_rows.setdefault(event_type, []).append(row)
+            trace_ids = {row['trace_id'] for event_type, row in half}
+            session = self.store(session, half_rows, [trace for trace in traces if trace['trace_id'] in trace_ids], 1)
+        return session
+
+    def try_store(self, session, rows, traces, attempts):
+        """Returns the session and None once rows are stored, or the error once the DB rejected them attempts times.
+
+        Errors is_permanent doesn't recognise, like a lost connection, are retried until they clear.
+        """
+        batch_size = sum(len(type_rows) for type_rows in rows.values())
+        rejections = 0
+        while True:
+            try:
+                self.pool.store_batch(session, rows, traces)
+                return session, None
+            except Exception as e:
+                session.close()
+                session = self.pool.session_factory()
+                if self.pool.is_permanent(e):
+                    rejections += 1
+                    if rejections >= attempts:
+                        logger.error(f"{self.name} DB rejected batch of {batch_size} events {rejections} times: {str(e)}")
+                        return session, e
+                logger.error(f"{self.name} error storing batch of {batch_size} events, retrying: {str(e)}")
+                time.sleep(self.pool.retry_interval_sec)
+
+
+class PartitionWorkerPool:
+    """Spreads partitions over a fixed number of workers and tracks which offsets are safe to commit.
+
+    Each partition is always handled by the same worker, so its messages are stored, and its offsets
+    become committable, in order. Revoking a partition bumps its generation, which discards its
+    queued messages and any stored offsets that were not committed yet.
+
+    Rows the DB rejects max_attempts times with an error is_permanent recognises are handed to
+    on_skipped, and their offsets become committable like stored ones.
+    """
+
+    def __init__(self, num_workers, max_batch_size, max_linger_sec, retry_interval_sec,
+                 session_factory, decode_message, store_batch, ingest_watermark,
+                 queue_size, max_attempts, is_permanent, on_skipped):
+        self.max_batch_size = max_batch_size
+        self.max_linger_sec = max_linger_sec
+        self.retry_interval_sec = retry_interval_sec
+        self.session_factory = session_factory
+        self.decode_message = decode_message
+        self.store_batch = store_batch
+        self.ingest_watermark = ingest_watermark
+        self.queue_size = queue_size
+        self.max_attempts = max_attempts
+        self.is_permanent = is_permanent
+        self.on_skipped = on_skipped
+        self.workers = [PartitionWorker(self, f"partition-worker-{i}") for i in range(num_workers)]
+        self.generations = {}
+        self.committable = {}
+        self.lock = RLock()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, msg):
+        """Queues a message for its partition's worker, blocking while that worker's queue is full."""
+        with self.lock:
+            generation = self.generations.get(msg.partition_id, 0)
+        self.workers[msg.partition_id % len(self.workers)].queue.put((msg.partition_id, generation, msg, time.time()))
+
+    def is_current(self, partition_id, generation):
+        with self.lock:
+            return self.generations.get(partition_id, 0) == generation
+
+    def revoke(self, partition_ids):
+        with self.lock:
+            for partition_id in partition_ids:
+                self.generations[partition_id] = self.generations.get(partition_id, 0) + 1
+                self.committable.pop(partition_id, None)
+
+    def mark_stored(self, last_offsets):
+        with self.lock:
+            for partition_id, (generation, offset) in last_offsets.items():
+                if self.generations.get(partition_id, 0) == generation:
+                    self.committable[partition_id] = max(offset, self.committable.get(partition_id, -1))
+
+    def take_committable(self):
+        """Returns the last stored offset of each partition that has not been committed yet."""
+        with self.lock:
+            committable = self.committable
+            self.committable = {}
+            return committable
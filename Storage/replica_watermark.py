@@ -0,0 +1,10 @@
+from base import Base, PreciseDateTime
+from sqlalchemy import Column, String
+
+class ReplicaWatermark(Base):
+    """The ingest watermark each Storage replica writing to the DB last published, and when it did."""
+    __tablename__ = 'replica_watermark'
+
+    replica_id = Column(String(36), primary_key=True)
+    watermark = Column(PreciseDateTime, nullable=False)
+    updated = Column(PreciseDateTime, nullable=False)
@@ -0,0 +1,117 @@
+import json
+import datetime
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+
+
+class IngestWatermark:
+    """Tracks the date_created before which every row has been committed.
+
+    Rows get their date_created when they are decoded, so while no write is in flight every
+    row before now is committed; otherwise the watermark is the start of the oldest write.
+    Other replicas writing to the same DB hold it back to the floor of their published watermarks,
+    which is the oldest possible until it is first raised.
+    """
+
+    def __init__(self):
+        self.in_flight = {}
+        self.tokens = itertools.count()
+        self.floor = datetime.datetime.min
+        self.lock = Lock()
+
+    @contextmanager
+    def writing(self):
+        """Wraps creating and committing rows, holding the watermark back until they are committed."""
+        with self.lock:
+            token = next(self.tokens)
+            self.in_flight[token] = datetime.datetime.now()
+        try:
+            yield
+        finally:
+            with self.lock:
+                del self.in_flight[token]
+
+    def local_value(self):
+        """Returns the watermark of this replica's own writes, for the other replicas."""
+        with self.lock:
+            # Taken under the lock, so a write that starts afterwards can't create rows before it
+            now = datetime.datetime.now()
+            return min(self.in_flight.values(), default=now)
+
+    def raise_floor(self, floor):
+        """Sets the oldest watermark the replicas published; each only moves forward, so it stays a lower bound."""
+        with self.lock:
+            self.floor = max(self.floor, floor)
+
+    def value(self):
+        with self.lock:
+            now = datetime.datetime.now()
+            return min(min(self.in_flight.values(), default=now), self.floor)
+
+
+class ResultCache:
+    """LRU cache of query results keyed by (table, ...), bounded by their total serialized size.
+
+    Results are only cached for windows that can no longer change, so entries never go stale,
+    except when retention deletes rows, which invalidates the table.
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def generation(self, table):
+        """Returns the table's generation, to pass to put() along with a result queried after this call."""
+        with self.lock:
+            return self.generations.get(table, 0)
+
+    def put(self, key, value, generation):
+        """Caches a result, unless its table was invalidated since the result's generation was taken."""
+        size = len(json.dumps(value, default=str))
+        if size > self.max_entry_bytes:
+            return
+        with self.lock:
+            if self.generations.get(key[0], 0) != generation:
+                return
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def invalidate(self, table):
+        """Drops a table's results, including any being queried now."""
+        with self.lock:
+            self.generations[table] = self.generations.get(table, 0) + 1
+            for key in [key for key in self.entries if key[0] == table]:
+                self.size -= self.entries.pop(key)[1]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0
+            }
@@ -1,17 +1,23 @@
-from base import Base
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from base import Base, PreciseDateTime
+from sqlalchemy import Column, Integer, String, Float, Index
 from datetime import datetime
 
 class SensorData(Base):
     __tablename__ = 'sensor_data'
+    __table_args__ = (
+        Index('sensor_data_date_created_idx', 'date_created', 'id'),
+        Index('sensor_data_trace_id_idx', 'trace_id', unique=True),
+        Index('sensor_data_timestamp_idx', 'timestamp'),
+        Index('sensor_data_sensor_timestamp_idx', 'sensor_id', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
-    sensor_id = Column(String(36), nullable=False)
+    sensor_id = Column(String(250), nullable=False)
     temperature = Column(Float, nullable=False)
-    timestamp = Column(DateTime, nullable=False)  
-    location = Column(String(255), nullable=True)
-    trace_id = Column(String(36), nullable=True)
-    date_created = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(PreciseDateTime, nullable=False)  
+    location = Column(String(250), nullable=False)
+    trace_id = Column(String(100), nullable=False)
+    date_created = Column(PreciseDateTime, nullable=False, default=datetime.now)
 
     def to_dict(self):
         return {
@@ -0,0 +1,35 @@
+from base import Base, PreciseDateTime
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index
+from datetime import datetime
+
+class SensorRollup(Base):
+    __tablename__ = 'sensor_rollup'
+    __table_args__ = (
+        Index('sensor_rollup_sensor_idx', 'bucket', 'sensor_id', 'bucket_start'),
+    )
+
+    bucket = Column(String(10), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    sensor_id = Column(String(250), primary_key=True)
+    location = Column(String(250), primary_key=True)
+    count = Column(Integer, nullable=False)
+    min_temperature = Column(Float, nullable=False)
+    max_temperature = Column(Float, nullable=False)
+    sum_temperature = Column(Float(53), nullable=False)
+    last_temperature = Column(Float, nullable=False)
+    last_timestamp = Column(PreciseDateTime, nullable=False)
+
+    def to_dict(self):
+        return {
+            'bucket': self.bucket,
+            'bucket_start': self.bucket_start.isoformat() if isinstance(self.bucket_start, datetime) else self.bucket_start,
+            'sensor_id': self.sensor_id,
+            'location': self.location,
+            'count': self.count,
+            'min_temperature': self.min_temperature,
+            'max_temperature': self.max_temperature,
+            'avg_temperature': self.sum_temperature / self.count,
+            'sum_temperature': self.sum_temperature,
+            'last_temperature': self.last_temperature,
+            'last_timestamp': self.last_timestamp.isoformat() if isinstance(self.last_timestamp, datetime) else self.last_timestamp
+        }
@@ -0,0 +1,13 @@
+from base import Base, PreciseDateTime
+from sqlalchemy import Column, String, Index
+
+class StoredTraceId(Base):
+    """Trace ids of the events in day-partitioned tables, whose unique keys have to include date_created."""
+    __tablename__ = 'stored_trace_id'
+    __table_args__ = (
+        Index('stored_trace_id_date_created_idx', 'event_type', 'date_created'),
+    )
+
+    trace_id = Column(String(100), primary_key=True)
+    event_type = Column(String(20), nullable=False)
+    date_created = Column(PreciseDateTime, nullable=False)
@@ -0,0 +1,19 @@
+from base import Base
+from sqlalchemy import Column, Integer, String, BigInteger, DateTime
+
+class TraceDigest(Base):
+    """Per-type, per-hour count and digest (sum of trace id hashes modulo 2^62) of the stored events."""
+    __tablename__ = 'trace_digest'
+
+    event_type = Column(String(20), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False)
+    digest = Column(BigInteger, nullable=False)
+
+    def to_dict(self):
+        return {
+            'event_type': self.event_type,
+            'bucket_start': self.bucket_start.isoformat(),
+            'count': self.count,
+            'digest': self.digest
+        }
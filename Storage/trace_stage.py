@@ -0,0 +1,41 @@
+from base import Base, PreciseDateTime
+from sqlalchemy import Column, String, Float, Index
+
+# Stages in pipeline order, each recorded as Unix seconds
+TRACE_STAGES = ['received', 'produced', 'consumed', 'committed', 'picked_up']
+# Time spent between consecutive stages, from Receiver's outbox to Processing's poll interval
+STAGE_LATENCIES = ['receiver_queue', 'kafka', 'storage_commit', 'processing_poll', 'end_to_end']
+
+class TraceStage(Base):
+    __tablename__ = 'trace_stage'
+    __table_args__ = (
+        Index('trace_stage_date_created_idx', 'date_created'),
+    )
+
+    trace_id = Column(String(100), primary_key=True)
+    event_type = Column(String(20), nullable=False)
+    date_created = Column(PreciseDateTime, nullable=False)
+    received = Column(Float(53), nullable=False)
+    produced = Column(Float(53), nullable=False)
+    consumed = Column(Float(53), nullable=False)
+    committed = Column(Float(53), nullable=False)
+    picked_up = Column(Float(53), nullable=True)
+
+    def stage_latencies(self):
+        """Returns the seconds spent between consecutive stages, and end to end."""
+        last_stage = self.picked_up if self.picked_up is not None else self.committed
+        return {
+            'receiver_queue': self.produced - self.received,
+            'kafka': self.consumed - self.produced,
+            'storage_commit': self.committed - self.consumed,
+            'processing_poll': self.picked_up - self.committed if self.picked_up is not None else None,
+            'end_to_end': last_stage - self.received
+        }
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'event_type': self.event_type,
+            'stages': {stage: getattr(self, stage) for stage in TRACE_STAGES},
+            'latencies': self.stage_latencies()
+        }
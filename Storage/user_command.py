@@ -1,17 +1,22 @@
-from base import Base
-from sqlalchemy import Column, Integer, String, Float, DateTime
+from base import Base, PreciseDateTime
+from sqlalchemy import Column, Integer, String, Float, Index
 from datetime import datetime
 
 class UserCommand(Base):
     __tablename__ = 'user_command'
+    __table_args__ = (
+        Index('user_command_date_created_idx', 'date_created', 'id'),
+        Index('user_command_trace_id_idx', 'trace_id', unique=True),
+        Index('user_command_timestamp_idx', 'timestamp'),
+    )
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(String(36), nullable=False)
-    target_device = Column(String(255), nullable=False)
+    user_id = Column(String(250), nullable=False)
+    target_device = Column(String(250), nullable=False)
     target_temperature = Column(Float, nullable=False)
-    timestamp = Column(DateTime, nullable=False)  
-    trace_id = Column(String(36), nullable=True)
-    date_created = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(PreciseDateTime, nullable=False)  
+    trace_id = Column(String(100), nullable=False)
+    date_created = Column(PreciseDateTime, nullable=False, default=datetime.now)
 
     def to_dict(self):
         return {
@@ -0,0 +1,101 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Benchmarks'))
+import fake_kafka  # noqa: E402
+
+READING = {"sensorId": "sensor-1", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen",
+           "trace_id": "trace-1"}
+
+
+@pytest.fixture
+def analyzer(service_loader):
+    analyzer = service_loader('Analyzer')
+    # The benchmark's in-memory topic reads offsets the way pykafka does, with -1 meaning OffsetType.LATEST
+    topic = fake_kafka.Topic('events', 2)
+    analyzer.get_kafka_topic = lambda: topic
+    return analyzer
+
+
+def produce(analyzer, event_type, payload):
+    """Appends an event to the topic and indexes it, as the tail consumer does."""
+    raw = analyzer.event_envelope.encode(event_type, datetime(2024, 9, 19, 10), payload)
+    msg = analyzer.get_kafka_topic().append(raw)
+    return analyzer.event_index.add(event_type, msg.partition_id, msg.offset)
+
+
+def test_reads_the_first_event_of_a_partition(analyzer):
+    assert produce(analyzer, 'sensor_data', READING) == 0
+    assert analyzer.event_index.lookup('sensor_data', 0) == (0, 0)
+    response = analyzer.app.test_client().get('/sensor_data', params={"index": 0})
+    assert response.status_code == 200
+    assert response.json()['trace_id'] == 'trace-1'
+
+
+def test_pages_follow_the_index_across_partitions(analyzer):
+    for i in range(3):
+        produce(analyzer, 'sensor_data', dict(READING, trace_id=f"trace-{i}"))
+    client = analyzer.app.test_client()
+    first = client.get('/events', params={"type": "sensor_data", "limit": 2}).json()
+    assert [event['trace_id'] for event in first['events']] == ['trace-0', 'trace-1']
+    second = client.get('/events', params={"type": "sensor_data", "cursor": first['next_cursor']}).json()
+    assert [event['trace_id'] for event in second['events']] == ['trace-2']
+    assert second['next_cursor'] is None
+    assert client.get('/events', params={"type": "user_command", "cursor": first['next_cursor']}).status_code == 400
+
+
+def read(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def test_saves_append_only_the_entries_added_since_the_last_save(analyzer, tmp_path):
+    filename = str(tmp_path / 'event_index.bin')
+    index = analyzer.EventIndex(filename)
+    for offset in range(3):
+        index.add('sensor_data', 0, offset)
+    index.save()
+    first = read(filename)
+
+    index.add('sensor_data', 0, 3)
+    index.add('user_command', 1, 0)
+    index.mark_consumed(1, 1)
+    index.save()
+    data = read(filename)
+    assert data.startswith(first)
+    # Per type: name length (2), entry count (8), name, then one partition id (2) and offset (8)
+    assert len(data) - len(first) == sum(2 + 8 + len(name) + 2 + 8 for name in ('sensor_data', 'user_command'))
+
+    restored = analyzer.EventIndex(filename)
+    assert restored.load()
+    assert [restored.lookup('sensor_data', i) for i in range(4)] == [(0, 0), (0, 1), (0, 2), (0, 3)]
+    assert restored.lookup('user_command', 0) == (1, 0)
+    assert restored.last_offsets == {0: 3, 1: 1}
+
+
+def test_entries_of_an_unfinished_save_are_discarded(analyzer, tmp_path):
+    filename = str(tmp_path / 'event_index.bin')
+    index = analyzer.EventIndex(filename)
+    index.add('sensor_data', 0, 0)
+    index.save()
+    sidecar = read(index.sidecar_filename)
+    # A save that appended its entries and stopped before replacing the sidecar
+    index.add('sensor_data', 0, 1)
+    index.save()
+    with open(index.sidecar_filename, 'wb') as f:
+        f.write(sidecar)
+
+    restored = analyzer.EventIndex(filename)
+    assert restored.load()
+    assert restored.count('sensor_data') == 1
+    assert restored.last_offsets == {0: 0}
+    # The tail consumer resumes after offset 0 and indexes offset 1 again, once
+    restored.add('sensor_data', 0, 1)
+    restored.add('sensor_data', 0, 2)
+    restored.save()
+    reloaded = analyzer.EventIndex(filename)
+    assert reloaded.load()
+    assert [reloaded.lookup('sensor_data', i) for i in range(reloaded.count('sensor_data'))] == [(0, 0), (0, 1), (0, 2)]
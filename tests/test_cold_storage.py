@@ -0,0 +1,131 @@
+import datetime
+import json
+
+import pytest
+
+WINDOW = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": "2100-01-01T00:00:00"}
+TODAY = datetime.date.today()
+# Five rows on the two days before today are exported, and the two from today stay in the DB
+CREATED = [datetime.datetime.combine(TODAY - datetime.timedelta(days=days), datetime.time(hour))
+           for days, hour in [(2, 10), (2, 11), (2, 12), (1, 10), (1, 11), (0, 0), (0, 1)]]
+
+
+@pytest.fixture(scope='module')
+def storage(service_loader):
+    def enable_cold_storage(app_config):
+        app_config['cold_storage']['export_after_days'] = 1
+
+    storage = service_loader('Storage', enable_cold_storage)
+    storage.init_database()
+    # Pruning drops partitions or deletes with MySQL syntax, so the exported days are deleted through the ORM
+    storage.prune_rows = lambda db_conn, table, oldest_kept_day: delete_rows_before(storage, oldest_kept_day)
+    rows = []
+    for i, date_created in enumerate(CREATED):
+        row = storage.sensor_data_row({"sensorId": f"sensor-{i}", "temperature": 20.0 + i,
+                                       "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen"})
+        rows.append(dict(row, date_created=date_created))
+    session = storage.DB_SESSION()
+    try:
+        storage.store_batch(session, {'sensor_data': rows})
+    finally:
+        session.close()
+    storage.export_closed_days(storage.SensorData, TODAY)
+    return storage
+
+
+def delete_rows_before(storage, oldest_kept_day):
+    session = storage.DB_SESSION()
+    try:
+        session.query(storage.SensorData).filter(
+            storage.SensorData.date_created < datetime.datetime.combine(oldest_kept_day, datetime.time())).delete()
+        session.commit()
+    finally:
+        session.close()
+
+
+def sensor_ids(rows):
+    return [row['sensor_id'] for row in rows]
+
+
+def test_exports_closed_days_and_prunes_them_from_the_db(storage):
+    session = storage.DB_SESSION()
+    try:
+        assert session.query(storage.SensorData).count() == 2
+    finally:
+        session.close()
+    stats = storage.app.test_client().get('/cold/stats').json()
+    assert stats['sensor_data']['exported_until'] == TODAY.isoformat()
+    assert (stats['sensor_data']['days'], stats['sensor_data']['rows']) == (2, 5)
+
+
+def test_readings_merge_cold_and_hot_rows(storage):
+    client = storage.app.test_client()
+    response = client.get('/sensor-data', params=WINDOW)
+    assert response.status_code == 200
+    assert sensor_ids(response.json()) == [f"sensor-{i}" for i in range(7)]
+
+    ndjson = client.get('/sensor-data', params=dict(WINDOW, format='ndjson'))
+    assert sensor_ids(json.loads(line) for line in ndjson.text.splitlines()) == [f"sensor-{i}" for i in range(7)]
+
+
+def test_pages_cross_from_cold_to_hot_rows(storage):
+    client = storage.app.test_client()
+    pages = []
+    params = dict(WINDOW, limit=3)
+    while True:
+        response = client.get('/sensor-data', params=params)
+        assert response.status_code == 200
+        pages.append(sensor_ids(response.json()))
+        if 'x-next-cursor' not in response.headers:
+            break
+        params['cursor'] = response.headers['x-next-cursor']
+    assert pages == [['sensor-0', 'sensor-1', 'sensor-2'], ['sensor-3', 'sensor-4', 'sensor-5'], ['sensor-6']]
+
+
+def test_window_stats_include_cold_rows(storage):
+    response = storage.app.test_client().get('/stats/window', params=dict(WINDOW, event_type='sensor_data',
+                                                                          detail=True))
+    assert response.status_code == 200
+    stats = response.json()['sensor_data']
+    assert (stats['count'], stats['min'], stats['max'], stats['sum']) == (7, 20.0, 26.0, sum(20.0 + i for i in range(7)))
+    assert sum(count for temperature, count in stats['temperature_histogram']) == 7
+    assert sorted(sensor['sensor_id'] for sensor in stats['sensors']) == [f"sensor-{i}" for i in range(7)]
+
+
+def test_window_detail_pages_cross_from_cold_to_hot_rows(storage):
+    client = storage.app.test_client()
+    pages = []
+    params = dict(WINDOW, event_type='sensor_data', detail=True, sensor_limit=3)
+    while True:
+        stats = client.get('/stats/window', params=params).json()['sensor_data']
+        pages.append([sensor['sensor_id'] for sensor in stats['sensors']])
+        if 'next_sensor_cursor' not in stats:
+            break
+        params['sensor_cursor'] = stats['next_sensor_cursor']
+    assert pages == [['sensor-0', 'sensor-1', 'sensor-2'], ['sensor-3', 'sensor-4', 'sensor-5'], ['sensor-6']]
+
+
+def test_ndjson_pages_stream_cold_rows_up_to_the_limit(storage):
+    client = storage.app.test_client()
+    pages = []
+    params = dict(WINDOW, format='ndjson', limit=2)
+    while True:
+        lines = [json.loads(line) for line in client.get('/sensor-data', params=params).text.splitlines()]
+        if lines and 'next_cursor' in lines[-1]:
+            params['cursor'] = lines.pop()['next_cursor']
+            pages.append(sensor_ids(lines))
+        else:
+            pages.append(sensor_ids(lines))
+            break
+    assert pages == [['sensor-0', 'sensor-1'], ['sensor-2', 'sensor-3'], ['sensor-4', 'sensor-5'], ['sensor-6']]
+
+
+def test_cold_rows_are_read_lazily_in_order(storage):
+    window = (datetime.datetime(2000, 1, 1), datetime.datetime.combine(TODAY, datetime.time()))
+    rows = storage.cold_store.read_window('sensor_data', *window, limit=3)
+    assert not isinstance(rows, list)
+    first = next(rows)
+    assert first['sensor_id'] == 'sensor-0'
+    after = (datetime.datetime.fromisoformat(first['date_created']), first['id'])
+    assert sensor_ids(storage.cold_store.read_window('sensor_data', *window, after=after)) == \
+        ['sensor-1', 'sensor-2', 'sensor-3', 'sensor-4']
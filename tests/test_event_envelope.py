@@ -0,0 +1,64 @@
+import os
+import time
+from datetime import datetime
+from collections import namedtuple
+
+import pytest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+Message = namedtuple('Message', ['partition_id', 'offset', 'value'])
+
+EVENT_TIME = datetime(2024, 9, 19, 10, 0, 0)
+READING = {"sensorId": "sensor-1", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen",
+           "trace_id": "trace-1"}
+
+
+@pytest.fixture(scope='module')
+def storage(service_loader):
+    return service_loader('Storage')
+
+
+def test_services_share_one_envelope_format():
+    copies = set()
+    for service in ('Receiver', 'Storage', 'Analyzer'):
+        with open(os.path.join(ROOT_DIR, service, 'event_envelope.py'), 'rb') as f:
+            copies.add(f.read())
+    assert len(copies) == 1
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_both_formats_round_trip(storage, binary):
+    envelope = storage.event_envelope
+    raw = envelope.encode('sensor_data', EVENT_TIME, READING, binary=binary)
+    assert envelope.is_binary(raw) == binary
+    assert envelope.read_type(raw) == 'sensor_data'
+    assert envelope.read_header(raw) == ('sensor_data', EVENT_TIME.timestamp())
+    assert envelope.decode_payload(raw) == READING
+    assert envelope.decode(raw) == {"type": "sensor_data", "datetime": "2024-09-19T10:00:00", "payload": READING}
+
+
+def test_binary_header_is_read_without_the_payload(storage):
+    envelope = storage.event_envelope
+    raw = envelope.encode('user_command', EVENT_TIME, {"userId": "user-1"})
+    header = raw[:envelope.HEADER.size]
+    assert envelope.read_type(header) == 'user_command'
+    assert envelope.read_header(header) == ('user_command', EVENT_TIME.timestamp())
+    assert len(raw) < len(envelope.encode('user_command', EVENT_TIME, {"userId": "user-1"}, binary=False))
+
+
+def test_storage_decodes_legacy_json_messages(storage):
+    raw = storage.event_envelope.encode('sensor_data', EVENT_TIME, READING, binary=False)
+    event_type, row, trace = storage.decode_message(Message(0, 0, raw), time.time())
+    assert event_type == 'sensor_data'
+    assert (row['sensor_id'], row['trace_id'], row['timestamp']) == ('sensor-1', 'trace-1', EVENT_TIME)
+    # Legacy messages are never traced
+    assert trace is None
+
+
+def test_storage_reads_the_stage_times_of_traced_messages(storage):
+    envelope = storage.event_envelope
+    raw = envelope.stamp_produced(envelope.encode('sensor_data', EVENT_TIME, READING, received=100.0), 101.0)
+    event_type, row, trace = storage.decode_message(Message(0, 0, raw), 102.0)
+    assert row['trace_id'] == 'trace-1'
+    assert (trace['received'], trace['produced'], trace['consumed']) == (100.0, 101.0, 102.0)
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Benchmarks'))
+import fake_kafka  # noqa: E402
+
+
+def wait_for(condition, timeout_sec=5):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_ready_once_kafka_connects_and_again_after_it_is_lost(service_loader):
+    def configure(app_config):
+        app_config['connections']['initial_backoff_sec'] = 0.01
+        app_config['connections']['max_backoff_sec'] = 0.02
+
+    receiver = service_loader('Receiver', configure)
+    client = receiver.app.test_client()
+    # The service serves straight away, and is live but not ready until Kafka connects
+    assert client.get('/health/live').status_code == 200
+    response = client.get('/health/ready')
+    assert response.status_code == 503
+    assert response.json() == {"status": "not ready", "dependencies": {"kafka": "Not connected yet"}}
+
+    topic = fake_kafka.Topic('events', 2)
+    attempts = []
+
+    def connect():
+        attempts.append(time.monotonic())
+        if len(attempts) < 3:
+            raise ConnectionError("broker down")
+        return topic.get_producer(delivery_reports=True)
+
+    receiver.kafka_producer.connect = connect
+    receiver.kafka_producer.start()
+    wait_for(lambda: client.get('/health/ready').status_code == 200)
+    assert len(attempts) == 3
+    assert client.get('/health/ready').json() == {"status": "ready", "dependencies": {"kafka": "ready"}}
+
+    # A failure reported by code using the producer makes it reconnect in the background
+    receiver.kafka_producer.reset(receiver.kafka_producer.get(), ConnectionError("lost"))
+    wait_for(lambda: len(attempts) == 4 and client.get('/health/ready').status_code == 200)
+
+
+def test_backoff_doubles_up_to_the_maximum_with_jitter(service_loader):
+    health = service_loader('Receiver').health
+    delays = health.backoff_delays(1, 8)
+    for ceiling in [1, 2, 4, 8, 8, 8]:
+        assert 0 <= next(delays) <= ceiling
+    assert len({next(delays) for _ in range(10)}) > 1
@@ -0,0 +1,72 @@
+import os
+import sys
+import asyncio
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Processing'))
+from live_updates import Broadcaster, encode_event, KEEPALIVE  # noqa: E402
+
+
+def stream(broadcaster, *actions):
+    """Connects a client to the stream, runs each action while it's connected, and returns the bodies it was sent."""
+    async def run():
+        sent = []
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        client = asyncio.ensure_future(broadcaster.stream(receive, send))
+        await asyncio.sleep(0.05)
+        for action in actions:
+            action()
+            await asyncio.sleep(0.05)
+        disconnected.set()
+        await client
+        assert sent[0]['headers'][0] == (b'content-type', b'text/event-stream')
+        return [message['body'] for message in sent[1:]]
+
+    return asyncio.run(run())
+
+
+def test_clients_start_from_the_latest_state_and_then_get_deltas():
+    broadcaster = Broadcaster()
+    broadcaster.publish('stats', {"max_temperature": 21.0}, latest={"max_temperature": 21.0, "num_user_commands": 1})
+
+    # Stats are published from the scheduler's threads rather than the event loop
+    def publish_delta():
+        thread = Thread(target=broadcaster.publish,
+                        args=('stats', {"num_user_commands": 2}, {"max_temperature": 21.0, "num_user_commands": 2}))
+        thread.start()
+        thread.join()
+
+    bodies = stream(broadcaster, publish_delta)
+    assert bodies == [encode_event('stats', {"max_temperature": 21.0, "num_user_commands": 1}),
+                      encode_event('stats', {"num_user_commands": 2})]
+    assert broadcaster.clients == 0
+
+    # A client connecting now starts from the full state, not from the delta
+    assert stream(broadcaster)[0] == encode_event('stats', {"max_temperature": 21.0, "num_user_commands": 2})
+
+
+def test_clients_too_far_behind_get_the_latest_of_each_event():
+    broadcaster = Broadcaster(history_size=2)
+
+    def publish_burst():
+        broadcaster.publish('sensor_data', {"index": 1})
+        broadcaster.publish('stats', {"num_user_commands": 2}, latest={"num_user_commands": 2})
+        broadcaster.publish('sensor_data', {"index": 2})
+
+    bodies = stream(broadcaster, publish_burst)
+    assert bodies == [KEEPALIVE, encode_event('sensor_data', {"index": 2}) +
+                      encode_event('stats', {"num_user_commands": 2})]
+
+
+def test_idle_streams_are_kept_alive():
+    bodies = stream(Broadcaster(keepalive_sec=0.01), lambda: None)
+    assert len(bodies) > 2
+    assert set(bodies) == {KEEPALIVE}
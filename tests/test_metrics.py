@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.mark.parametrize('service', ['Receiver', 'Storage', 'Processing', 'Analyzer'])
+def test_metrics_endpoint(service_loader, service):
+    module = service_loader(service)
+    response = module.app.test_client().get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert '# TYPE ' in response.text
@@ -0,0 +1,76 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Storage'))
+import migrations  # noqa: E402
+
+
+class MySQLCursor:
+    """Answers the information_schema lookups of a MySQL schema that a failed migration left half done."""
+
+    def __init__(self, version, indexes, datetime_tables, digested):
+        self.version = version
+        self.indexes = set(indexes)
+        self.datetime_tables = set(datetime_tables)
+        self.digested = set(digested)
+        self.executed = []
+        self.result = None
+
+    def execute(self, statement, params=()):
+        statement = ' '.join(statement.split())
+        if statement.startswith('SELECT MAX(version)'):
+            self.result = (self.version,)
+        elif 'information_schema.STATISTICS' in statement:
+            self.result = (int(params[1] in self.indexes),)
+        elif 'information_schema.COLUMNS' in statement:
+            self.result = ('datetime' if params[0] in self.datetime_tables else 'varchar',)
+        elif statement.startswith('SELECT COUNT(*) FROM trace_digest'):
+            self.result = (int(params[0] in self.digested),)
+        elif not statement.startswith('CREATE TABLE IF NOT EXISTS schema_version'):
+            self.executed.append(statement)
+
+    def fetchone(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class MySQLConnection:
+    def __init__(self, db_cursor):
+        self.db_cursor = db_cursor
+
+    def cursor(self):
+        return self.db_cursor
+
+    def commit(self):
+        pass
+
+
+def migrate(**schema):
+    db_cursor = MySQLCursor(**schema)
+    migrations.migrate(MySQLConnection(db_cursor))
+    return db_cursor.executed
+
+
+def test_rerun_skips_the_steps_a_failed_migration_applied():
+    executed = migrate(version=2, indexes={'sensor_data_date_created_idx', 'sensor_data_trace_id_idx'},
+                       datetime_tables=set(), digested={'sensor_data'})
+    created = [statement.split(' ON ')[0].split()[-1] for statement in executed
+               if statement.startswith(('CREATE INDEX', 'CREATE UNIQUE INDEX'))]
+    assert created == ['sensor_data_sensor_timestamp_idx', 'user_command_date_created_idx',
+                       'user_command_trace_id_idx', 'sensor_rollup_sensor_idx', 'trace_stage_date_created_idx',
+                       'sensor_data_timestamp_idx', 'user_command_timestamp_idx', 'stored_trace_id_date_created_idx']
+    digests = [statement for statement in executed if statement.startswith('INSERT INTO trace_digest')]
+    assert len(digests) == 1 and "SELECT 'user_command'" in digests[0]
+    versions = [statement for statement in executed if statement.startswith('INSERT INTO schema_version')]
+    assert len(versions) == len(migrations.MIGRATIONS) - 2
+
+
+def test_timestamps_are_converted_only_in_tables_still_storing_strings():
+    executed = migrate(version=1, indexes=set(), datetime_tables={'sensor_data'}, digested=set())
+    converted = [statement.split()[1] for statement in executed if statement.startswith('UPDATE ')]
+    altered = [statement.split()[2] for statement in executed if statement.startswith('ALTER TABLE ')]
+    assert converted == altered == ['user_command']
+    update = next(statement for statement in executed if statement.startswith('UPDATE '))
+    assert "CONVERT_TZ(" in update and "RIGHT(timestamp, 6), '+00:00')" in update
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+from threading import Thread, Event
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Storage'))
+from partition_workers import PartitionWorkerPool  # noqa: E402
+from result_cache import IngestWatermark  # noqa: E402
+
+Message = namedtuple('Message', ['partition_id', 'offset', 'value'])
+
+
+class Session:
+    def close(self):
+        pass
+
+
+class Store:
+    """Stands in for store_batch, rejecting the rows in bad and failing the first transient_failures calls."""
+
+    def __init__(self, bad=(), transient_failures=0, blocked=None):
+        self.bad = set(bad)
+        self.transient_failures = transient_failures
+        self.blocked = blocked
+        self.stored = []
+        self.skipped = []
+
+    def store_batch(self, session, rows, traces=()):
+        if self.blocked is not None:
+            self.blocked.wait()
+        if self.transient_failures:
+            self.transient_failures -= 1
+            raise ConnectionError("lost connection")
+        trace_ids = [row['trace_id'] for type_rows in rows.values() for row in type_rows]
+        if self.bad.intersection(trace_ids):
+            raise ValueError("rejected")
+        self.stored.extend(trace_ids)
+
+    def on_skipped(self, rows, error):
+        self.skipped.extend(row['trace_id'] for type_rows in rows.values() for row in type_rows)
+
+
+def make_pool(store, queue_size=100, max_batch_size=100):
+    pool = PartitionWorkerPool(1, max_batch_size, 0.01, 0, Session,
+                               lambda msg, consumed_at: ('sensor_data', {'trace_id': msg.value}, None),
+                               store.store_batch, IngestWatermark(), queue_size, 3,
+                               lambda error: isinstance(error, ValueError), store.on_skipped)
+    pool.start()
+    return pool
+
+
+def wait_for_offset(pool, partition_id, offset, timeout_sec=5):
+    deadline = time.time() + timeout_sec
+    committed = {}
+    while committed.get(partition_id) != offset:
+        assert time.time() < deadline, f"offset {offset} never became committable"
+        committed.update(pool.take_committable())
+        time.sleep(0.01)
+
+
+def test_skips_rejected_rows_and_commits_past_them():
+    store = Store(bad=['event-5'])
+    pool = make_pool(store)
+    for offset in range(10):
+        pool.submit(Message(0, offset, f"event-{offset}"))
+    wait_for_offset(pool, 0, 9)
+    assert sorted(store.stored) == sorted(f"event-{i}" for i in range(10) if i != 5)
+    assert store.skipped == ['event-5']
+
+
+def test_retries_until_transient_errors_clear():
+    store = Store(transient_failures=5)
+    pool = make_pool(store)
+    for offset in range(3):
+        pool.submit(Message(0, offset, f"event-{offset}"))
+    wait_for_offset(pool, 0, 2)
+    assert sorted(store.stored) == ['event-0', 'event-1', 'event-2']
+    assert store.skipped == []
+
+
+def test_submit_blocks_while_the_worker_queue_is_full():
+    blocked = Event()
+    store = Store(blocked=blocked)
+    pool = make_pool(store, queue_size=2, max_batch_size=1)
+
+    def submit_all():
+        for offset in range(4):
+            pool.submit(Message(0, offset, f"event-{offset}"))
+
+    submitter = Thread(target=submit_all, daemon=True)
+    submitter.start()
+    # The worker holds the first message while it is stuck storing it, and the queue the next two
+    submitter.join(0.3)
+    assert submitter.is_alive()
+
+    blocked.set()
+    submitter.join(5)
+    assert not submitter.is_alive()
+    wait_for_offset(pool, 0, 3)
+    assert store.stored == ['event-0', 'event-1', 'event-2', 'event-3']
@@ -0,0 +1,111 @@
+import json
+import os
+from datetime import datetime, timedelta
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+NOW = datetime.now().replace(microsecond=0)
+LAST_UPDATED = NOW - timedelta(hours=2)
+WATERMARK = NOW - timedelta(hours=1, microseconds=-500)
+
+
+class FakeStorage(BaseHTTPRequestHandler):
+    windows = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == '/cache/stats':
+            body = {"watermark": WATERMARK.isoformat()}
+        elif params['event_type'] == 'user_command':
+            FakeStorage.windows.append((params['start_timestamp'], params['end_timestamp']))
+            body = {"user_command": {"count": 1, "max": 22.0, "min": 22.0, "sum": 22.0}}
+        else:
+            # Two pages of per-sensor aggregates, as Storage returns them past its sensor limit
+            sensor_id = 'sensor-2' if 'sensor_cursor' in params else 'sensor-1'
+            stats = {"count": 2, "max": 21.0, "min": 20.0, "sum": 41.0, "temperature_histogram": [[20.0, 1], [21.0, 1]],
+                     "sensors": [{"sensor_id": sensor_id, "location": "Kitchen", "count": 1, "sum": 20.0}]}
+            if 'sensor_cursor' not in params:
+                stats["next_sensor_cursor"] = "page-2"
+            body = {"sensor_data": stats}
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def processing(service_loader):
+    storage = ThreadingHTTPServer(('127.0.0.1', 0), FakeStorage)
+    Thread(target=storage.serve_forever, daemon=True).start()
+
+    def configure(app_config):
+        app_config['eventstore']['url'] = f"http://127.0.0.1:{storage.server_port}"
+        app_config['tracing']['report_pickup'] = False
+
+    yield service_loader('Processing', configure)
+    storage.shutdown()
+
+
+def test_windows_close_at_the_ingest_watermark(processing):
+    processing.set_stats(dict(processing.current_stats, last_updated=LAST_UPDATED.isoformat()))
+    processing.process_new_events()
+    end = WATERMARK.replace(microsecond=0)
+    assert FakeStorage.windows == [(LAST_UPDATED.isoformat(), end.isoformat())]
+    assert processing.current_stats['last_updated'] == end.isoformat()
+    assert processing.current_stats['num_sensor_data_events'] == 2
+    assert processing.current_stats['num_user_commands'] == 1
+    assert processing.current_sketches['distinct_sensors'].count() == 2
+
+
+def test_unchanged_stats_answer_304(processing):
+    client = processing.app.test_client()
+    response = client.get('/stats')
+    assert response.status_code == 200
+    etag = response.headers['etag']
+    assert client.get('/stats', headers={'If-None-Match': etag}).status_code == 304
+
+    stats = processing.current_stats
+    processing.set_stats(dict(stats, num_user_commands=stats['num_user_commands'] + 1))
+    changed = client.get('/stats', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['etag'] != etag
+    assert changed.json() == processing.current_stats
+
+
+def test_snapshots_replace_the_stats_file(processing):
+    stats = dict(processing.current_stats, max_temperature=30.5)
+    processing.set_stats(stats)
+    processing.snapshot_stats()
+    with open(processing.stats_file, 'r') as f:
+        assert json.load(f) == stats
+    assert not os.path.exists(f"{processing.stats_file}.tmp")
+    with open(processing.sketch_file, 'r') as f:
+        assert json.load(f)['distinct_sensors'] == processing.current_sketches['distinct_sensors'].to_dict()
+
+    # Nothing is written again until the stats change
+    os.remove(processing.stats_file)
+    processing.snapshot_stats()
+    assert not os.path.exists(processing.stats_file)
+
+
+def test_only_changed_stats_are_pushed_to_the_stream(processing):
+    updates = processing.stats_updates
+    version = updates.version
+    later = datetime.fromisoformat(processing.current_stats['last_updated']) + timedelta(seconds=5)
+    processing.set_stats(dict(processing.current_stats, last_updated=later.isoformat()))
+    assert updates.version == version
+
+    stats = processing.current_stats
+    processing.set_stats(dict(stats, max_temperature=stats['max_temperature'] + 1))
+    messages, _ = updates.messages_since(version)
+    delta = {"max_temperature": stats['max_temperature'] + 1}
+    assert messages.decode('utf-8') == f"event: stats\ndata: {json.dumps(delta)}\n\n"
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+VALID = {"sensorId": "sensor-1", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen"}
+
+
+MAX_BYTES = 4096
+
+
+@pytest.fixture(scope='module')
+def client(service_loader):
+    def configure(app_config):
+        app_config['events']['batch']['max_bytes'] = MAX_BYTES
+
+    # Accepted events wait in the outbox, as no producer runs
+    return service_loader('Receiver', configure).app.test_client()
+
+
+def test_rejects_items_that_do_not_match_the_event_schema(client):
+    items = [VALID,
+             dict(VALID, temperature="hot"),
+             dict(VALID, timestamp="nope"),
+             {key: value for key, value in VALID.items() if key != 'location'}]
+    response = client.post('/sensor-data/batch', json=items)
+    assert response.status_code == 200
+    body = response.json()
+    assert (body['accepted'], body['rejected']) == (1, 3)
+    assert [result['status'] for result in body['results']] == [201, 400, 400, 400]
+    assert [result['index'] for result in body['results']] == [0, 1, 2, 3]
+    assert 'trace_id' in body['results'][0]
+    assert all('trace_id' not in result for result in body['results'][1:])
+    assert 'temperature' in body['results'][1]['error']
+    assert 'timestamp' in body['results'][2]['error']
+
+
+def test_rejects_ndjson_items_that_do_not_match_the_event_schema(client):
+    lines = "\n".join([json.dumps(dict(VALID, timestamp="nope")), json.dumps(VALID), '"not an event"'])
+    response = client.post('/sensor-data/batch', content=lines, headers={'Content-Type': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert [result['status'] for result in response.json()['results']] == [400, 201, 400]
+
+
+def test_rejects_batches_over_the_byte_limit(client):
+    items = [VALID] * 100
+    response = client.post('/sensor-data/batch', json=items)
+    assert response.status_code == 413
+
+
+def test_rejects_chunked_batches_over_the_byte_limit(client):
+    lines = [json.dumps(VALID).encode('utf-8') + b"\n" for _ in range(100)]
+    response = client.post('/sensor-data/batch', content=iter(lines), headers={'Content-Type': 'application/x-ndjson'})
+    assert response.status_code == 413
+
+
+def test_accepts_chunked_batches_within_the_byte_limit(client):
+    lines = [json.dumps(VALID).encode('utf-8') + b"\n" for _ in range(3)]
+    response = client.post('/sensor-data/batch', content=iter(lines), headers={'Content-Type': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.json()['accepted'] == 3
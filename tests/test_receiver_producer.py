@@ -0,0 +1,51 @@
+import os
+import sys
+import time
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Benchmarks'))
+import fake_kafka  # noqa: E402
+
+VALID = {"sensorId": "sensor-1", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen"}
+
+
+def wait_for(condition, timeout_sec=5):
+    deadline = time.monotonic() + timeout_sec
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_full_outbox_answers_503_until_the_producer_drains_it(service_loader):
+    def configure(app_config):
+        app_config['events']['producer']['max_in_flight'] = 2
+
+    receiver = service_loader('Receiver', configure)
+    client = receiver.app.test_client()
+    rejected = receiver.REJECTED_EVENTS.value()
+    # Kafka is not connected yet, so accepted events wait in the outbox until it is full
+    responses = [client.post('/sensor-data', json=VALID) for _ in range(3)]
+    assert [response.status_code for response in responses] == [201, 201, 503]
+    assert responses[2].headers['retry-after'] == '1'
+    assert receiver.REJECTED_EVENTS.value() - rejected == 1
+
+    topic = fake_kafka.Topic('events', 2)
+    receiver.kafka_producer.connect = lambda: topic.get_producer(delivery_reports=True)
+    receiver.kafka_producer.start()
+    Thread(target=receiver.run_async_producer, daemon=True).start()
+    wait_for(lambda: topic.size() == 2 and receiver.outbox.empty())
+
+    assert client.post('/sensor-data', json=VALID).status_code == 201
+    wait_for(lambda: topic.size() == 3)
+    trace_ids = {receiver.event_envelope.decode_payload(msg.value)['trace_id']
+                 for partition in topic.partitions.values() for msg in partition.messages}
+    assert len(trace_ids) == 3
+
+
+def test_sync_mode_answers_503_while_kafka_is_unavailable(service_loader):
+    def configure(app_config):
+        app_config['events']['producer']['mode'] = 'sync'
+
+    response = service_loader('Receiver', configure).app.test_client().post('/sensor-data', json=VALID)
+    assert response.status_code == 503
+    assert response.headers['retry-after'] == '1'
@@ -0,0 +1,97 @@
+import json
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+ROWS = [{"id": i, "sensor_id": f"sensor-{i}", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00",
+         "location": "Kitchen", "trace_id": f"trace-{i}", "date_created": "2024-09-19T10:00:01"}
+        for i in range(50)]
+
+MAX_ENTRY_BYTES = 1000
+
+
+class FakeStorage(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        FakeStorage.requests.append(self.path)
+        rows = ROWS[:int(params['limit'][0])] if 'limit' in params else ROWS
+        if params.get('format') == ['ndjson']:
+            body, content_type = "".join(json.dumps(row) + "\n" for row in rows), 'application/x-ndjson'
+        else:
+            body, content_type = json.dumps(rows), 'application/json'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def client(service_loader):
+    storage = ThreadingHTTPServer(('127.0.0.1', 0), FakeStorage)
+    Thread(target=storage.serve_forever, daemon=True).start()
+
+    def configure(app_config):
+        app_config['eventstore1']['url'] = f"http://127.0.0.1:{storage.server_port}/sensor-data"
+        app_config['proxy']['cache_max_entry_bytes'] = MAX_ENTRY_BYTES
+
+    yield service_loader('Receiver', configure).app.test_client()
+    storage.shutdown()
+
+
+def get_twice(client, params):
+    FakeStorage.requests.clear()
+    responses = [client.get('/sensor-data', params=params) for _ in range(2)]
+    return responses, len(FakeStorage.requests)
+
+
+def test_caches_small_bodies_of_closed_windows(client):
+    window = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": "2000-01-02T00:00:00", "limit": 2}
+    responses, upstream_requests = get_twice(client, window)
+    assert [response.json() for response in responses] == [ROWS[:2], ROWS[:2]]
+    assert upstream_requests == 1
+
+
+def test_streams_bodies_larger_than_a_cache_entry_without_caching_them(client):
+    window = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": "2000-01-02T00:00:00", "format": "ndjson"}
+    responses, upstream_requests = get_twice(client, window)
+    for response in responses:
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        assert [json.loads(line) for line in response.text.splitlines()] == ROWS
+    assert len(responses[0].content) > MAX_ENTRY_BYTES
+    assert upstream_requests == 2
+
+
+def test_does_not_cache_open_windows(client):
+    window = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": "2999-01-01T00:00:00", "limit": 2}
+    responses, upstream_requests = get_twice(client, window)
+    assert [response.json() for response in responses] == [ROWS[:2], ROWS[:2]]
+    assert upstream_requests == 2
+
+
+def test_caches_closed_windows_with_zoned_end_timestamps(client):
+    window = {"start_timestamp": "2000-01-01T00:00:00Z", "end_timestamp": "2000-01-02T00:00:00+02:00", "limit": 3}
+    responses, upstream_requests = get_twice(client, window)
+    assert [response.status_code for response in responses] == [200, 200]
+    assert upstream_requests == 1
+
+
+def test_storage_unavailable(service_loader):
+    def configure(app_config):
+        # Nothing listens on the discard port
+        app_config['eventstore1']['url'] = "http://127.0.0.1:9/sensor-data"
+
+    client = service_loader('Receiver', configure).app.test_client()
+    response = client.get('/sensor-data', params={"start_timestamp": "2000-01-01T00:00:00",
+                                                  "end_timestamp": "2000-01-02T00:00:00"})
+    assert response.status_code == 503
+    assert response.json() == {"error": "Storage unavailable"}
+    assert response.headers['retry-after'] == '5'
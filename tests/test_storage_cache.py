@@ -0,0 +1,90 @@
+import datetime
+
+import pytest
+
+READING = {"sensorId": "sensor-1", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen"}
+WINDOW = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": "2001-01-01T00:00:00"}
+
+
+@pytest.fixture(scope='module')
+def storage(service_loader):
+    storage = service_loader('Storage')
+    storage.init_database()
+    return storage
+
+
+def publish(storage, replica_id, watermark, updated):
+    session = storage.DB_SESSION()
+    try:
+        session.add(storage.ReplicaWatermark(replica_id=replica_id, watermark=watermark, updated=updated))
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_watermark_is_held_back_by_the_oldest_live_replica(storage):
+    # Nothing can be cached until the other replicas' watermarks are known
+    assert storage.ingest_watermark.value() == datetime.datetime.min
+
+    now = datetime.datetime.now()
+    writing_since = now - datetime.timedelta(hours=1)
+    publish(storage, 'writing-replica', writing_since, now)
+    publish(storage, 'gone-replica', now - datetime.timedelta(hours=2), now - datetime.timedelta(hours=1))
+    storage.sync_watermark()
+    assert storage.ingest_watermark.value() == writing_since
+
+    session = storage.DB_SESSION()
+    try:
+        replicas = {replica_id for (replica_id,) in session.query(storage.ReplicaWatermark.replica_id)}
+    finally:
+        session.close()
+    assert replicas == {storage.REPLICA_ID, 'writing-replica'}
+
+
+def test_closed_windows_are_cached_until_retention_invalidates_them(storage):
+    storage.ingest_watermark.raise_floor(datetime.datetime.now())
+    row = dict(storage.sensor_data_row(READING), date_created=datetime.datetime(2000, 6, 1))
+    session = storage.DB_SESSION()
+    try:
+        storage.store_batch(session, {'sensor_data': [row]})
+    finally:
+        session.close()
+
+    client = storage.app.test_client()
+    hits = storage.RESULT_CACHE_HITS.value()
+    assert len(client.get('/sensor-data', params=WINDOW).json()) == 1
+    assert len(client.get('/sensor-data', params=WINDOW).json()) == 1
+    assert storage.RESULT_CACHE_HITS.value() - hits == 1
+
+    storage.result_cache.invalidate('sensor_data')
+    assert len(client.get('/sensor-data', params=WINDOW).json()) == 1
+    assert storage.RESULT_CACHE_HITS.value() - hits == 1
+    assert client.get('/cache/stats').json()['entries'] == 1
+
+
+def test_windows_past_the_watermark_query_only_the_tail(storage):
+    window = {"start_timestamp": "2002-01-01T00:00:00", "end_timestamp": "2100-01-01T00:00:00"}
+    storage.ingest_watermark.raise_floor(datetime.datetime.now())
+    old_row = dict(storage.sensor_data_row(dict(READING, sensorId="sensor-old")),
+                   date_created=datetime.datetime(2002, 6, 1))
+    session = storage.DB_SESSION()
+    try:
+        storage.store_batch(session, {'sensor_data': [old_row]})
+    finally:
+        session.close()
+
+    client = storage.app.test_client()
+    # A write in flight holds the watermark, and so the cached prefix, where it is
+    with storage.ingest_watermark.writing():
+        hits = storage.RESULT_CACHE_HITS.value()
+        assert [row['sensor_id'] for row in client.get('/sensor-data', params=window).json()] == ['sensor-old']
+        tail_row = dict(storage.sensor_data_row(dict(READING, sensorId="sensor-new")),
+                        date_created=datetime.datetime.now() + datetime.timedelta(hours=1))
+        session = storage.DB_SESSION()
+        try:
+            storage.store_batch(session, {'sensor_data': [tail_row]})
+        finally:
+            session.close()
+        rows = client.get('/sensor-data', params=window).json()
+        assert [row['sensor_id'] for row in rows] == ['sensor-old', 'sensor-new']
+        assert storage.RESULT_CACHE_HITS.value() - hits == 1
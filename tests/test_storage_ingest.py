@@ -0,0 +1,120 @@
+import pytest
+
+READING = {"sensorId": "sensor-1", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen"}
+
+
+@pytest.fixture(scope='module')
+def storage(service_loader):
+    storage = service_loader('Storage')
+    storage.init_database()
+    return storage
+
+
+def store(storage, *trace_ids):
+    """Stores a batch of sensor data with the given trace ids, as a fresh consumer would after a restart."""
+    storage.trace_id_cache = storage.TraceIdCache(100)
+    session = storage.DB_SESSION()
+    try:
+        storage.store_batch(session, {'sensor_data': [storage.sensor_data_row(dict(READING, trace_id=trace_id))
+                                                      for trace_id in trace_ids]})
+    finally:
+        session.close()
+
+
+def count_rows(storage, model, **filters):
+    session = storage.DB_SESSION()
+    try:
+        return session.query(model).filter_by(**filters).count()
+    finally:
+        session.close()
+
+
+def test_replays_are_dropped_and_counted(storage):
+    replayed = storage.REPLAYED_EVENTS.value()
+    stored = storage.STORED_EVENTS.value()
+    store(storage, 'replay-1', 'replay-2')
+    store(storage, 'replay-2', 'replay-3')
+    assert count_rows(storage, storage.SensorData, trace_id='replay-2') == 1
+    assert storage.REPLAYED_EVENTS.value() - replayed == 1
+    assert storage.STORED_EVENTS.value() - stored == 3
+
+
+def test_rollups_only_count_inserted_rows(storage):
+    store(storage, 'rollup-1')
+    store(storage, 'rollup-1', 'rollup-2')
+    session = storage.DB_SESSION()
+    try:
+        rollup = session.query(storage.SensorRollup).filter_by(bucket='hour', sensor_id='sensor-1').one()
+        assert rollup.count == count_rows(storage, storage.SensorData, sensor_id='sensor-1')
+    finally:
+        session.close()
+
+
+def test_digests_only_count_inserted_rows(storage):
+    store(storage, 'digest-1')
+    store(storage, 'digest-1', 'digest-2')
+    session = storage.DB_SESSION()
+    try:
+        bucket_start = storage.parse_event_timestamp(READING['timestamp'])
+        digest = session.query(storage.TraceDigest).filter_by(event_type='sensor_data', bucket_start=bucket_start).one()
+        trace_ids = [trace_id for (trace_id,) in session.query(storage.SensorData.trace_id)
+                     .filter_by(timestamp=bucket_start)]
+    finally:
+        session.close()
+    assert digest.count == len(trace_ids)
+    assert digest.digest == sum(storage.trace_id_hash(trace_id) for trace_id in trace_ids) % storage.DIGEST_MODULUS
+
+
+def test_trace_id_drill_down_reads_cold_storage(service_loader):
+    def enable_cold_storage(app_config):
+        app_config['cold_storage']['export_after_days'] = 1
+
+    storage = service_loader('Storage', enable_cold_storage)
+    storage.init_database()
+    store(storage, 'hot-1')
+    exported = dict(storage.sensor_data_row(dict(READING, trace_id='cold-1')), id=1,
+                    date_created=storage.datetime.datetime(2024, 9, 19, 10, 0, 1))
+    storage.cold_store.export_day(storage.SensorData, storage.datetime.date(2024, 9, 19), [exported])
+
+    response = storage.app.test_client().get('/reconcile/trace-ids',
+                                             params={"event_type": "sensor_data", "bucket_start": "2024-09-19T10:00:00"})
+    assert response.status_code == 200
+    assert sorted(response.json()) == ['cold-1', 'hot-1']
+
+
+def test_replays_are_dropped_from_partitioned_tables(service_loader):
+    def partition_by_day(app_config):
+        app_config['retention']['partition_by_day'] = True
+
+    storage = service_loader('Storage', partition_by_day)
+    storage.init_database()
+    # Partitioning swaps the unique trace_id index for a plain one, as enable_day_partitioning does on MySQL
+    with storage.DB_ENGINE.begin() as conn:
+        conn.execute(storage.text('DROP INDEX sensor_data_trace_id_idx'))
+        conn.execute(storage.text('CREATE INDEX sensor_data_trace_id_idx ON sensor_data (trace_id)'))
+
+    replayed = storage.REPLAYED_EVENTS.value()
+    store(storage, 'partitioned-1', 'partitioned-2')
+    store(storage, 'partitioned-2', 'partitioned-3')
+    assert count_rows(storage, storage.SensorData, trace_id='partitioned-2') == 1
+    assert count_rows(storage, storage.StoredTraceId, event_type='sensor_data') == 3
+    assert storage.REPLAYED_EVENTS.value() - replayed == 1
+    session = storage.DB_SESSION()
+    try:
+        rollup = session.query(storage.SensorRollup).filter_by(bucket='hour', sensor_id='sensor-1').one()
+        digest = session.query(storage.TraceDigest).filter_by(event_type='sensor_data').one()
+    finally:
+        session.close()
+    assert rollup.count == digest.count == 3
+
+
+def test_bad_rows_raise_rather_than_being_skipped_as_duplicates(storage):
+    rows = [storage.sensor_data_row(dict(READING, trace_id=trace_id)) for trace_id in ('bad-1', 'bad-2')]
+    rows[1]['location'] = None
+    session = storage.DB_SESSION()
+    try:
+        with pytest.raises(storage.IntegrityError):
+            storage.store_batch(session, {'sensor_data': rows})
+    finally:
+        session.close()
+    assert count_rows(storage, storage.SensorData, trace_id='bad-1') == 0
@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+WINDOW = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": "2100-01-01T00:00:00"}
+
+SENSOR_DATA = [
+    {"sensorId": f"sensor-{i}", "temperature": 20.0 + i, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen"}
+    for i in range(3)
+]
+USER_COMMAND = {"userId": "user-1", "targetDevice": "Thermostat", "targetTemperature": 21.0,
+                "timestamp": "2024-09-19T10:05:00Z"}
+
+
+@pytest.fixture(scope='module')
+def client(service_loader):
+    storage = service_loader('Storage')
+    storage.init_database()
+    client = storage.app.test_client()
+    for event in SENSOR_DATA:
+        assert client.post('/sensor-data', json=event).status_code == 201
+    assert client.post('/user-command', json=USER_COMMAND).status_code == 201
+    return client
+
+
+def read_ndjson(response):
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_json(client):
+    response = client.get('/sensor-data', params=WINDOW)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/json'
+    assert [row['sensor_id'] for row in response.json()] == ['sensor-0', 'sensor-1', 'sensor-2']
+    assert 'x-next-cursor' not in response.headers
+
+
+def test_json_pages(client):
+    first = client.get('/sensor-data', params=dict(WINDOW, limit=2))
+    assert first.status_code == 200
+    assert [row['sensor_id'] for row in first.json()] == ['sensor-0', 'sensor-1']
+
+    second = client.get('/sensor-data', params=dict(WINDOW, limit=2, cursor=first.headers['x-next-cursor']))
+    assert second.status_code == 200
+    assert [row['sensor_id'] for row in second.json()] == ['sensor-2']
+    assert 'x-next-cursor' not in second.headers
+
+
+def test_ndjson(client):
+    response = client.get('/sensor-data', params=dict(WINDOW, format='ndjson'))
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert [row['sensor_id'] for row in read_ndjson(response)] == ['sensor-0', 'sensor-1', 'sensor-2']
+
+
+def test_ndjson_pages(client):
+    first = read_ndjson(client.get('/sensor-data', params=dict(WINDOW, format='ndjson', limit=2)))
+    assert [row['sensor_id'] for row in first[:-1]] == ['sensor-0', 'sensor-1']
+
+    second = read_ndjson(client.get('/sensor-data',
+                                    params=dict(WINDOW, format='ndjson', limit=2, cursor=first[-1]['next_cursor'])))
+    assert [row['sensor_id'] for row in second] == ['sensor-2']
+
+
+@pytest.mark.parametrize('format', ['json', 'ndjson'])
+def test_user_command(client, format):
+    response = client.get('/user-command', params=dict(WINDOW, format=format))
+    assert response.status_code == 200
+    rows = response.json() if format == 'json' else read_ndjson(response)
+    assert [row['user_id'] for row in rows] == ['user-1']
+
+
+def test_invalid_cursor(client):
+    response = client.get('/sensor-data', params=dict(WINDOW, cursor='not a cursor'))
+    assert response.status_code == 400
+
+
+def test_window_detail_pages_sensors(client):
+    params = dict(WINDOW, event_type='sensor_data', detail=True, sensor_limit=2)
+    first = client.get('/stats/window', params=params).json()['sensor_data']
+    assert first['count'] == 3
+    assert [sensor['sensor_id'] for sensor in first['sensors']] == ['sensor-0', 'sensor-1']
+
+    second = client.get('/stats/window', params=dict(params, sensor_cursor=first['next_sensor_cursor'])).json()
+    assert [sensor['sensor_id'] for sensor in second['sensor_data']['sensors']] == ['sensor-2']
+    assert 'next_sensor_cursor' not in second['sensor_data']
+
+
+def test_invalid_sensor_cursor(client):
+    response = client.get('/stats/window', params=dict(WINDOW, detail=True, sensor_cursor='not a cursor'))
+    assert response.status_code == 400
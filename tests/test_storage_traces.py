@@ -0,0 +1,64 @@
+import time
+import datetime
+
+import pytest
+
+WINDOW = {"start_timestamp": "2000-01-01T00:00:00", "end_timestamp": "2001-01-01T00:00:00"}
+CREATED = datetime.datetime(2000, 6, 1)
+READING = {"sensorId": "sensor-1", "temperature": 21.5, "timestamp": "2024-09-19T10:00:00Z", "location": "Kitchen"}
+
+
+@pytest.fixture(scope='module')
+def storage(service_loader):
+    storage = service_loader('Storage')
+    storage.init_database()
+    received = time.time() - 10
+    rows = []
+    traces = []
+    # Three traced events spending 0.1, 0.2 and 0.3 s in Receiver's outbox and 1, 2 and 3 s in Kafka,
+    # and one that wasn't sampled
+    for i in range(4):
+        row = dict(storage.sensor_data_row(dict(READING, trace_id=f"trace-{i}")), date_created=CREATED)
+        rows.append(row)
+        if i < 3:
+            traces.append({'trace_id': row['trace_id'], 'event_type': 'sensor_data', 'date_created': CREATED,
+                           'received': received, 'produced': received + 0.1 * (i + 1),
+                           'consumed': received + 0.1 * (i + 1) + i + 1})
+    session = storage.DB_SESSION()
+    try:
+        storage.store_batch(session, {'sensor_data': rows}, traces)
+    finally:
+        session.close()
+    return storage
+
+
+def test_traces_hold_the_stage_times_of_sampled_events(storage):
+    client = storage.app.test_client()
+    trace = client.get('/traces/trace-0').json()
+    assert trace['event_type'] == 'sensor_data'
+    assert trace['stages']['consumed'] - trace['stages']['received'] == pytest.approx(1.1)
+    assert trace['stages']['committed'] >= trace['stages']['consumed']
+    assert trace['stages']['picked_up'] is None
+    assert trace['latencies']['kafka'] == pytest.approx(1.0)
+    assert client.get('/traces/trace-3').status_code == 404
+
+
+def test_stats_aggregate_stage_latencies_once_processing_picks_up_the_window(storage):
+    client = storage.app.test_client()
+    stats = client.get('/traces/stats', params=WINDOW).json()
+    assert stats['receiver_queue']['count'] == 3
+    assert (stats['receiver_queue']['p50'], stats['receiver_queue']['max']) == (pytest.approx(0.2), pytest.approx(0.3))
+    assert (stats['kafka']['p50'], stats['kafka']['max']) == (pytest.approx(2.0), pytest.approx(3.0))
+    assert stats['processing_poll'] == {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+
+    picked_up = time.time()
+    response = client.post('/traces/picked-up', json=dict(WINDOW, picked_up=picked_up))
+    assert response.json() == {"updated": 3}
+    # Only the first pickup of a window is recorded
+    assert client.post('/traces/picked-up', json=dict(WINDOW, picked_up=picked_up + 60)).json() == {"updated": 0}
+
+    stats = client.get('/traces/stats', params=dict(WINDOW, event_type='sensor_data')).json()
+    assert stats['processing_poll']['count'] == 3
+    received = storage.get_trace('trace-0')[0]['stages']['received']
+    assert stats['end_to_end']['max'] == pytest.approx(picked_up - received)
+    assert client.get('/traces/stats', params=dict(WINDOW, event_type='user_command')).json()['kafka']['count'] == 0